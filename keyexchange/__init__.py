@@ -33,3 +33,6 @@
 # the terms of any one of the MPL, the GPL or the LGPL.
 #
 # ***** END LICENSE BLOCK *****
+import logging
+
+logger = logging.getLogger('keyexchange')
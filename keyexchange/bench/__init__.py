@@ -0,0 +1,215 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmarks.
+
+app runs the application in-process, loadgen loads a running server. Their
+results are plain dicts, dumped in JSON with sorted keys so two runs can be
+diffed, and can be kept in a results directory to be compared later (see
+keyexchange.bench.results).
+"""
+import gc
+import sys
+import time
+import json
+import socket
+import platform
+from hashlib import sha1
+
+# time.time has a microsecond resolution on the platforms we run on
+timer = time.time
+
+
+def percentile(samples, pct):
+    """Returns the nearest-rank percentile of sorted samples."""
+    if not samples:
+        return 0.
+    rank = int(len(samples) * pct / 100. + 0.5)
+    rank = min(max(rank, 1), len(samples))
+    return samples[rank - 1]
+
+
+def summarize(samples, unit='us', keep_samples=False):
+    """Returns the metrics of a list of durations, in seconds.
+
+    The throughput is computed on the time spent in the measured calls
+    only, so the setup of each call does not lower it. If keep_samples is
+    True, the sorted durations are kept as well, in the same unit.
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+    count = len(samples)
+    scale = {'us': 1000000., 'ms': 1000., 's': 1.}[unit]
+
+    def _value(value):
+        return round(value * scale, 3)
+
+    if total > 0:
+        ops = round(count / total, 2)
+    else:
+        ops = 0.
+    if count:
+        mean = total / count
+    else:
+        mean = 0.
+    summary = {'count': count, 'ops_per_sec': ops, 'unit': unit,
+               'mean': _value(mean),
+               'min': _value(samples and samples[0] or 0.),
+               'p50': _value(percentile(samples, 50)),
+               'p90': _value(percentile(samples, 90)),
+               'p99': _value(percentile(samples, 99)),
+               'p99.9': _value(percentile(samples, 99.9)),
+               'max': _value(samples and samples[-1] or 0.)}
+    if keep_samples:
+        summary['samples'] = [_value(sample) for sample in samples]
+    return summary
+
+
+def measure(func, iterations, warmup=0, prepare=None):
+    """Calls func() iterations times and returns the durations.
+
+    - warmup: number of calls done first, and not measured.
+    - prepare: optional callable called before each call, out of the
+      measure. What it returns is passed to func.
+
+    Like timeit, the garbage collector is disabled during the calls, so
+    its pauses don't land at random in the samples.
+    """
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in xrange(warmup + iterations):
+            if prepare is not None:
+                args = (prepare(),)
+            else:
+                args = ()
+            start = timer()
+            func(*args)
+            duration = timer() - start
+            if i >= warmup:
+                samples.append(duration)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return samples
+
+
+def _cpu_model():
+    try:
+        cpuinfo = open('/proc/cpuinfo')
+    except IOError:
+        return platform.processor()
+    try:
+        for line in cpuinfo:
+            if line.startswith('model name'):
+                return line.split(':', 1)[1].strip()
+    finally:
+        cpuinfo.close()
+    return platform.processor()
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def environment():
+    """Describes where the benchmark ran.
+
+    The fingerprint identifies the machine and the interpreter: results
+    with different fingerprints can't be compared.
+    """
+    env = {'python': platform.python_version(),
+           'implementation': platform.python_implementation(),
+           'platform': platform.platform(),
+           'machine': platform.machine(),
+           'cpu': _cpu_model(),
+           'cpus': _cpu_count(),
+           'host': socket.gethostname()}
+    keys = ('host', 'cpu', 'cpus', 'machine', 'implementation', 'python')
+    fingerprint = '|'.join([str(env[key]) for key in keys])
+    env['fingerprint'] = sha1(fingerprint).hexdigest()[:12]
+    return env
+
+
+def dump(results, stream=None):
+    """Writes the results in JSON, with a stable keys order."""
+    if stream is None:
+        stream = sys.stdout
+    json.dump(results, stream, sort_keys=True, indent=2)
+    stream.write('\n')
+
+
+def add_output_options(parser):
+    """Adds the options used by write_results to an OptionParser."""
+    parser.add_option('-o', '--output', help='writes the results there')
+    parser.add_option('-s', '--save', action='store_true', default=False,
+                      help='keeps the results, with their samples, in the '
+                           'results directory')
+    parser.add_option('--results-dir', default='benchresults',
+                      help='the results directory [%default]')
+
+
+def write_results(results, options, stdout=True):
+    """Writes the results as asked in the command-line options. Without an
+    output file, they are dumped on stdout unless stdout is False."""
+    if options.save:
+        from keyexchange.bench.results import save
+        path = save(results, options.results_dir)
+        sys.stderr.write('Results saved in %s\n' % path)
+    if options.output is not None:
+        stream = open(options.output, 'w')
+        try:
+            dump(results, stream)
+        finally:
+            stream.close()
+    elif stdout:
+        dump(_strip_samples(results))
+
+
+def _strip_samples(results):
+    # the samples are only useful to compare runs
+    if isinstance(results, dict):
+        return dict([(key, _strip_samples(value))
+                     for key, value in results.items()
+                     if key != 'samples'])
+    if isinstance(results, list):
+        return [_strip_samples(value) for value in results]
+    return results
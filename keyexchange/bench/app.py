@@ -0,0 +1,403 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmarks the request paths of KeyExchangeApp.
+
+The application is built with make_app and called directly through WSGI,
+with the memory backend or with a fake memcache that pickles the values
+like a real client does, and can add a latency to each call.
+
+    $ bin/python -m keyexchange.bench.app --iterations 2000 > before.json
+
+Each scenario measures one kind of request. The setup it needs (creating a
+channel, filling it..) is done out of the measure.
+"""
+import os
+import sys
+import json
+import hashlib
+import random
+import time
+import cPickle
+from cStringIO import StringIO
+from optparse import OptionParser
+
+from keyexchange.bench import (summarize, measure, environment,
+                             add_output_options, write_results)
+from keyexchange.util import MemoryClient
+from keyexchange.wsgiapp import make_app, KeyExchangeApp
+
+
+class FakeMemcache(MemoryClient):
+    """Memory client that serializes the values, like memcache does.
+
+    - latency: time in seconds added to each call, to simulate the network
+      round trip.
+    """
+    def __init__(self, servers, latency=0.):
+        MemoryClient.__init__(self, servers)
+        self.latency = latency
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key):
+        self._wait()
+        value = dict.get(self, key)
+        if value is None:
+            return None
+        return cPickle.loads(value)
+
+    def set(self, key, value, time=0):
+        self._wait()
+        return MemoryClient.set(self, key, cPickle.dumps(value, 2), time)
+
+    cas = set
+
+    def add(self, key, value, time=0):
+        self._wait()
+        return MemoryClient.add(self, key, cPickle.dumps(value, 2), time)
+
+    def replace(self, key, value, time=0):
+        self._wait()
+        return MemoryClient.replace(self, key, cPickle.dumps(value, 2), time)
+
+    def delete(self, key):
+        self._wait()
+        return MemoryClient.delete(self, key)
+
+    def incr(self, key):
+        self._wait()
+        value = str(int(cPickle.loads(self[key])) + 1)
+        self[key] = cPickle.dumps(value, 2)
+        return int(value)
+
+
+def _client_id():
+    return hashlib.sha256(str(random.random())).hexdigest() * 4
+
+
+class Client(object):
+    """Calls a WSGI application in-process.
+
+    The requests come from a pool of IPs, so the IP filtering does not
+    blacklist the benchmark.
+    """
+    def __init__(self, app, ips=256):
+        self.app = app
+        self.ips = ['10.0.%d.%d' % (i / 256, i % 256) for i in range(ips)]
+        self._ip = 0
+        self.id = _client_id()
+
+    def environ(self, method, path, headers=None, body=''):
+        """Builds the environ of a request."""
+        self._ip = (self._ip + 1) % len(self.ips)
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+                   'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'REMOTE_ADDR': self.ips[self._ip],
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+                   'wsgi.input': StringIO(body), 'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': False, 'wsgi.multiprocess': False,
+                   'wsgi.run_once': False,
+                   'HTTP_X_KEYEXCHANGE_ID': self.id}
+        if headers is not None:
+            for name, value in headers.items():
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = value
+        if body:
+            environ['CONTENT_TYPE'] = 'application/json'
+        return environ
+
+    def call(self, environ):
+        """Calls the application, returns the status, headers and body."""
+        res = []
+
+        def start_response(status, headers, exc_info=None):
+            res.append(status)
+            res.append(headers)
+
+        body = ''.join(self.app(environ, start_response))
+        status = int(res[0].split(' ', 1)[0])
+        return status, dict(res[1]), body
+
+    def request(self, method, path, headers=None, body='', status=200):
+        """Calls the application and checks the status."""
+        environ = self.environ(method, path, headers, body)
+        res = self.call(environ)
+        if res[0] != status:
+            raise AssertionError('%s %s returned %d' % (method, path, res[0]))
+        return res
+
+    def new_channel(self):
+        status, headers, body = self.request('GET', '/new_channel')
+        return str(json.loads(body))
+
+
+class Scenarios(object):
+    """The benchmarked requests.
+
+    Each bench_* method returns a prepare callable, called out of the
+    measure, that returns the environ of the request to measure, and the
+    expected status.
+    """
+    payload = json.dumps({'data': 'x' * 700})
+
+    def __init__(self, client, max_gets=6):
+        self.client = client
+        self.max_gets = max_gets
+
+    def _filled_channel(self):
+        cid = self.client.new_channel()
+        self.client.request('PUT', '/' + cid, body=self.payload)
+        return cid
+
+    def bench_new_channel(self):
+        def prepare():
+            return self.client.environ('GET', '/new_channel'), 200
+        return prepare
+
+    def bench_join(self):
+        def prepare():
+            cid = self._filled_channel()
+            environ = self.client.environ('GET', '/' + cid)
+            # the second client registers itself on its first GET
+            environ['HTTP_X_KEYEXCHANGE_ID'] = _client_id()
+            return environ, 200
+        return prepare
+
+    def bench_put(self):
+        def prepare():
+            cid = self.client.new_channel()
+            return self.client.environ('PUT', '/' + cid,
+                                       body=self.payload), 200
+        return prepare
+
+    def bench_get_200(self):
+        # the last GET deletes the channel, we stay below
+        state = {'cid': None, 'gets': 0}
+
+        def prepare():
+            if state['cid'] is None or state['gets'] >= self.max_gets - 1:
+                state['cid'] = self._filled_channel()
+                state['gets'] = 0
+            state['gets'] += 1
+            return self.client.environ('GET', '/' + state['cid']), 200
+        return prepare
+
+    def bench_get_304(self):
+        # a 304 does not count as a GET, the channel can be reused
+        cid = self._filled_channel()
+        status, headers, body = self.client.request('GET', '/' + cid)
+        etag = headers['ETag']
+
+        def prepare():
+            headers = {'If-None-Match': etag}
+            return self.client.environ('GET', '/' + cid, headers), 304
+        return prepare
+
+    def bench_report(self):
+        def prepare():
+            cid = self.client.new_channel()
+            headers = {'X-KeyExchange-Log': 'Pairing failed',
+                       'X-KeyExchange-Cid': cid}
+            return self.client.environ('POST', '/report', headers,
+                                       body='error ' * 20), 200
+        return prepare
+
+
+def pairing(app, params):
+    """Runs a full J-PAKE exchange between two clients, as the browsers do.
+
+    The channel is never read more than max_gets times.
+    """
+    from keyexchange.tests.client import JPAKE
+    sender = Client(app)
+    receiver = Client(app)
+    sender_pake = JPAKE('secret', params=params, signerid='sender')
+    receiver_pake = JPAKE('secret', params=params, signerid='receiver')
+    cid = sender.new_channel()
+    url = '/' + cid
+
+    def put(client, msg):
+        status, headers, body = client.request('PUT', url,
+                                               body=json.dumps(msg))
+        return headers['ETag']
+
+    def get(client, etag=None):
+        if etag is not None:
+            headers = {'If-None-Match': etag}
+        else:
+            headers = None
+        status, headers, body = client.request('GET', url, headers)
+        return _str(json.loads(body))
+
+    # step one, the receiver registers itself on its first GET
+    sender_etag = put(sender, sender_pake.one())
+    sender_one = get(receiver)
+    receiver_etag = put(receiver, receiver_pake.one())
+
+    # step two
+    sender_etag = put(sender, sender_pake.two(get(sender, sender_etag)))
+    sender_two = get(receiver, receiver_etag)
+    receiver_etag = put(receiver, receiver_pake.two(sender_one))
+
+    # step three, then the sender sends the data
+    receiver_key = receiver_pake.three(sender_two)
+    sender_key = sender_pake.three(get(sender, sender_etag))
+    if sender_key != receiver_key:
+        raise AssertionError('The keys differ')
+    put(sender, {'username': 'bob', 'password': 'secret'})
+    get(receiver, receiver_etag)
+
+
+def _str(data):
+    # the JPAKE class wants str, not unicode
+    if isinstance(data, unicode):
+        return str(data)
+    if isinstance(data, dict):
+        return dict([(str(key), _str(value))
+                     for key, value in data.items()])
+    return data
+
+
+def build_app(memcache='memory', latency=0., filtering=False, max_gets=6):
+    """Returns the application, and the KeyExchangeApp it wraps."""
+    # the values are strings, as in an ini file
+    conf = {'keyexchange.use_memory': 'true',
+            'keyexchange.max_gets': str(max_gets),
+            'keyexchange.health_frequency': '0',
+            'keyexchange.root_redirect': 'https://services.mozilla.com',
+            'cef.use': 'true', 'cef.file': os.devnull,
+            'cef.vendor': 'mozilla', 'cef.version': '0',
+            'cef.device_version': '1.3', 'cef.product': 'keyexchange',
+            'filtering.use': str(filtering).lower()}
+    if filtering:
+        conf.update({'filtering.use_memory': 'true',
+                     'filtering.async': 'false',
+                     'filtering.update_blfreq': '1000'})
+    app = make_app({}, **conf)
+
+    kxapp = app
+    while not isinstance(kxapp, KeyExchangeApp):
+        kxapp = kxapp.app
+
+    if memcache == 'fake':
+        kxapp.cache.cache = FakeMemcache(kxapp.cache_servers, latency)
+    return app, kxapp
+
+
+def run(scenarios=None, iterations=1000, warmup=100, memcache='memory',
+        latency=0., filtering=False, pairings=20, params='80'):
+    """Runs the benchmarks and returns the results."""
+    if iterations < 1 or pairings < 1:
+        raise ValueError('At least one iteration and one pairing are needed')
+    from keyexchange.tests import client as jpake
+    app, kxapp = build_app(memcache, latency, filtering)
+    client = Client(app)
+    bench = Scenarios(client, kxapp.max_gets)
+    if scenarios is None:
+        scenarios = [name[len('bench_'):] for name in dir(bench)
+                     if name.startswith('bench_')] + ['pairing']
+
+    results = {}
+    for name in scenarios:
+        if name == 'pairing':
+            params_ = getattr(jpake, 'params_%s' % params)
+            samples = measure(lambda: pairing(app, params_), pairings,
+                              min(warmup, 2))
+            results[name] = summarize(samples, unit='ms',
+                                      keep_samples=True)
+            continue
+
+        prepare = getattr(bench, 'bench_%s' % name)()
+        calls = []
+
+        def call(request):
+            environ, status = request
+            res = client.call(environ)
+            if res[0] != status:
+                raise AssertionError('%s returned %d' % (name, res[0]))
+            calls.append(environ.get('keyexchange.cache_calls', 0))
+
+        samples = measure(call, iterations, warmup, prepare)
+        results[name] = summarize(samples, keep_samples=True)
+        calls = calls[warmup:]
+        if calls:
+            results[name]['cache_calls'] = round(float(sum(calls)) /
+                                                 len(calls), 2)
+
+    return {'benchmark': 'app',
+            'config': {'iterations': iterations, 'warmup': warmup,
+                       'memcache': memcache, 'latency': latency,
+                       'filtering': filtering, 'pairings': pairings,
+                       'params': params},
+            'environment': environment(),
+            'results': results}
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-n', '--iterations', type='int', default=1000,
+                      help='measured calls per scenario')
+    parser.add_option('-w', '--warmup', type='int', default=100,
+                      help='calls done before the measure')
+    parser.add_option('-m', '--memcache', choices=['memory', 'fake'],
+                      default='memory', help='memory or fake memcache')
+    parser.add_option('-l', '--latency', type='float', default=0.,
+                      help='latency of the fake memcache, in seconds')
+    parser.add_option('-f', '--filtering', action='store_true',
+                      default=False, help='adds the IP filtering')
+    parser.add_option('-p', '--pairings', type='int', default=20,
+                      help='number of full J-PAKE pairings')
+    parser.add_option('--params', choices=['80', '112', '128'],
+                      default='80', help='J-PAKE parameters')
+    add_output_options(parser)
+    options, scenarios = parser.parse_args(args)
+    if options.iterations < 1 or options.pairings < 1:
+        parser.error('At least one iteration and one pairing are needed')
+
+    results = run(scenarios or None, options.iterations, options.warmup,
+                  options.memcache, options.latency, options.filtering,
+                  options.pairings, options.params)
+    write_results(results, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmarks the J-PAKE math of tests/client.py, for each params level, and
+the EC-JPAKE one of tests/ecjpake.py.
+
+    $ bin/python -m keyexchange.bench.crypto -n 100
+    $ bin/python -m keyexchange.bench.crypto -n 100 128 p256
+
+The load generator runs the client side of every pairing, so its speed
+bounds the load it can send. --table prints the ops/sec and latencies of
+each operation, and the number of pairings a CPU can run:
+
+    $ bin/python -m keyexchange.bench.crypto --table --save
+"""
+import sys
+import random
+import time
+from optparse import OptionParser
+
+from keyexchange.bench import (summarize, measure, environment, timer,
+                               add_output_options, write_results)
+from keyexchange.tests import client as jpake
+from keyexchange.tests import ecjpake
+
+
+PARAMS = ('80', '112', '128')
+# the EC-JPAKE curves, params_128 is the finite-field equivalent of P-256
+CURVES = {'p256': ecjpake.P256}
+
+
+def _pair(params):
+    # two instances that went through one()
+    sender = jpake.JPAKE('secret', params=params, signerid='sender')
+    receiver = jpake.JPAKE('secret', params=params, signerid='receiver')
+    return sender, receiver, sender.one(), receiver.one()
+
+
+def _proofs(params, count):
+    # proofs for g, as in two(), and for another generator, as in three()
+    prover = jpake.JPAKE('secret', params=params, signerid='prover')
+    generator = params.gpow(random.randrange(params.q))
+    proofs = []
+    for i in range(count):
+        if i % 2:
+            base = generator
+        else:
+            base = params.g
+        x = random.randrange(params.q)
+        gx = pow(base, x, params.p)
+        proofs.append((base, gx, prover.createZKP(base, x, gx)))
+    return proofs
+
+
+def bench_params(params, iterations=100, warmup=5, batch=50):
+    """Returns the durations of the J-PAKE operations for params.
+
+    The checks of batch proofs, one by one and at once, are measured
+    iterations / 10 times.
+    """
+    p = params.p
+    q = params.q
+    g = params.g
+
+    def exponent():
+        return random.randrange(q)
+
+    samples = {}
+    start = timer()
+    jpake.get_fixed_base_table(g, p, q)
+    build = timer() - start
+
+    samples['pow_g'] = measure(lambda e: pow(g, e, p), iterations, warmup,
+                               exponent)
+    samples['gpow'] = measure(params.gpow, iterations, warmup, exponent)
+
+    def exponents():
+        return (random.randrange(p), random.randrange(q),
+                random.randrange(p), random.randrange(q))
+
+    samples['two_pow'] = measure(
+        lambda args: (pow(args[0], args[1], p) * pow(args[2], args[3], p))
+                     % p, iterations, warmup, exponents)
+    samples['multi_exp'] = measure(
+        lambda args: jpake.multi_exp([args[:2], args[2:]], p), iterations,
+        warmup, exponents)
+
+    # a proof for g, as in two(), and for another generator, as in three()
+    prover = jpake.JPAKE('secret', params=params, signerid='prover')
+    verifier = jpake.JPAKE('secret', params=params, signerid='verifier')
+    for suffix, generator in (('_g', g), ('', params.gpow(exponent()))):
+        def prepare_secret(generator=generator):
+            x = exponent()
+            return generator, x, pow(generator, x, p)
+
+        def prepare_zkp(generator=generator):
+            generator, x, gx = prepare_secret(generator)
+            return generator, gx, prover.createZKP(generator, x, gx)
+
+        samples['create_zkp' + suffix] = measure(
+            lambda args: prover.createZKP(*args), iterations, warmup,
+            prepare_secret)
+        samples['check_zkp' + suffix] = measure(
+            lambda args: verifier.checkZKP(*args), iterations, warmup,
+            prepare_zkp)
+
+    def check_one_by_one(proofs):
+        for proof in proofs:
+            verifier.checkZKP(*proof)
+
+    def prepare():
+        return _proofs(params, batch)
+
+    batch_iterations = max(iterations // 10, 1)
+    samples['check_zkps'] = measure(check_one_by_one, batch_iterations, 1,
+                                    prepare)
+    samples['batch_check_zkps'] = measure(
+        lambda proofs: jpake.batch_check_zkps(params, proofs, 'verifier'),
+        batch_iterations, 1, prepare)
+
+    samples['one'] = measure(
+        lambda pake: pake.one(), iterations, warmup,
+        lambda: jpake.JPAKE('secret', params=params, signerid='sender'))
+
+    # one() drawing precomputed material. The producer is stopped before
+    # the measure so it doesn't compete for the CPU.
+    pool = jpake.RoundOnePool(params, iterations + warmup)
+    pool.start()
+    while pool.stats()['available'] < pool.size:
+        time.sleep(.01)
+    pool.join()
+    samples['one_pooled'] = measure(
+        lambda pake: pake.one(), iterations, warmup,
+        lambda: jpake.JPAKE('secret', params=params, signerid='sender',
+                            pool=pool))
+
+    def prepare_two():
+        sender, receiver, sender_one, receiver_one = _pair(params)
+        return sender, receiver_one
+
+    samples['two'] = measure(lambda args: args[0].two(args[1]), iterations,
+                             warmup, prepare_two)
+
+    def prepare_three():
+        sender, receiver, sender_one, receiver_one = _pair(params)
+        sender.two(receiver_one)
+        return sender, receiver.two(sender_one)
+
+    samples['three'] = measure(lambda args: args[0].three(args[1]),
+                               iterations, warmup, prepare_three)
+
+    # the message codecs, on the messages of a pairing
+    sender, receiver, sender_one, receiver_one = _pair(params)
+    sender_two = sender.two(receiver_one)
+    packed_one = sender.pack_one(sender_one)
+    packed_two = sender.pack_two(sender_two)
+    samples['pack_one'] = measure(lambda: sender.pack_one(sender_one),
+                                  iterations, warmup)
+    samples['unpack_one'] = measure(lambda: sender.unpack_one(packed_one),
+                                    iterations, warmup)
+    samples['pack_two'] = measure(lambda: sender.pack_two(sender_two),
+                                  iterations, warmup)
+    samples['unpack_two'] = measure(lambda: sender.unpack_two(packed_two),
+                                    iterations, warmup)
+
+    results = {}
+    for name, durations in samples.items():
+        results[name] = summarize(durations, keep_samples=True)
+    results['table_build'] = round(build * 1000, 3)
+    return results
+
+
+def bench_curve(curve, iterations=100, warmup=5):
+    """Returns the durations of the EC-JPAKE operations for curve."""
+    def scalar():
+        return random.randrange(1, curve.n)
+
+    def pair():
+        sender = ecjpake.ECJPAKE('secret', curve, signerid='sender')
+        receiver = ecjpake.ECJPAKE('secret', curve, signerid='receiver')
+        return sender, receiver, sender.one(), receiver.one()
+
+    samples = {}
+    start = timer()
+    curve.base_multiply(1)
+    build = timer() - start
+
+    samples['base_multiply'] = measure(curve.base_multiply, iterations,
+                                       warmup, scalar)
+    point = curve.base_multiply(scalar())
+    samples['multiply'] = measure(lambda k: curve.multiply(point, k),
+                                  iterations, warmup, scalar)
+
+    prover = ecjpake.ECJPAKE('secret', curve, signerid='prover')
+    verifier = ecjpake.ECJPAKE('secret', curve, signerid='verifier')
+    for suffix, generator in (('_g', curve.g), ('', point)):
+        def prepare_secret(generator=generator):
+            x = scalar()
+            return generator, x, curve.multiply(generator, x)
+
+        def prepare_zkp(generator=generator):
+            generator, x, gx = prepare_secret(generator)
+            return generator, gx, prover.createZKP(generator, x, gx)
+
+        samples['create_zkp' + suffix] = measure(
+            lambda args: prover.createZKP(*args), iterations, warmup,
+            prepare_secret)
+        samples['check_zkp' + suffix] = measure(
+            lambda args: verifier.checkZKP(*args), iterations, warmup,
+            prepare_zkp)
+
+    samples['one'] = measure(
+        lambda pake: pake.one(), iterations, warmup,
+        lambda: ecjpake.ECJPAKE('secret', curve, signerid='sender'))
+
+    def prepare_two():
+        sender, receiver, sender_one, receiver_one = pair()
+        return sender, receiver_one
+
+    samples['two'] = measure(lambda args: args[0].two(args[1]), iterations,
+                             warmup, prepare_two)
+
+    def prepare_three():
+        sender, receiver, sender_one, receiver_one = pair()
+        sender.two(receiver_one)
+        return sender, receiver.two(sender_one)
+
+    samples['three'] = measure(lambda args: args[0].three(args[1]),
+                               iterations, warmup, prepare_three)
+
+    results = {}
+    for name, durations in samples.items():
+        results[name] = summarize(durations, keep_samples=True)
+    results['table_build'] = round(build * 1000, 3)
+    return results
+
+
+def run(params=PARAMS, iterations=100, warmup=5, batch=50):
+    results = {}
+    for name in params:
+        if name in CURVES:
+            results['ec_%s' % name] = bench_curve(CURVES[name], iterations,
+                                                  warmup)
+        else:
+            results['params_%s' % name] = bench_params(
+                    getattr(jpake, 'params_%s' % name), iterations, warmup,
+                    batch)
+    return {'benchmark': 'crypto',
+            'config': {'params': list(params), 'iterations': iterations,
+                       'warmup': warmup, 'batch': batch,
+                       'bigint': jpake.backend.name},
+            'environment': environment(),
+            'results': results}
+
+
+def report(results, stream=None):
+    """Prints the throughput and latencies of each operation, and the
+    pairings a CPU can run, each pairing running both sides."""
+    if stream is None:
+        stream = sys.stdout
+    line = '%-12s %-18s %10s %10s %10s %10s %10s %10s\n'
+    stream.write(line % ('params', 'operation', 'ops/sec', 'mean', 'p50',
+                         'p90', 'p99', 'max'))
+    for name, operations in sorted(results['results'].items()):
+        for operation, summary in sorted(operations.items()):
+            if not isinstance(summary, dict):
+                continue
+            stream.write(line % (name, operation, summary['ops_per_sec'],
+                                 summary['mean'], summary['p50'],
+                                 summary['p90'], summary['p99'],
+                                 summary['max']))
+    stream.write('(durations in us)\n\n')
+    for name, operations in sorted(results['results'].items()):
+        # both sides run one(), two() and three()
+        pairing = 2 * sum([operations[step]['mean']
+                           for step in ('one', 'two', 'three')])
+        if pairing:
+            stream.write('%-12s %.1f pairings/sec per CPU\n' %
+                         (name, 1000000. / pairing))
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] [params ...]')
+    parser.add_option('-n', '--iterations', type='int', default=100,
+                      help='measured calls per operation')
+    parser.add_option('-w', '--warmup', type='int', default=5,
+                      help='calls done before the measure')
+    parser.add_option('-b', '--batch', type='int', default=50,
+                      help='number of proofs checked at once')
+    parser.add_option('--bigint', choices=list(jpake.BACKENDS),
+                      help='big-integer backend, by default the fastest '
+                           'one installed')
+    parser.add_option('-t', '--table', action='store_true', default=False,
+                      help='prints a table instead of the JSON results')
+    add_output_options(parser)
+    options, params = parser.parse_args(args)
+    for name in params:
+        if name not in PARAMS and name not in CURVES:
+            parser.error('Unknown params %r, use one of %s' %
+                         (name, ', '.join(PARAMS + tuple(CURVES))))
+
+    if options.bigint is not None:
+        try:
+            jpake.set_backend(options.bigint)
+        except ImportError:
+            parser.error('%s is not installed' % options.bigint)
+
+    results = run(params or PARAMS, options.iterations, options.warmup,
+                  options.batch)
+    if options.table:
+        report(results)
+    write_results(results, options, stdout=not options.table)
+
+
+if __name__ == '__main__':
+    main()
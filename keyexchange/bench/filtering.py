@@ -0,0 +1,336 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmarks of the IP filtering structures.
+
+memory fills each queue backend with distinct IPs in a child process, and
+reports the resident memory it took per IP:
+
+    $ bin/python -m keyexchange.bench.filtering memory -n 1000000
+
+append measures append() followed by count(), as done on each request,
+with a queue full of IPs:
+
+    $ bin/python -m keyexchange.bench.filtering append -n 100000
+
+zipf replays Zipf-distributed traffic from many IPs, as during an attack
+from a botnet, and reports how well each queue catches the IPs that go
+over the treshold, and how fast:
+
+    $ bin/python -m keyexchange.bench.filtering zipf -n 200 -t 1000
+
+contention checks the blacklist and counts the calls from 1 to 64 threads
+at once, with the queues and the blacklist split in 1 and 16 stripes:
+
+    $ bin/python -m keyexchange.bench.filtering contention -S 1,16
+"""
+import os
+import time
+import bisect
+import threading
+import socket
+import struct
+import random
+from optparse import OptionParser
+
+from keyexchange.bench import (summarize, measure, environment,
+                               add_output_options, write_results)
+from keyexchange.filtering.ipqueue import QUEUES, StripedQueue
+from keyexchange.filtering.blacklist import Blacklist
+
+
+def ip(number):
+    """Returns the IPv4 address of a number, in 10/8 and up."""
+    return socket.inet_ntoa(struct.pack('!I', 0x0a000000 + number))
+
+
+def _rss():
+    # current resident memory, in bytes
+    try:
+        statm = open('/proc/self/statm')
+    except IOError:
+        import resource
+        # the peak, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        statm.close()
+
+
+def _fill(kind, entries, conn):
+    # run in a child process, so each queue starts from the same heap
+    before = _rss()
+    start = time.time()
+    queue = QUEUES[kind](entries, ttl=3600)
+    for number in xrange(entries):
+        queue.append(ip(number))
+    duration = time.time() - start
+    conn.send((_rss() - before, duration, len(queue)))
+    conn.close()
+
+
+def memory(kinds=None, entries=1000000):
+    """Returns the memory taken by the queues filled with entries IPs."""
+    import multiprocessing
+
+    results = {}
+    for kind in kinds or sorted(QUEUES):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_fill,
+                                          args=(kind, entries, child))
+        process.start()
+        rss, duration, length = parent.recv()
+        process.join()
+        results[kind] = {'entries': length, 'rss_bytes': rss,
+                         'bytes_per_ip': round(float(rss) / entries, 1),
+                         'fill_seconds': round(duration, 3)}
+    return {'benchmark': 'filtering_memory',
+            'config': {'kinds': kinds or sorted(QUEUES),
+                       'entries': entries},
+            'environment': environment(),
+            'results': results}
+
+
+def bench_append(kind, size=200, iterations=100000, warmup=1000,
+                 distinct=None):
+    """Measures append() and count() on a full queue of size IPs. The IPs
+    are drawn uniformly from distinct ones, twice the size by default."""
+    if distinct is None:
+        distinct = 2 * size
+    queue = QUEUES[kind](size, ttl=3600)
+    for number in xrange(size):
+        queue.append(ip(number))
+    addresses = [ip(number) for number in xrange(distinct)]
+    rnd = random.Random(1)
+
+    def request(address):
+        queue.append(address)
+        queue.count(address)
+
+    return summarize(measure(request, iterations, warmup,
+                             lambda: rnd.choice(addresses)),
+                     keep_samples=True)
+
+
+def append(kinds=None, size=200, iterations=100000, warmup=1000):
+    results = {}
+    for kind in kinds or sorted(QUEUES):
+        results[kind] = bench_append(kind, size, iterations, warmup)
+    return {'benchmark': 'filtering_append',
+            'config': {'kinds': kinds or sorted(QUEUES), 'size': size,
+                       'iterations': iterations, 'warmup': warmup},
+            'environment': environment(),
+            'results': results}
+
+
+def zipf_traffic(requests, distinct, exponent=1.1, seed=1):
+    """Returns the IPs of requests calls, from distinct IPs. The IP of
+    rank k does a share of the calls proportional to 1 / k ** exponent."""
+    bounds = []
+    total = 0.
+    for rank in xrange(1, distinct + 1):
+        total += 1. / rank ** exponent
+        bounds.append(total)
+    addresses = [ip(number) for number in xrange(distinct)]
+    # the ranks are not in the order of the IPs
+    rnd = random.Random(seed)
+    rnd.shuffle(addresses)
+    draw = rnd.random
+    return [addresses[bisect.bisect(bounds, draw() * total)]
+            for i in xrange(requests)]
+
+
+def bench_zipf(kind, traffic, size=200, treshold=1000):
+    """Replays the traffic in a queue the way IPFiltering does, and
+    compares the IPs that reached the treshold with the ones that
+    actually made that many calls."""
+    queue = QUEUES[kind](size, ttl=3600)
+    caught = set()
+    start = time.time()
+    for address in traffic:
+        queue.append(address)
+        if queue.count(address) >= treshold:
+            caught.add(address)
+    duration = time.time() - start
+
+    calls = {}
+    for address in traffic:
+        calls[address] = calls.get(address, 0) + 1
+    expected = set([address for address, count in calls.items()
+                    if count >= treshold])
+    found = len(caught & expected)
+    return {'expected': len(expected), 'caught': len(caught),
+            'recall': round(float(found) / max(len(expected), 1), 4),
+            'precision': round(float(found) / max(len(caught), 1), 4),
+            'ops_per_sec': round(len(traffic) / duration, 2)}
+
+
+def zipf(kinds=None, size=200, treshold=1000, requests=1000000,
+         distinct=100000, exponent=1.1):
+    traffic = zipf_traffic(requests, distinct, exponent)
+    results = {}
+    for kind in kinds or sorted(QUEUES):
+        results[kind] = bench_zipf(kind, traffic, size, treshold)
+    return {'benchmark': 'filtering_zipf',
+            'config': {'kinds': kinds or sorted(QUEUES), 'size': size,
+                       'treshold': treshold, 'requests': requests,
+                       'distinct': distinct, 'exponent': exponent},
+            'environment': environment(),
+            'results': results}
+
+
+def bench_contention(threads, stripes=1, requests=100000, kind='lru',
+                     size=200, distinct=1000):
+    """Returns the calls per second when threads check the calls of
+    distinct IPs at once, like IPFiltering does. 1% of the IPs are
+    blacklisted."""
+    queue = QUEUES[kind]
+
+    def factory(size):
+        return queue(size, ttl=3600)
+
+    if stripes > 1:
+        queue = StripedQueue(factory, size, stripes)
+    else:
+        queue = factory(size)
+    blacklist = Blacklist(async=False, stripes=stripes)
+    addresses = [ip(number) for number in xrange(distinct)]
+    for address in addresses[::100]:
+        blacklist.add(address)
+
+    go = threading.Event()
+
+    def check(calls, seed):
+        rnd = random.Random(seed)
+        calls = [rnd.choice(addresses) for i in xrange(calls)]
+        go.wait()
+        for address in calls:
+            if address not in blacklist:
+                queue.append(address)
+                queue.count(address)
+
+    workers = [threading.Thread(target=check,
+                                args=(requests // threads, seed))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    # letting the workers draw their IPs
+    time.sleep(.1)
+    start = time.time()
+    go.set()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+    return {'seconds': round(duration, 3),
+            'ops_per_sec': round(requests // threads * threads / duration,
+                                 2)}
+
+
+def contention(kinds=None, stripes=(1, 16), threads=(1, 2, 4, 8, 16, 32, 64),
+               requests=100000, size=200):
+    results = {}
+    for kind in kinds or ['lru']:
+        results[kind] = res = {}
+        for count in stripes:
+            res[count] = dict([(workers,
+                                bench_contention(workers, count, requests,
+                                                 kind, size))
+                               for workers in threads])
+    return {'benchmark': 'filtering_contention',
+            'config': {'kinds': kinds or ['lru'], 'stripes': list(stripes),
+                       'threads': list(threads), 'requests': requests,
+                       'size': size},
+            'environment': environment(),
+            'results': results}
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog memory|append|zipf|contention '
+                                '[options]')
+    parser.add_option('-n', '--entries', type='int',
+                      help='IPs kept in the queue [1000000 for memory, '
+                           '200 for the others]')
+    parser.add_option('-q', '--queues', metavar='KINDS',
+                      help='comma-separated queue backends, among %s' %
+                           ', '.join(sorted(QUEUES)))
+    parser.add_option('-i', '--iterations', type='int', default=100000,
+                      help='measured calls of append')
+    parser.add_option('-r', '--requests', type='int',
+                      help='calls replayed [1000000 for zipf, 100000 for '
+                           'contention]')
+    parser.add_option('-d', '--distinct', type='int', default=100000,
+                      help='distinct IPs calling, for zipf')
+    parser.add_option('-e', '--exponent', type='float', default=1.1,
+                      help='exponent of the Zipf distribution')
+    parser.add_option('-t', '--treshold', type='int', default=1000,
+                      help='calls for an IP to be caught, for zipf')
+    parser.add_option('-S', '--stripes', default='1,16',
+                      help='comma-separated stripe counts, for contention')
+    parser.add_option('-T', '--threads', default='1,2,4,8,16,32,64',
+                      help='comma-separated thread counts, for contention')
+    add_output_options(parser)
+    options, args = parser.parse_args(args)
+
+    commands = ('memory', 'append', 'zipf', 'contention')
+    if len(args) != 1 or args[0] not in commands:
+        parser.error('Unknown command')
+    kinds = None
+    if options.queues is not None:
+        kinds = options.queues.split(',')
+        for kind in kinds:
+            if kind not in QUEUES:
+                parser.error('Unknown queue %r' % kind)
+
+    if args[0] == 'memory':
+        results = memory(kinds, options.entries or 1000000)
+    elif args[0] == 'append':
+        results = append(kinds, options.entries or 200, options.iterations)
+    elif args[0] == 'zipf':
+        results = zipf(kinds, options.entries or 200, options.treshold,
+                       options.requests or 1000000, options.distinct,
+                       options.exponent)
+    else:
+        stripes = [int(count) for count in options.stripes.split(',')]
+        threads = [int(count) for count in options.threads.split(',')]
+        results = contention(kinds, stripes, threads,
+                             options.requests or 100000,
+                             options.entries or 200)
+    write_results(results, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1098 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Load generator simulating concurrent J-PAKE pairings against a server.
+
+Python 2 has no asyncio, so the pairings are generator-based coroutines
+run by a small select() loop. A coroutine yields what it waits for:
+
+- Wait(sock, 'r' or 'w', timeout): the socket is readable or writable.
+- Sleep(seconds)
+- Park(waiters): the task is suspended until someone resumes it.
+- another generator: it's run, and what it returns is sent back.
+- Return(value): returns value to the calling generator.
+
+The HTTP requests go through pools of keep-alive HTTP/1.1 connections.
+
+    $ bin/python -m keyexchange.bench.loadgen -u http://localhost:5000 \\
+          -n 1000 -c 200
+
+By default the load is closed: a pairing starts when another one is over,
+so a slow server also slows the clients down and its tail latency is
+hidden. With --arrival fixed or poisson the pairings start at --rate per
+second whatever happens, and their latency is also measured from the time
+they should have started: it's corrected for the coordinated omission.
+
+--sweep runs the open-loop load at increasing rates, until the p99 explodes
+or the server can't keep up with the rate:
+
+    $ bin/python -m keyexchange.bench.loadgen --sweep 5,10,20,40,80
+
+The J-PAKE math runs in the loop, so a process uses one CPU at most: the
+client side can become the bottleneck before the server does. --processes
+shards the pairings over several processes, each one running its own loop,
+and merges their results:
+
+    $ bin/python -m keyexchange.bench.loadgen -n 10000 -c 800 --processes 4
+"""
+import sys
+import time
+import json
+import socket
+import errno
+import select
+import heapq
+import hashlib
+import random
+import urlparse
+import traceback
+from types import GeneratorType
+from optparse import OptionParser
+
+from keyexchange.bench import (summarize, environment, add_output_options,
+                             write_results)
+from keyexchange.tests import client as jpake
+
+
+# Linux only
+_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
+
+
+class Wait(object):
+    def __init__(self, sock, mode, timeout=None):
+        self.sock = sock
+        self.mode = mode
+        self.timeout = timeout
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Park(object):
+    def __init__(self, waiters):
+        self.waiters = waiters
+
+
+class Return(object):
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Timeout(Exception):
+    pass
+
+
+class Task(object):
+    """A coroutine run by the loop, and the generators it called."""
+    def __init__(self, gen, callback=None):
+        self.stack = [gen]
+        self.callback = callback
+        self.result = self.error = None
+        self.done = False
+        # identifies the current wait, so a stale timer is ignored
+        self.wait_id = 0
+
+
+class Loop(object):
+    """Runs tasks until they are all done."""
+    def __init__(self):
+        self.time = time.time
+        self._ready = []
+        self._timers = []
+        self._readers = {}
+        self._writers = {}
+        self._seq = 0
+        self.tasks = 0
+
+    def spawn(self, gen, callback=None):
+        """Starts a task. callback is called with it once it's done."""
+        task = Task(gen, callback)
+        self.tasks += 1
+        self._ready.append((task, None, None))
+        return task
+
+    def resume(self, task, value=None):
+        """Resumes a parked task."""
+        self._ready.append((task, value, None))
+
+    def _call_later(self, delay, task, value=None, exc=None, wait_id=None):
+        self._seq += 1
+        heapq.heappush(self._timers, (self.time() + delay, self._seq, task,
+                                      value, exc, wait_id))
+
+    def _finish(self, task, result=None, error=None):
+        task.done = True
+        task.result = result
+        task.error = error
+        self.tasks -= 1
+        if task.callback is not None:
+            task.callback(task)
+
+    def _step(self, task, value, exc):
+        gen = task.stack[-1]
+        try:
+            if exc is not None:
+                yielded = gen.throw(*exc)
+            else:
+                yielded = gen.send(value)
+        except StopIteration:
+            task.stack.pop()
+            if task.stack:
+                self._ready.append((task, None, None))
+            else:
+                self._finish(task)
+            return
+        except Exception:
+            task.stack.pop()
+            if task.stack:
+                self._ready.append((task, None, sys.exc_info()))
+            else:
+                self._finish(task, error=sys.exc_info()[1])
+            return
+
+        if isinstance(yielded, GeneratorType):
+            task.stack.append(yielded)
+            self._ready.append((task, None, None))
+        elif isinstance(yielded, Return):
+            task.stack.pop().close()
+            if task.stack:
+                self._ready.append((task, yielded.value, None))
+            else:
+                self._finish(task, yielded.value)
+        elif isinstance(yielded, Wait):
+            task.wait_id += 1
+            if yielded.mode == 'r':
+                self._readers[yielded.sock] = task
+            else:
+                self._writers[yielded.sock] = task
+            if yielded.timeout is not None:
+                exc = (Timeout, Timeout('timed out'), None)
+                self._call_later(yielded.timeout, task, exc=exc,
+                                 wait_id=task.wait_id)
+        elif isinstance(yielded, Sleep):
+            self._call_later(yielded.seconds, task)
+        elif isinstance(yielded, Park):
+            yielded.waiters.append(task)
+        else:
+            exc = TypeError('Cannot wait for %r' % (yielded,))
+            self._ready.append((task, None, (TypeError, exc, None)))
+
+    def _cancel_wait(self, task):
+        for fds in (self._readers, self._writers):
+            for sock, waiting in fds.items():
+                if waiting is task:
+                    del fds[sock]
+
+    def _select(self, timeout):
+        if not hasattr(select, 'poll'):
+            readable, writable, _ = select.select(self._readers.keys(),
+                                                  self._writers.keys(),
+                                                  [], timeout)
+            return readable, writable
+
+        # select() is limited to 1024 file descriptors
+        poll = select.poll()
+        socks = {}
+        for sock in self._readers:
+            socks[sock.fileno()] = sock
+            poll.register(sock, select.POLLIN)
+        for sock in self._writers:
+            socks[sock.fileno()] = sock
+            poll.register(sock, select.POLLOUT)
+        if timeout is not None:
+            timeout = timeout * 1000
+        readable, writable = [], []
+        for fd, event in poll.poll(timeout):
+            sock = socks[fd]
+            if sock in self._readers:
+                readable.append(sock)
+            else:
+                writable.append(sock)
+        return readable, writable
+
+    def run(self):
+        """Runs the tasks until they are all done."""
+        while self.tasks > 0:
+            ready, self._ready = self._ready, []
+            for task, value, exc in ready:
+                self._step(task, value, exc)
+            if self.tasks == 0:
+                break
+
+            if self._ready:
+                timeout = 0
+            elif self._timers:
+                timeout = max(self._timers[0][0] - self.time(), 0)
+            else:
+                timeout = None
+
+            if self._readers or self._writers:
+                readable, writable = self._select(timeout)
+                for sock in readable:
+                    task = self._readers.pop(sock)
+                    task.wait_id += 1
+                    self._ready.append((task, None, None))
+                for sock in writable:
+                    task = self._writers.pop(sock)
+                    task.wait_id += 1
+                    self._ready.append((task, None, None))
+            elif timeout:
+                time.sleep(timeout)
+            elif timeout is None and self.tasks > 0 and not self._ready:
+                raise RuntimeError('%d tasks are stuck' % self.tasks)
+
+            now = self.time()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, task, value, exc, wait_id = heapq.heappop(self._timers)
+                if wait_id is not None:
+                    if wait_id != task.wait_id:
+                        continue    # the wait is over already
+                    self._cancel_wait(task)
+                    task.wait_id += 1
+                self._ready.append((task, value, exc))
+
+
+class HTTPError(Exception):
+    """Raised when the server returns an unexpected status."""
+    def __init__(self, status):
+        Exception.__init__(self, 'HTTP %d' % status)
+        self.status = status
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Connection(object):
+    """A keep-alive HTTP/1.1 connection, used by one task at a time."""
+    def __init__(self, host, port, timeout=30.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._buffer = ''
+        self.requests = 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._buffer = ''
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        res = sock.connect_ex((self.host, self.port))
+        if res not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(res, errno.errorcode.get(res, str(res)))
+        try:
+            yield Wait(sock, 'w', self.timeout)
+        except Timeout:
+            sock.close()
+            raise
+        res = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if res != 0:
+            sock.close()
+            raise socket.error(res, errno.errorcode.get(res, str(res)))
+        self.sock = sock
+        self._buffer = ''
+
+    def _send(self, data):
+        while data:
+            yield Wait(self.sock, 'w', self.timeout)
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            data = data[sent:]
+
+    def _recv(self):
+        while True:
+            yield Wait(self.sock, 'r', self.timeout)
+            try:
+                data = self.sock.recv(65536)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            if _QUICKACK is not None:
+                # servers writing the headers and the body separately
+                # would otherwise wait for our delayed ACK
+                self.sock.setsockopt(socket.IPPROTO_TCP, _QUICKACK, 1)
+            yield Return(data)
+
+    def _read_response(self, method):
+        while '\r\n\r\n' not in self._buffer:
+            data = yield self._recv()
+            if not data:
+                raise ProtocolError('Connection closed by the server')
+            self._buffer += data
+
+        head, self._buffer = self._buffer.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        try:
+            version, status = lines[0].split(' ', 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise ProtocolError('Bad status line %r' % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', 'identity') != 'identity':
+            raise ProtocolError('Unsupported transfer encoding')
+
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            length = 0
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+        else:
+            length = None   # until the connection is closed
+
+        while length is None or len(self._buffer) < length:
+            data = yield self._recv()
+            if not data:
+                if length is None:
+                    break
+                raise ProtocolError('Connection closed by the server')
+            self._buffer += data
+
+        if length is None:
+            body, self._buffer = self._buffer, ''
+            keep_alive = False
+        else:
+            body, self._buffer = (self._buffer[:length],
+                                  self._buffer[length:])
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.0':
+                keep_alive = connection == 'keep-alive'
+            else:
+                keep_alive = connection != 'close'
+
+        if not keep_alive:
+            self.close()
+        yield Return((status, headers, body))
+
+    def request(self, method, path, headers=None, body=''):
+        """Sends a request, returns the status, headers and body.
+
+        A request on a kept-alive connection the server closed in the
+        meantime is sent again on a new one.
+        """
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s:%d' % (self.host, self.port),
+                 'Content-Length: %d' % len(body)]
+        if headers is not None:
+            for name, value in headers.items():
+                lines.append('%s: %s' % (name, value))
+        data = '\r\n'.join(lines) + '\r\n\r\n' + body
+
+        reused = self.sock is not None
+        if not reused:
+            yield self._connect()
+        try:
+            yield self._send(data)
+            res = yield self._read_response(method)
+        except (socket.error, ProtocolError):
+            self.close()
+            if not reused:
+                raise
+            yield self._connect()
+            yield self._send(data)
+            res = yield self._read_response(method)
+        except Timeout:
+            self.close()
+            raise
+        self.requests += 1
+        yield Return(res)
+
+
+class Pool(object):
+    """Keep-alive connections to a server.
+
+    - size: maximum number of connections. When they're all used, the
+      tasks wait for one to be released.
+    """
+    def __init__(self, loop, host, port, size=100, timeout=30.):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._waiters = []
+        self.connections = 0
+
+    def acquire(self):
+        if self._idle:
+            yield Return(self._idle.pop())
+        if self.connections < self.size:
+            self.connections += 1
+            yield Return(Connection(self.host, self.port, self.timeout))
+        conn = yield Park(self._waiters)
+        yield Return(conn)
+
+    def release(self, conn):
+        if self._waiters:
+            self.loop.resume(self._waiters.pop(0), conn)
+        else:
+            self._idle.append(conn)
+
+    def request(self, method, path, headers=None, body=''):
+        conn = yield self.acquire()
+        try:
+            res = yield conn.request(method, path, headers, body)
+        finally:
+            self.release(conn)
+        yield Return(res)
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle = []
+
+
+def _str(data):
+    # the JPAKE class wants str, not unicode
+    if isinstance(data, unicode):
+        return str(data)
+    if isinstance(data, dict):
+        return dict([(str(key), _str(value))
+                     for key, value in data.items()])
+    return data
+
+
+class Results(object):
+    """Latencies per step, errors per class and completed pairings.
+
+    With an open-loop arrival, the pairing latencies are also measured
+    from the time each pairing was supposed to start, in corrected. The
+    time a pairing started late is in lags.
+    """
+    def __init__(self):
+        self.steps = {}
+        self.pairings = []
+        self.corrected = []
+        self.lags = []
+        self.errors = {}
+        self.requests = 0
+
+    def record(self, step, duration):
+        self.steps.setdefault(step, []).append(duration)
+
+    def error(self, error):
+        if isinstance(error, HTTPError):
+            name = 'http_%d' % error.status
+        elif isinstance(error, Timeout):
+            name = 'timeout'
+        elif isinstance(error, socket.error):
+            name = 'socket'
+        elif isinstance(error, ProtocolError):
+            name = 'protocol'
+        elif isinstance(error, jpake.JPAKEError):
+            name = 'jpake'
+        else:
+            name = error.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Pairing(object):
+    """A sender and a receiver exchanging data through a channel.
+
+    Both poll the channel every poll seconds, with the ETag of their last
+    PUT, as the browsers do, and give up after timeout seconds.
+
+    intended is the time the pairing should have started at, when the
+    pairings arrive at a given rate.
+
+    round_one is an optional RoundOnePool the J-PAKE round-one material is
+    drawn from.
+    """
+    def __init__(self, loop, pool, results, params, poll=.05, timeout=30.,
+                 root='', intended=None, round_one=None):
+        self.loop = loop
+        self.pool = pool
+        self.results = results
+        self.params = params
+        self.poll = poll
+        self.timeout = timeout
+        self.root = root
+        self.intended = intended
+        self.round_one = round_one
+        self.aborted = False
+        self._sender_waiters = []
+
+    def _request(self, step, client_id, method, path, headers=None,
+                 body='', expected=(200,)):
+        if headers is None:
+            headers = {}
+        headers['X-KeyExchange-Id'] = client_id
+        if body:
+            headers['Content-Type'] = 'application/json'
+        start = self.loop.time()
+        status, headers, body = yield self.pool.request(method,
+                                                        self.root + path,
+                                                        headers, body)
+        self.results.requests += 1
+        if status not in expected:
+            raise HTTPError(status)
+        self.results.record(step, self.loop.time() - start)
+        yield Return((status, headers, body))
+
+    def _put(self, client_id, url, data):
+        res = yield self._request('put', client_id, 'PUT', url,
+                                  body=json.dumps(data))
+        yield Return(res[1]['etag'])
+
+    def _wait(self, client_id, url, etag=None):
+        """Polls the channel until it contains new data."""
+        deadline = self.loop.time() + self.timeout
+        while True:
+            if self.aborted:
+                raise ProtocolError('The other side failed')
+            if self.loop.time() > deadline:
+                raise Timeout('No data in the channel')
+            if etag is not None:
+                headers = {'If-None-Match': etag}
+            else:
+                headers = {}
+            status, headers, body = yield self._request('get', client_id,
+                                                        'GET', url, headers,
+                                                        expected=(200, 304))
+            if status == 200 and body != '{}':
+                yield Return(_str(json.loads(body)))
+            if status == 200:
+                # the channel is still empty
+                etag = headers.get('etag')
+            yield Sleep(self.poll)
+
+    def _client_id(self):
+        return hashlib.sha256(str(random.random())).hexdigest() * 4
+
+    def run(self):
+        try:
+            yield self._run()
+        except Exception:
+            # stops the receiver
+            self.aborted = True
+            raise
+
+    def _run(self):
+        start = self.loop.time()
+        if self.intended is not None:
+            self.results.lags.append(max(start - self.intended, 0))
+        sender_id = self._client_id()
+        pake = jpake.JPAKE('secret', params=self.params, signerid='sender',
+                           pool=self.round_one)
+
+        res = yield self._request('new_channel', sender_id, 'GET',
+                                  '/new_channel')
+        url = '/' + str(json.loads(res[2]))
+
+        step = self.loop.time()
+        etag = yield self._put(sender_id, url, pake.one())
+
+        # the receiver joins once the code is displayed
+        receiver = self.loop.spawn(self.receiver(url))
+
+        other_one = yield self._wait(sender_id, url, etag)
+        self.results.record('step_one', self.loop.time() - step)
+
+        step = self.loop.time()
+        etag = yield self._put(sender_id, url, pake.two(other_one))
+        other_two = yield self._wait(sender_id, url, etag)
+        key = pake.three(other_two)
+        self.results.record('step_two', self.loop.time() - step)
+
+        yield self._put(sender_id, url, {'data': 'secret'})
+
+        # the pairing is over when the receiver got the data
+        if not receiver.done:
+            yield Park(self._sender_waiters)
+        if receiver.error is not None:
+            raise receiver.error
+        if receiver.result != key:
+            raise jpake.JPAKEError('The keys differ')
+        end = self.loop.time()
+        self.results.pairings.append(end - start)
+        if self.intended is not None:
+            self.results.corrected.append(end - self.intended)
+
+    def receiver(self, url):
+        receiver_id = self._client_id()
+        pake = jpake.JPAKE('secret', params=self.params,
+                           signerid='receiver', pool=self.round_one)
+        try:
+            other_one = yield self._wait(receiver_id, url)
+            etag = yield self._put(receiver_id, url, pake.one())
+            other_two = yield self._wait(receiver_id, url, etag)
+            etag = yield self._put(receiver_id, url, pake.two(other_one))
+            key = pake.three(other_two)
+            yield self._wait(receiver_id, url, etag)
+        finally:
+            for task in self._sender_waiters:
+                self.loop.resume(task)
+            self._sender_waiters = []
+        yield Return(key)
+
+    def start(self, callback=None):
+        return self.loop.spawn(self.run(), callback)
+
+
+def _arrivals(loop, count, rate, arrival, start_pairing):
+    """Starts count pairings at the given rate, whatever happens to them.
+
+    When the loop is late, the pairings due are started right away, with
+    their intended start time.
+    """
+    intended = loop.time()
+    for i in range(count):
+        delay = intended - loop.time()
+        if delay > 0:
+            yield Sleep(delay)
+        start_pairing(intended)
+        if arrival == 'poisson':
+            intended += random.expovariate(rate)
+        else:
+            intended += 1. / rate
+
+
+def run(url, pairings=100, concurrency=10, connections=100, poll=.05,
+        timeout=30., params='80', arrival='closed', rate=None,
+        precompute=0, precompute_processes=1, processes=1, ready=None):
+    """Runs the pairings against the server and returns the results.
+
+    - pairings: total number of pairings.
+    - concurrency: number of pairings running at the same time, when
+      arrival is 'closed'.
+    - connections: size of the connection pool.
+    - poll: delay in seconds between two polls of a client.
+    - timeout: timeout in seconds of a socket operation.
+    - arrival: 'closed' starts a pairing when another one is over. 'fixed'
+      and 'poisson' start rate pairings per second, at fixed intervals or
+      as a Poisson process, even when the server falls behind.
+    - precompute: when non zero, the J-PAKE round-one material is computed
+      ahead by precompute_processes processes, and up to precompute states
+      are kept. The pool is filled before the load starts, so the client
+      crypto doesn't delay the requests.
+    - processes: number of processes the load is sharded over. The
+      pairings, concurrency, connections, rate and precompute size are
+      split between them.
+    - ready: optional callable, called when the load is about to start.
+    """
+    if arrival not in ('closed', 'fixed', 'poisson'):
+        raise ValueError('Unknown arrival %r' % arrival)
+    if arrival != 'closed' and not rate:
+        raise ValueError('The %s arrival needs a rate' % arrival)
+    if processes > 1:
+        return _run_sharded(processes, url=url, pairings=pairings,
+                            concurrency=concurrency, connections=connections,
+                            poll=poll, timeout=timeout, params=params,
+                            arrival=arrival, rate=rate, precompute=precompute,
+                            precompute_processes=precompute_processes)
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme != 'http':
+        raise ValueError('Only http is supported')
+    host = parsed.hostname
+    port = parsed.port or 80
+    root = parsed.path.rstrip('/')
+    loop = Loop()
+    pool = Pool(loop, host, port, connections, timeout)
+    results = Results()
+    params_ = getattr(jpake, 'params_%s' % params)
+    state = {'started': 0}
+    round_one = None
+    if precompute:
+        round_one = _start_round_one(params_, precompute,
+                                     precompute_processes, pairings)
+
+    def pairing_done(task):
+        if task.error is not None:
+            results.error(task.error)
+
+    def start_pairing(intended=None, callback=pairing_done):
+        state['started'] += 1
+        pairing = Pairing(loop, pool, results, params_, poll, timeout, root,
+                          intended, round_one)
+        pairing.start(callback)
+
+    def start_next(task=None):
+        if task is not None:
+            pairing_done(task)
+        if state['started'] < pairings:
+            start_pairing(callback=start_next)
+
+    if ready is not None:
+        ready()
+    start = time.time()
+    if arrival == 'closed':
+        for i in range(min(concurrency, pairings)):
+            start_next()
+    else:
+        loop.spawn(_arrivals(loop, pairings, rate, arrival, start_pairing))
+    loop.run()
+    duration = time.time() - start
+    pool.close()
+    if round_one is not None:
+        round_one.join()
+
+    def _summary(samples):
+        return summarize(samples, unit='ms', keep_samples=True)
+
+    steps = {}
+    for step, samples in results.steps.items():
+        steps[step] = _summary(samples)
+    completed = len(results.pairings)
+    res = {'pairing': _summary(results.pairings),
+           'steps': steps,
+           'completed': completed,
+           'errors': results.errors,
+           'requests': results.requests,
+           'connections': pool.connections,
+           'duration': round(duration, 3),
+           'pairings_per_sec': round(completed / duration, 2),
+           'requests_per_sec': round(results.requests / duration, 2)}
+    if arrival != 'closed':
+        res['pairing_corrected'] = _summary(results.corrected)
+        res['lag'] = _summary(results.lags)
+    if round_one is not None:
+        res['round_one'] = round_one.stats()
+    return {'benchmark': 'loadgen',
+            'config': {'url': url, 'pairings': pairings,
+                       'concurrency': concurrency,
+                       'connections': connections, 'poll': poll,
+                       'timeout': timeout, 'params': params,
+                       'arrival': arrival, 'rate': rate,
+                       'precompute': precompute,
+                       'precompute_processes': precompute_processes,
+                       'processes': processes},
+            'environment': environment(),
+            'results': res}
+
+
+def _split(value, count):
+    # count integers adding up to value
+    return [value // count + (index < value % count)
+            for index in range(count)]
+
+
+def _shard(queue, start, index, options):
+    # runs a shard of the load, in a child process
+    def ready():
+        queue.put((index, 'ready', None))
+        start.wait()
+
+    try:
+        result = run(ready=ready, **options)
+    except Exception:
+        queue.put((index, 'error', traceback.format_exc()))
+    else:
+        queue.put((index, 'done', result))
+
+
+def _next_message(queue, children, pending, timeout=.25):
+    # returns the next message of the shards. A pending shard that died
+    # without posting it gets an error message instead.
+    from Queue import Empty
+    while True:
+        try:
+            return queue.get(timeout=timeout)
+        except Empty:
+            pass
+        for index in sorted(pending):
+            child = children[index]
+            if child.is_alive():
+                continue
+            # its last message may still be in the pipe
+            try:
+                return queue.get(timeout=.1)
+            except Empty:
+                return (index, 'error', 'Shard %d died with exit code %s'
+                        % (index, child.exitcode))
+
+
+def _run_sharded(processes, **options):
+    import multiprocessing
+
+    pairings = options['pairings']
+    processes = max(min(processes, pairings), 1)
+    shards = []
+    for index, (pairings, concurrency, connections) in enumerate(zip(
+            _split(pairings, processes),
+            _split(options['concurrency'], processes),
+            _split(options['connections'], processes))):
+        shard = dict(options)
+        shard['pairings'] = pairings
+        shard['concurrency'] = max(concurrency, 1)
+        shard['connections'] = max(connections, 1)
+        if options['rate']:
+            shard['rate'] = float(options['rate']) / processes
+        if options['precompute']:
+            shard['precompute'] = max(options['precompute'] // processes, 1)
+        shards.append(shard)
+
+    queue = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    children = [multiprocessing.Process(target=_shard,
+                                        args=(queue, start, index, shard))
+                for index, shard in enumerate(shards)]
+    # not daemonic, so they can run their own RoundOnePool processes
+    for child in children:
+        child.start()
+
+    # the shards start together, once all are ready
+    results = [None] * processes
+    errors = []
+    ready = set()
+    pending = set(range(processes))
+    try:
+        while pending:
+            index, status, value = _next_message(queue, children, pending)
+            pending.discard(index)
+            if status == 'ready':
+                ready.add(index)
+            else:
+                errors.append(value)
+        start.set()
+        pending = ready
+        while pending:
+            index, status, value = _next_message(queue, children, pending)
+            pending.discard(index)
+            if status == 'done':
+                results[index] = value
+            else:
+                errors.append(value)
+    finally:
+        start.set()
+        for child in children:
+            child.join()
+    if errors:
+        raise RuntimeError('A shard failed:\n%s' % errors[0])
+
+    merged = merge(results)
+    merged['config'] = dict(options)
+    merged['config']['processes'] = processes
+    return merged
+
+
+def _merge_summaries(summaries):
+    # the samples are kept by run(), in ms
+    samples = []
+    for summary in summaries:
+        samples.extend([sample / 1000. for sample in summary['samples']])
+    return summarize(samples, unit='ms', keep_samples=True)
+
+
+def merge(results):
+    """Merges the results of runs that loaded the server at the same time.
+
+    The latency distributions are rebuilt from the samples, the counters
+    are added up and the rates are computed on the longest run.
+    """
+    shards = [result['results'] for result in results]
+    duration = max([shard['duration'] for shard in shards])
+    completed = sum([shard['completed'] for shard in shards])
+    requests = sum([shard['requests'] for shard in shards])
+    errors = {}
+    steps = {}
+    for shard in shards:
+        for name, count in shard['errors'].items():
+            errors[name] = errors.get(name, 0) + count
+        for step, summary in shard['steps'].items():
+            steps.setdefault(step, []).append(summary)
+    for step, summaries in steps.items():
+        steps[step] = _merge_summaries(summaries)
+    res = {'pairing': _merge_summaries([shard['pairing']
+                                        for shard in shards]),
+           'steps': steps,
+           'completed': completed,
+           'errors': errors,
+           'requests': requests,
+           'connections': sum([shard['connections'] for shard in shards]),
+           'duration': duration,
+           'pairings_per_sec': round(completed / duration, 2),
+           'requests_per_sec': round(requests / duration, 2),
+           'shards': [{'completed': shard['completed'],
+                       'requests': shard['requests'],
+                       'duration': shard['duration']} for shard in shards]}
+    for key in ('pairing_corrected', 'lag'):
+        if key in shards[0]:
+            res[key] = _merge_summaries([shard[key] for shard in shards])
+    if 'round_one' in shards[0]:
+        round_one = {}
+        for shard in shards:
+            for name, value in shard['round_one'].items():
+                round_one[name] = round_one.get(name, 0) + value
+        res['round_one'] = round_one
+    return {'benchmark': results[0]['benchmark'],
+            'config': results[0]['config'],
+            'environment': results[0]['environment'],
+            'results': res}
+
+
+def _start_round_one(params, size, processes, pairings, wait=60.):
+    # each pairing uses two states
+    round_one = jpake.RoundOnePool(params, size, processes)
+    round_one.start()
+    needed = min(size, 2 * pairings)
+    deadline = time.time() + wait
+    while (round_one.stats()['available'] < needed and
+           time.time() < deadline):
+        time.sleep(.05)
+    return round_one
+
+
+def find_knee(steps, factor=3., max_errors=.01, min_rate=.9):
+    """Returns the first rate the server can't sustain, or None.
+
+    A rate is not sustained when the corrected p99 of the pairings is
+    factor times the one of the lowest rate, when more than max_errors of
+    the pairings failed, or when less than min_rate of the offered rate
+    was achieved.
+    """
+    if not steps:
+        return None
+    baseline = steps[0]['results']['pairing_corrected']['p99']
+    for step in steps:
+        rate = step['config']['rate']
+        res = step['results']
+        errors = sum(res['errors'].values())
+        offered = step['config']['pairings']
+        if (res['pairing_corrected']['p99'] > factor * baseline or
+            errors > max_errors * offered or
+            res['pairings_per_sec'] < min_rate * rate):
+            return rate
+    return None
+
+
+def sweep(url, rates, duration=10., arrival='poisson', factor=3.,
+          **options):
+    """Runs an open-loop load at each rate, for duration seconds.
+
+    Stops after the first rate the server can't sustain (see find_knee)
+    and returns the results of each rate, and that rate.
+    """
+    steps = []
+    knee = None
+    for rate in sorted(rates):
+        pairings = max(int(rate * duration), 1)
+        steps.append(run(url, pairings, arrival=arrival, rate=rate,
+                         **options))
+        knee = find_knee(steps, factor)
+        if knee is not None:
+            break
+    return {'benchmark': 'loadgen_sweep',
+            'config': {'url': url, 'rates': sorted(rates),
+                       'duration': duration, 'arrival': arrival,
+                       'factor': factor},
+            'environment': environment(),
+            'results': {'knee': knee,
+                        'steps': steps}}
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-u', '--url', default='http://localhost:5000',
+                      help='root URL of the server')
+    parser.add_option('-n', '--pairings', type='int', default=100,
+                      help='total number of pairings')
+    parser.add_option('-c', '--concurrency', type='int', default=10,
+                      help='pairings running at the same time')
+    parser.add_option('--connections', type='int', default=100,
+                      help='size of the connection pool')
+    parser.add_option('--poll', type='float', default=.05,
+                      help='delay between two polls, in seconds')
+    parser.add_option('--timeout', type='float', default=30.,
+                      help='timeout of the socket operations, in seconds')
+    parser.add_option('--params', choices=['80', '112', '128'],
+                      default='80', help='J-PAKE parameters')
+    parser.add_option('-a', '--arrival', default='closed',
+                      choices=['closed', 'fixed', 'poisson'],
+                      help='closed, or open-loop fixed or poisson arrivals')
+    parser.add_option('-r', '--rate', type='float',
+                      help='pairings started per second, in open loop')
+    parser.add_option('--sweep', metavar='RATES',
+                      help='comma-separated rates: finds the rate where the '
+                           'p99 explodes')
+    parser.add_option('--duration', type='float', default=10.,
+                      help='duration of each rate of the sweep, in seconds')
+    parser.add_option('--factor', type='float', default=3.,
+                      help='p99 increase marking the knee of the sweep')
+    parser.add_option('--precompute', type='int', default=0, metavar='SIZE',
+                      help='keeps SIZE J-PAKE round-one states computed '
+                           'ahead, 0 to compute them inline')
+    parser.add_option('--precompute-processes', type='int', default=1,
+                      help='processes computing the round-one states')
+    parser.add_option('-p', '--processes', type='int', default=1,
+                      help='processes the pairings are sharded over')
+    add_output_options(parser)
+    options, args = parser.parse_args(args)
+
+    if options.sweep is not None:
+        try:
+            rates = [float(rate) for rate in options.sweep.split(',')]
+        except ValueError:
+            parser.error('Invalid rates: %s' % options.sweep)
+        if options.arrival == 'closed':
+            options.arrival = 'poisson'
+        results = sweep(options.url, rates, options.duration,
+                        options.arrival, options.factor,
+                        connections=options.connections, poll=options.poll,
+                        timeout=options.timeout, params=options.params,
+                        precompute=options.precompute,
+                        precompute_processes=options.precompute_processes,
+                        processes=options.processes)
+    else:
+        if options.arrival != 'closed' and options.rate is None:
+            parser.error('--rate is needed with the %s arrival' %
+                         options.arrival)
+        results = run(options.url, options.pairings, options.concurrency,
+                      options.connections, options.poll, options.timeout,
+                      options.params, options.arrival, options.rate,
+                      options.precompute, options.precompute_processes,
+                      options.processes)
+    write_results(results, options)
+
+
+if __name__ == '__main__':
+    main()
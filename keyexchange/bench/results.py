@@ -0,0 +1,423 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Keeps the benchmark results and compares them.
+
+save() writes results in a directory, tagged with the git revision and the
+time of the run. The environment, which contains the machine fingerprint,
+and the config are already part of the results.
+
+    $ bin/python -m keyexchange.bench.app --save
+    ... some changes ...
+    $ bin/python -m keyexchange.bench.app --save
+    $ bin/python -m keyexchange.bench.results compare
+
+compare() flags the regressions between two runs: a lower throughput, a
+higher p99 or more memcache calls per request. The p99 varies more from
+one run to the other, so it has its own threshold. When both runs kept their
+samples, a throughput change only counts if a Mann-Whitney U test finds
+the two distributions are different, and a p99 change if a bootstrap of
+the p99 finds it is not noise. The Mann-Whitney test looks at the whole
+distribution, so it misses a tail that moves on its own.
+"""
+import os
+import sys
+import math
+import json
+import random
+import time
+import subprocess
+from optparse import OptionParser
+
+
+def git_revision(path=None):
+    """Returns the current git revision, and whether the tree is dirty.
+
+    The revision is None when git or the repository is not there.
+    """
+    if path is None:
+        path = os.path.dirname(__file__)
+
+    def _git(*args):
+        try:
+            process = subprocess.Popen(('git',) + args, cwd=path,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        out = process.communicate()[0]
+        if process.returncode != 0:
+            return None
+        return out.strip()
+
+    revision = _git('rev-parse', 'HEAD')
+    if revision is None:
+        return None, False
+    return revision, _git('status', '--porcelain', '-uno') != ''
+
+
+def save(results, directory='benchresults'):
+    """Writes results in directory and returns the path of the file."""
+    revision, dirty = git_revision()
+    results = dict(results)
+    results['revision'] = {'id': revision, 'dirty': dirty}
+    results['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    name = '%s-%s-%s' % (results.get('benchmark', 'bench'),
+                         time.strftime('%Y%m%d-%H%M%S'),
+                         (revision or 'norev')[:8])
+    if dirty:
+        name += '-dirty'
+    path = os.path.join(directory, name + '.json')
+    index = 1
+    while os.path.exists(path):
+        index += 1
+        path = os.path.join(directory, '%s-%d.json' % (name, index))
+
+    stream = open(path, 'w')
+    try:
+        json.dump(results, stream, sort_keys=True, indent=2)
+    finally:
+        stream.close()
+    return path
+
+
+def load(path):
+    stream = open(path)
+    try:
+        return json.load(stream)
+    finally:
+        stream.close()
+
+
+def runs(directory='benchresults', benchmark=None):
+    """Returns the paths of the results kept, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            results = load(path)
+        except ValueError:
+            continue
+        if benchmark is not None and results.get('benchmark') != benchmark:
+            continue
+        # runs saved in the same second are sorted by their file date
+        found.append((results.get('time', ''), os.path.getmtime(path),
+                      path))
+    found.sort()
+    return [path for time_, mtime, path in found]
+
+
+def _erfc(x):
+    # Numerical Recipes' erfcc, with a fractional error below 1.2e-7.
+    # math.erfc is not there before Python 2.7
+    z = abs(x)
+    t = 1. / (1. + .5 * z)
+    r = t * math.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        .37409196 + t * (.09678418 + t * (-.18628806 + t * (.27886807 +
+        t * (-1.13520398 + t * (1.48851587 + t * (-.82215223 +
+        t * .17087277)))))))))
+    if x >= 0:
+        return r
+    return 2. - r
+
+
+def mann_whitney(first, second):
+    """Runs a two-sided Mann-Whitney U test on two samples.
+
+    Returns U for the first sample and the p-value, computed with the
+    normal approximation, corrected for the ties. It's accurate when both
+    samples have more than about 20 values.
+    """
+    n1 = len(first)
+    n2 = len(second)
+    if n1 == 0 or n2 == 0:
+        raise ValueError('Empty sample')
+    values = [(value, 0) for value in first] + [(value, 1)
+                                                for value in second]
+    values.sort()
+
+    # ranks, with the average rank for the ties
+    rank_sum = 0.
+    ties = 0.
+    i = 0
+    total = len(values)
+    while i < total:
+        j = i
+        while j + 1 < total and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2. + 1
+        count = j - i + 1
+        if count > 1:
+            ties += count ** 3 - count
+        for k in range(i, j + 1):
+            if values[k][1] == 0:
+                rank_sum += rank
+        i = j + 1
+
+    u = rank_sum - n1 * (n1 + 1) / 2.
+    mean = n1 * n2 / 2.
+    variance = n1 * n2 / 12. * ((total + 1) - ties / (total * (total - 1)
+                                                      or 1))
+    if variance <= 0:
+        return u, 1.
+    # continuity correction
+    delta = abs(u - mean) - .5
+    if delta < 0:
+        delta = 0.
+    z = delta / math.sqrt(variance)
+    return u, min(_erfc(z / math.sqrt(2)), 1.)
+
+
+def bootstrap_percentile(first, second, pct=99, resamples=2000, seed=0):
+    """Runs a two-sided bootstrap test on a percentile of two samples.
+
+    Returns the p-value: twice the share of the resampled differences of
+    the percentile that are on the other side of zero. The percentile of
+    a resample is drawn without building it: the rank-th smallest of n
+    uniform draws follows a Beta(rank, n - rank + 1) law.
+    """
+    if not first or not second:
+        raise ValueError('Empty sample')
+    rand = random.Random(seed)
+
+    def _draw(samples):
+        # the nearest rank, as in percentile()
+        count = len(samples)
+        rank = min(max(int(count * pct / 100. + 0.5), 1), count)
+        index = int(count * rand.betavariate(rank, count - rank + 1))
+        return samples[min(index, count - 1)]
+
+    first = sorted(first)
+    second = sorted(second)
+    below = above = 0
+    for i in xrange(resamples):
+        diff = _draw(second) - _draw(first)
+        if diff <= 0:
+            below += 1
+        if diff >= 0:
+            above += 1
+    return min(2. * min(below, above) / resamples, 1.)
+
+
+def _summaries(old, new, path=()):
+    """Yields the paths and values found in both results."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        if 'p99' in old and 'count' in old and 'p99' in new:
+            yield path, old, new
+            return
+        for key in sorted(old):
+            if key in new and key not in ('config', 'environment',
+                                          'revision', 'samples'):
+                for item in _summaries(old[key], new[key], path + (key,)):
+                    yield item
+    elif isinstance(old, list) and isinstance(new, list):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            for item in _summaries(old_item, new_item, path + (index,)):
+                yield item
+    elif (isinstance(old, (int, float)) and isinstance(new, (int, float))
+          and path and path[-1] in _THROUGHPUTS):
+        yield path, old, new
+
+
+# top-level rates compared as throughputs
+_THROUGHPUTS = ('pairings_per_sec', 'requests_per_sec')
+
+
+def _change(old, new):
+    if old == 0:
+        if new == 0:
+            return 0.
+        return float('inf')
+    return (new - old) / float(old)
+
+
+def compare(old, new, threshold=.1, p99_threshold=.25, alpha=.01):
+    """Compares two results. Returns the warnings and the metrics.
+
+    Each metric is a dict with its path, name, old and new values, the
+    relative change, the p-value when the samples are there, and its
+    status: 'regression', 'improvement' or 'same'. The p-value is the
+    Mann-Whitney one for the throughput, and the bootstrap one for the
+    p99.
+
+    - threshold: minimum relative change of the throughput.
+    - p99_threshold: minimum relative change of the p99.
+    - alpha: maximum p-value of a significant change.
+    """
+    warnings = []
+    if old.get('benchmark') != new.get('benchmark'):
+        warnings.append('The benchmarks differ: %s and %s' %
+                        (old.get('benchmark'), new.get('benchmark')))
+    old_env = old.get('environment', {})
+    new_env = new.get('environment', {})
+    if old_env.get('fingerprint') != new_env.get('fingerprint'):
+        warnings.append('The runs were not done on the same machine or '
+                        'Python')
+    old_config = old.get('config', {})
+    new_config = new.get('config', {})
+    for key in sorted(set(old_config.keys() + new_config.keys())):
+        if old_config.get(key) != new_config.get(key):
+            warnings.append('The config differs on %s: %s and %s' %
+                            (key, old_config.get(key), new_config.get(key)))
+
+    metrics = []
+
+    def _metric(path, name, old_value, new_value, worse, pvalue=None,
+                threshold=threshold):
+        change = _change(old_value, new_value)
+        significant = pvalue is None or pvalue < alpha
+        if significant and abs(change) > threshold:
+            if (change > 0) == worse:
+                status = 'regression'
+            else:
+                status = 'improvement'
+        else:
+            status = 'same'
+        metrics.append({'path': '.'.join([str(part) for part in path]),
+                        'name': name, 'old': old_value, 'new': new_value,
+                        'change': change, 'pvalue': pvalue,
+                        'status': status})
+
+    for path, old_value, new_value in _summaries(old.get('results', {}),
+                                                 new.get('results', {})):
+        if not isinstance(old_value, dict):
+            _metric(path[:-1], path[-1], old_value, new_value, worse=False)
+            continue
+
+        pvalue = p99_pvalue = None
+        old_samples = old_value.get('samples')
+        new_samples = new_value.get('samples')
+        if old_samples and new_samples:
+            pvalue = mann_whitney(old_samples, new_samples)[1]
+            p99_pvalue = bootstrap_percentile(old_samples, new_samples)
+        _metric(path, 'ops_per_sec', old_value['ops_per_sec'],
+                new_value['ops_per_sec'], worse=False, pvalue=pvalue)
+        _metric(path, 'p99', old_value['p99'], new_value['p99'],
+                worse=True, pvalue=p99_pvalue, threshold=p99_threshold)
+        if 'cache_calls' in old_value and 'cache_calls' in new_value:
+            # the calls don't vary from one run to the other
+            _metric(path, 'cache_calls', old_value['cache_calls'],
+                    new_value['cache_calls'], worse=True, threshold=0)
+
+    return warnings, metrics
+
+
+def report(warnings, metrics, stream=None, verbose=False):
+    """Prints the comparison. Only the changes, unless verbose is True."""
+    if stream is None:
+        stream = sys.stdout
+    for warning in warnings:
+        stream.write('WARNING: %s\n' % warning)
+    stream.write('%-30s %-12s %12s %12s %8s %8s  %s\n' %
+                 ('path', 'metric', 'old', 'new', 'change', 'p', 'status'))
+    for metric in metrics:
+        if not verbose and metric['status'] == 'same':
+            continue
+        if metric['pvalue'] is None:
+            pvalue = '-'
+        else:
+            pvalue = '%.4f' % metric['pvalue']
+        stream.write('%-30s %-12s %12.3f %12.3f %+7.1f%% %8s  %s\n' %
+                     (metric['path'], metric['name'], metric['old'],
+                      metric['new'], metric['change'] * 100, pvalue,
+                      metric['status'].upper()))
+    regressions = len([metric for metric in metrics
+                       if metric['status'] == 'regression'])
+    stream.write('%d regression(s), %d metric(s) compared\n' %
+                 (regressions, len(metrics)))
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog list\n       %prog compare [OLD NEW]')
+    parser.add_option('--results-dir', default='benchresults',
+                      help='the results directory [%default]')
+    parser.add_option('-b', '--benchmark', default='app',
+                      help='without OLD and NEW, compares the last two '
+                           'runs of this benchmark [%default]')
+    parser.add_option('-t', '--threshold', type='float', default=.1,
+                      help='minimum relative change of the throughput '
+                           '[%default]')
+    parser.add_option('--p99-threshold', type='float', default=.25,
+                      help='minimum relative change of the p99 [%default]')
+    parser.add_option('-a', '--alpha', type='float', default=.01,
+                      help='maximum p-value of a significant change '
+                           '[%default]')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      default=False, help='shows all the metrics')
+    options, args = parser.parse_args(args)
+
+    if not args or args[0] not in ('list', 'compare'):
+        parser.error('Unknown command')
+
+    if args[0] == 'list':
+        for path in runs(options.results_dir):
+            results = load(path)
+            revision = results.get('revision', {})
+            print '%s  %-14s %s%s  %s' % (results.get('time'),
+                    results.get('benchmark'), (revision.get('id') or '')[:8],
+                    revision.get('dirty') and '+' or ' ', path)
+        return 0
+
+    if len(args) == 3:
+        old, new = args[1:]
+    elif len(args) == 1:
+        paths = runs(options.results_dir, options.benchmark)
+        if len(paths) < 2:
+            parser.error('Less than two %s runs in %s' %
+                         (options.benchmark, options.results_dir))
+        old, new = paths[-2:]
+    else:
+        parser.error('compare takes two results, or none')
+
+    print 'Comparing %s to %s' % (old, new)
+    warnings, metrics = compare(load(old), load(new), options.threshold,
+                                options.p99_threshold, options.alpha)
+    report(warnings, metrics, verbose=options.verbose)
+    for metric in metrics:
+        if metric['status'] == 'regression':
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
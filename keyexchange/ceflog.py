@@ -0,0 +1,274 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Asynchronous CEF logging and aggregation.
+
+log_cef() writes each record synchronously, which blocks the worker on the
+syslog or file I/O. AsyncCEFLogger pushes the records in a bounded queue
+instead, and a background thread drains it by batches.
+
+Under attack the same event is emitted for every request. CEFAggregator
+logs the first one and then summarizes the others periodically, from the
+AsyncCEFLogger thread.
+"""
+import time
+import threading
+from Queue import Queue, Full, Empty
+
+from cef import log_cef
+
+from keyexchange.util import stop_at_exit
+
+# environ keys used by log_cef to build a record
+_ENVIRON_KEYS = ('HTTP_X_FORWARDED_FOR', 'REMOTE_ADDR', 'REQUEST_METHOD',
+                 'PATH_INFO', 'HTTP_HOST', 'HTTP_USER_AGENT')
+
+# signatures an attacker can trigger at will
+AGGREGATED_SIGNATURES = ('Invalid X-KeyExchange-Id',
+                         'Unknown X-KeyExchange-Id', 'Report',
+                         'BlackListed IP')
+
+
+def _copy_environ(environ):
+    # the environ is not kept: it's likely to change once the
+    # request is over
+    return dict([(key, environ[key]) for key in _ENVIRON_KEYS
+                 if key in environ])
+
+
+def _get_source_ip(environ):
+    if 'HTTP_X_FORWARDED_FOR' in environ:
+        return environ['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
+    return environ.get('REMOTE_ADDR')
+
+
+class AsyncCEFLogger(threading.Thread):
+    """Logs CEF records from a background thread.
+
+    - maxsize: maximum number of records waiting in the queue.
+    - batch_size: maximum number of records written per wake-up.
+    - overflow: what to do when the queue is full. 'drop' discards the
+      record and counts it, 'block' waits until there's some room.
+    - interval: maximum time in seconds the writer waits for records.
+    - log: the function used to write a record, defaults to log_cef.
+    - periodic: optional callable run by the writer after each wake-up.
+
+    The record date is set when it's written, so it can lag a bit behind
+    the event under heavy load.
+    """
+    def __init__(self, maxsize=10000, batch_size=100, overflow='drop',
+                 interval=1., log=None, periodic=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if overflow not in ('drop', 'block'):
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.interval = interval
+        if log is None:
+            log = log_cef
+        self._log = log
+        self.periodic = periodic
+        self._queue = Queue(maxsize)
+        self._lock = threading.Lock()
+        self.dropped = self.written = self.errors = 0
+        self.running = False
+
+    def log_cef(self, name, severity, environ, config, *args, **kw):
+        """Queues a record. Takes the same arguments than log_cef."""
+        record = name, severity, _copy_environ(environ), config, args, kw
+
+        if threading.current_thread() is self:
+            # logged from the periodic callable, queuing it
+            # could block the writer on its own queue.
+            self._write([record])
+        elif self.overflow == 'block':
+            self._queue.put(record)
+        else:
+            try:
+                self._queue.put_nowait(record)
+            except Full:
+                self._incr('dropped')
+
+    def _incr(self, counter, value=1):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + value)
+        finally:
+            self._lock.release()
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.interval)]
+        except Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        written = 0
+        for name, severity, environ, config, args, kw in batch:
+            try:
+                self._log(name, severity, environ, config, *args, **kw)
+                written += 1
+            except Exception, e:
+                # we don't want the writer to die
+                from keyexchange import logger
+                logger.error('Could not write a CEF record: %s' % str(e))
+                self._incr('errors')
+        self._incr('written', written)
+
+    def start(self):
+        # set before the thread runs, so an early join() stops it
+        self.running = True
+        threading.Thread.start(self)
+        # the records still queued are written before the exit
+        stop_at_exit(self)
+
+    def run(self):
+        while self.running or not self._queue.empty():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            if self.periodic is not None:
+                try:
+                    self.periodic()
+                except Exception, e:
+                    from keyexchange import logger
+                    logger.error(str(e))
+
+    def stats(self):
+        """Returns the queue metrics."""
+        return {'queued': self._queue.qsize(), 'maxsize': self.maxsize,
+                'dropped': self.dropped, 'written': self.written,
+                'errors': self.errors}
+
+    def join(self):
+        """Stops the writer once all queued records are written."""
+        if not self.running:
+            return
+        self.running = False
+        threading.Thread.join(self)
+
+
+class CEFAggregator(object):
+    """Aggregates the CEF events emitted for a same signature and IP.
+
+    - log: the function used to write a record, defaults to log_cef.
+    - window: time in seconds during which events are aggregated.
+    - signatures: the signatures to aggregate. Other events are logged
+      as usual.
+    - max_keys: maximum number of (signature, IP) tracked. When reached,
+      the events of the other ones are logged as usual until the window
+      is closed.
+
+    The first event of a window for a given (signature, IP) is logged right
+    away. The next ones are only counted, and when the window is closed a
+    summary event is logged: it's the last event received, with the number
+    of events of the window, the first one included, in the CEF "cnt"
+    extension.
+
+    The windows are closed by tick(), which is meant to be called
+    periodically by the AsyncCEFLogger thread, so the requests never write
+    the summaries and the last window is closed even if no other event
+    comes in.
+    """
+    def __init__(self, log=None, window=60, signatures=AGGREGATED_SIGNATURES,
+                 max_keys=10000):
+        if log is None:
+            log = log_cef
+        self._log = log
+        self.window = window
+        self.signatures = signatures
+        self.max_keys = max_keys
+        self._events = {}
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+
+    def log_cef(self, name, severity, environ, config, *args, **kw):
+        """Logs or counts an event. Takes the same arguments than log_cef."""
+        signature = kw.get('signature')
+        if signature is None:
+            signature = name
+        if signature not in self.signatures:
+            self._log(name, severity, environ, config, *args, **kw)
+            return
+
+        key = signature, _get_source_ip(environ)
+        self._lock.acquire()
+        try:
+            event = self._events.get(key)
+            if event is not None:
+                # keeping the last event for the summary
+                event[0] += 1
+                event[1] = (name, severity, _copy_environ(environ), config,
+                            args, kw)
+            elif len(self._events) < self.max_keys:
+                self._events[key] = [1, None]
+        finally:
+            self._lock.release()
+
+        if event is None:
+            self._log(name, severity, environ, config, *args, **kw)
+
+    def tick(self):
+        """Closes the window if it's over, or if max_keys is reached."""
+        if (time.time() - self._window_start >= self.window or
+            len(self._events) >= self.max_keys):
+            self.flush()
+
+    def flush(self):
+        """Closes the window and logs the summaries."""
+        self._lock.acquire()
+        try:
+            events = self._events
+            self._events = {}
+            self._window_start = time.time()
+        finally:
+            self._lock.release()
+
+        for count, event in events.values():
+            if count == 1:
+                continue
+            name, severity, environ, config, args, kw = event
+            kw = dict(kw)
+            kw['cnt'] = count
+            self._log(name, severity, environ, config, *args, **kw)
@@ -48,6 +48,7 @@ For the bad request counter, the same technique is used.
 Blacklisted IPs are kept in memory with a TTL.
 """
 import time
+import zlib
 import threading
 
 
@@ -88,13 +89,26 @@ class Blacklist(object):
 
     IPs are saved/loaded from Memcached so several apps can share the
     blacklist.
+
+    The IPs are spread over several stripes, so threads checking
+    different IPs don't wait for each other. Each stripe has its own lock,
+    IP set and TTLs, and an IP always goes to the same stripe, picked with
+    its CRC-32 like in StripedQueue. Looking up an IP that is not
+    blacklisted takes no lock.
+
+    The IPs found in Memcached are merged in their stripe. The IPs removed
+    here are remembered until the next save, so an older copy of the list
+    doesn't bring them back.
     """
-    def __init__(self, cache_server=None, frequency=5, async=True):
-        self._ttls = {}
+    def __init__(self, cache_server=None, frequency=5, async=True,
+                 stripes=1):
         self._cache_server = cache_server
-        self.ips = set()
         self._dirty = False
-        self._lock = threading.RLock()
+        self.stripes = stripes
+        self._locks = [threading.RLock() for i in range(stripes)]
+        self._ips = [set() for i in range(stripes)]
+        self._ttls = [{} for i in range(stripes)]
+        self._removed = [set() for i in range(stripes)]
         self.async = async
         if self.async:
             self._syncer = _Syncer(self, frequency=frequency)
@@ -103,15 +117,40 @@ class Blacklist(object):
 
     def __getstate__(self):
         odict = self.__dict__.copy()
-        del odict['_lock']
+        del odict['_locks']
         if self.async:
             del odict['_syncer']
         return odict
 
     def __setstate__(self, state):
+        state = dict(state)
+        ips = state.pop('ips', None)
         self.__dict__.update(state)
-        if self.async:
-            self._lock = threading.RLock()
+        # pickled without stripes
+        self.stripes = state.get('stripes', 1)
+        self._locks = [threading.RLock() for i in range(self.stripes)]
+        if '_removed' not in state:
+            self._removed = [set() for i in range(self.stripes)]
+        if ips is not None:
+            # pickled with a single IP set and TTL dict
+            ttls = self._ttls
+            self._ips = [set() for i in range(self.stripes)]
+            self._ttls = [{} for i in range(self.stripes)]
+            for ip in ips:
+                index = self._index(ip)
+                self._ips[index].add(ip)
+                self._ttls[index][ip] = ttls.get(ip)
+
+    def _index(self, elmt):
+        return (zlib.crc32(elmt) & 0xffffffff) % self.stripes
+
+    def _acquire_all(self):
+        for lock in self._locks:
+            lock.acquire()
+
+    def _release_all(self):
+        for lock in reversed(self._locks):
+            lock.release()
 
     def _get_dirty(self):
         # hiding it behind a property since
@@ -120,80 +159,133 @@ class Blacklist(object):
 
     outsynced = property(_get_dirty)
 
+    def _get_ips(self):
+        # a copy, merged from the stripes
+        ips = set()
+        for stripe in self._ips:
+            ips.update(stripe)
+        return ips
+
+    ips = property(_get_ips)
+
     def update(self):
         """Loads the IP list from memcached."""
         if self._cache_server is None:
             return
-        self._lock.acquire()
+        self._acquire_all()
         try:
             self._update()
         finally:
-            self._lock.release()
+            self._release_all()
 
     def _update(self):
         data = self._cache_server.get('keyexchange:blacklist')
         # merging the memcached values
         if data is not None:
             ips, ttls = data
-            # get new blacklisted IP
-            if not self.ips.issuperset(ips):
-                self.ips.union(ips)
-                self._ttls.update(ttls)
+            for ip in ips:
+                index = self._index(ip)
+                if ip in self._removed[index]:
+                    continue
+                ttl = ttls.get(ip)
+                if ip in self._ips[index]:
+                    # the longest blacklisting wins
+                    current = self._ttls[index][ip]
+                    if current is None or ttl is None:
+                        ttl = None
+                    else:
+                        ttl = max(current, ttl)
+                else:
+                    self._ips[index].add(ip)
+                self._ttls[index][ip] = ttl
 
     def save(self):
         """Save the IP into memcached if needed."""
         if self._cache_server is None or not self._dirty:
             return
 
-        self._lock.acquire()
+        self._acquire_all()
         try:
             # XXX will use CAS/GETS once pylibmc 1.1.2 is released
             self._update()
-            data = self.ips, self._ttls
+            ttls = {}
+            for stripe in self._ttls:
+                ttls.update(stripe)
+            data = self.ips, ttls
             if not self._cache_server.set('keyexchange:blacklist', data):
                 from keyexchange.filtering import logger
                 logger.error('Could not update the backlist')
+            else:
+                for removed in self._removed:
+                    removed.clear()
             self._dirty = False
         finally:
-            self._lock.release()
+            self._release_all()
 
     def add(self, elmt, ttl=None):
-        self._lock.acquire()
+        index = self._index(elmt)
+        lock = self._locks[index]
+        lock.acquire()
         try:
-            self.ips.add(elmt)
+            self._ips[index].add(elmt)
+            self._removed[index].discard(elmt)
             if ttl is not None:
-                self._ttls[elmt] = time.time() + ttl
+                self._ttls[index][elmt] = time.time() + ttl
             else:
-                self._ttls[elmt] = None
+                self._ttls[index][elmt] = None
             self._dirty = True
         finally:
-            self._lock.release()
+            lock.release()
 
     def remove(self, elmt):
-        self._lock.acquire()
+        index = self._index(elmt)
+        lock = self._locks[index]
+        lock.acquire()
         try:
-            self.ips.remove(elmt)
-            del self._ttls[elmt]
+            self._ips[index].remove(elmt)
+            del self._ttls[index][elmt]
+            self._removed[index].add(elmt)
             self._dirty = True
         finally:
-            self._lock.release()
+            lock.release()
 
     def __contains__(self, elmt):
-        self._lock.acquire()
+        # set lookups are atomic, the lock is only needed to expire the IP
+        index = self._index(elmt)
+        ips = self._ips[index]
+        if elmt not in ips:
+            return False
+        lock = self._locks[index]
+        lock.acquire()
         try:
-            found = elmt in self.ips
+            found = elmt in ips
             if found:
-                ttl = self._ttls[elmt]
+                ttl = self._ttls[index][elmt]
                 if ttl is None:
                     return True
-                if self._ttls[elmt] - time.time() <= 0:
+                if ttl - time.time() <= 0:
                     # this will not provocate a deadlock
                     # since we use a Re-entrant lock.
                     self.remove(elmt)
                     return False
             return found
         finally:
-            self._lock.release()
+            lock.release()
 
     def __len__(self):
-        return len(self.ips)
+        return sum([len(stripe) for stripe in self._ips])
+
+    def snapshot(self):
+        """Returns the expiration time of each blacklisted IP, or None if
+        it does not expire, at a given time."""
+        self._acquire_all()
+        try:
+            now = time.time()
+            res = {}
+            for ttls in self._ttls:
+                for ip, ttl in ttls.items():
+                    if ttl is None or ttl > now:
+                        res[ip] = ttl
+            return res
+        finally:
+            self._release_all()
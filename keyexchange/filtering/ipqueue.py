@@ -33,9 +33,15 @@
 # the terms of any one of the MPL, the GPL or the LGPL.
 #
 # ***** END LICENSE BLOCK *****
-from collections import deque
 import threading
 import time
+import socket
+import zlib
+from array import array
+from hashlib import md5
+
+# fields of the nodes of the linked list
+_PREV, _NEXT, _IP, _COUNT, _UPDATED = range(5)
 
 
 class IPQueue(object):
@@ -51,80 +57,647 @@ class IPQueue(object):
 
     Elements that are too old gets discarded, so this works also
     for low traffic applications.
+
+    The queue is a doubly-linked list indexed by a dict, so all these
+    operations are O(1). The right end is always the least recently updated
+    IP: each append() discards the old ones from there.
     """
     def __init__(self, maxlen=200, ttl=360):
-        self._ips = deque()
-        self._counter = dict()
-        self._last_update = dict()
         self._maxlen = maxlen
         self._ttl = float(ttl)
         self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        # the root is the sentinel of the circular list, its next node is
+        # the left end of the queue
+        self._root = root = [None, None, None, 0, 0.]
+        root[_PREV] = root[_NEXT] = root
+        self._nodes = {}
+
+    def __getstate__(self):
+        # the linked list is too deep to be pickled as is
+        self._lock.acquire()
+        try:
+            ips = [tuple(node[_IP:]) for node in self._iter_nodes()]
+        finally:
+            self._lock.release()
+        return {'maxlen': self._maxlen, 'ttl': self._ttl, 'ips': ips}
+
+    def __setstate__(self, state):
+        if '_ips' in state:
+            # pickled by the deque-based queue
+            ips = [(ip, state['_counter'][ip], state['_last_update'][ip])
+                   for ip in state['_ips']]
+            state = {'maxlen': state['_maxlen'], 'ttl': state['_ttl'],
+                     'ips': ips}
+        self.__init__(state['maxlen'], state['ttl'])
+        for ip, count, updated in reversed(state['ips']):
+            self._link(ip, count, updated)
+
+    def _iter_nodes(self):
+        # from left to right
+        root = self._root
+        node = root[_NEXT]
+        while node is not root:
+            yield node
+            node = node[_NEXT]
+
+    def _link(self, ip, count, updated):
+        # adds the IP at the left end
+        root = self._root
+        first = root[_NEXT]
+        node = [root, first, ip, count, updated]
+        first[_PREV] = root[_NEXT] = node
+        self._nodes[ip] = node
+
+    def _unlink(self, ip):
+        node = self._nodes.pop(ip)
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+        return node
+
+    def _discard_old_ips(self, now):
+        # from right to left, until an IP is recent enough
+        root = self._root
+        last = root[_PREV]
+        while last is not root and now - last[_UPDATED] > self._ttl:
+            self._unlink(last[_IP])
+            last = root[_PREV]
+
+    def append(self, ip):
+        """Adds the IP and raise the counter accordingly."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(now)
+            if ip in self._nodes:
+                count = self._unlink(ip)[_COUNT] + 1
+            else:
+                count = 1
+            self._link(ip, count, now)
+
+            if len(self._nodes) > self._maxlen:
+                self._unlink(self._root[_PREV][_IP])
+        finally:
+            self._lock.release()
+
+    def _get(self, ip):
+        # returns the node of a recent enough IP, under the lock
+        node = self._nodes.get(ip)
+        if node is not None and time.time() - node[_UPDATED] > self._ttl:
+            self._unlink(ip)
+            return None
+        return node
+
+    def count(self, ip):
+        """Returns the IP count."""
+        self._lock.acquire()
+        try:
+            node = self._get(ip)
+            if node is None:
+                return 0
+            return node[_COUNT]
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns the count of each IP, at a given time."""
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(time.time())
+            return dict([(node[_IP], node[_COUNT])
+                         for node in self._iter_nodes()])
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(time.time())
+            return len(self._nodes)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, ip):
+        self._lock.acquire()
+        try:
+            return self._get(ip) is not None
+        finally:
+            self._lock.release()
+
+    def remove(self, ip):
+        self._lock.acquire()
+        try:
+            try:
+                self._unlink(ip)
+            except KeyError:
+                raise ValueError('%r is not in the queue' % ip)
+        finally:
+            self._lock.release()
+
+
+_V4_PREFIX = '\x00' * 10 + '\xff\xff'
+_inet_pton = getattr(socket, 'inet_pton', None)
+_inet_ntop = getattr(socket, 'inet_ntop', None)
+
+
+def pack_ip(ip):
+    """Returns the 16 bytes of an IPv6 address, or of an IPv4 address mapped
+    in IPv6. Other strings get their MD5 digest."""
+    try:
+        return _V4_PREFIX + socket.inet_aton(ip)
+    except socket.error:
+        pass
+    if ':' in ip and _inet_pton is not None:
+        try:
+            return _inet_pton(socket.AF_INET6, ip)
+        except (socket.error, ValueError):
+            pass
+    return md5(ip).digest()
+
+
+def unpack_ip(key):
+    """Returns the IP packed by pack_ip. The strings that were hashed come
+    back as IPv6 addresses."""
+    if key.startswith(_V4_PREFIX):
+        return socket.inet_ntoa(key[12:])
+    if _inet_ntop is not None:
+        return _inet_ntop(socket.AF_INET6, key)
+    return key.encode('hex')
+
+
+def _hash(key):
+    # the str hash of keys that only differ by their last bytes mostly
+    # differ in a few low bits, which makes long clusters when probing
+    # linearly. Mixing it like MurmurHash3 does spreads them.
+    h = hash(key) & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    return h ^ (h >> 16)
+
+
+class CompactIPQueue(object):
+    """IPQueue with a fixed capacity, kept in preallocated arrays.
+
+    Has the same API than IPQueue, but an IP costs about 50 bytes instead
+    of several Python objects:
+
+    - the packed IPs (see pack_ip) are in a bytearray, their counters,
+      update times and list links in arrays, all indexed by slot.
+    - the slots form a circular doubly-linked list ordered like IPQueue,
+      the last slot being its sentinel. Unused slots are in a free stack.
+    - an open-addressed hash table with linear probing maps the packed IPs
+      to their slots. It has 2 to 4 buckets per slot, and entries are
+      shifted back on deletion, so there are no tombstones.
+
+    This is slower than IPQueue, since the IPs are packed and looked up
+    from Python code: it's meant for big queues.
+    """
+    def __init__(self, maxlen=200, ttl=360):
+        self._maxlen = maxlen
+        self._ttl = float(ttl)
+        self._lock = threading.RLock()
+        self._keys = bytearray(16 * maxlen)
+        self._counts = array('I', [0]) * maxlen
+        self._updated = array('d', [0.]) * maxlen
+        # the sentinel is the slot maxlen
+        self._prev = array('i', [maxlen]) * (maxlen + 1)
+        self._next = array('i', [maxlen]) * (maxlen + 1)
+        self._free = array('i', xrange(maxlen - 1, -1, -1))
+        buckets = 8
+        while buckets < 2 * maxlen:
+            buckets *= 2
+        self._mask = buckets - 1
+        self._index = array('i', [-1]) * buckets
+        self._size = 0
 
     def __getstate__(self):
         odict = self.__dict__.copy()
         del odict['_lock']
+        # the str hash can change from a process to another
+        del odict['_index']
         return odict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._index = array('i', [-1]) * (self._mask + 1)
+        root = self._maxlen
+        slot = self._next[root]
+        while slot != root:
+            key = str(self._keys[slot << 4:(slot + 1) << 4])
+            self._index[self._find(key)[1]] = slot
+            slot = self._next[slot]
+
+    def _find(self, key):
+        # returns the slot of the key, or -1, and its bucket
+        keys = self._keys
+        index = self._index
+        mask = self._mask
+        bucket = _hash(key) & mask
+        while True:
+            slot = index[bucket]
+            if slot == -1 or keys[slot << 4:(slot + 1) << 4] == key:
+                return slot, bucket
+            bucket = (bucket + 1) & mask
+
+    def _unindex(self, hole):
+        # empties a bucket, and moves back the next entries of its cluster
+        # that would not be found anymore
+        keys = self._keys
+        index = self._index
+        mask = self._mask
+        index[hole] = -1
+        bucket = (hole + 1) & mask
+        slot = index[bucket]
+        while slot != -1:
+            home = _hash(str(keys[slot << 4:(slot + 1) << 4])) & mask
+            if (bucket - home) & mask >= (bucket - hole) & mask:
+                index[hole] = slot
+                index[bucket] = -1
+                hole = bucket
+            bucket = (bucket + 1) & mask
+            slot = index[bucket]
+
+    def _link(self, slot):
+        # at the left end
+        root = self._maxlen
+        first = self._next[root]
+        self._prev[slot] = root
+        self._next[slot] = first
+        self._prev[first] = slot
+        self._next[root] = slot
+
+    def _unlink(self, slot):
+        prev = self._prev[slot]
+        next = self._next[slot]
+        self._next[prev] = next
+        self._prev[next] = prev
+
+    def _remove(self, slot, bucket):
+        self._unlink(slot)
+        self._unindex(bucket)
+        self._free.append(slot)
+        self._size -= 1
+
+    def _evict(self, slot):
+        key = str(self._keys[slot << 4:(slot + 1) << 4])
+        self._remove(slot, self._find(key)[1])
+
+    def _discard_old_ips(self, now):
+        # from right to left, until an IP is recent enough
+        prev = self._prev
+        updated = self._updated
+        root = self._maxlen
+        last = prev[root]
+        while last != root and now - updated[last] > self._ttl:
+            self._evict(last)
+            last = prev[root]
 
     def append(self, ip):
         """Adds the IP and raise the counter accordingly."""
+        key = pack_ip(ip)
+        now = time.time()
         self._lock.acquire()
         try:
-            if ip not in self._ips:
-                self._ips.appendleft(ip)
-                self._counter[ip] = 1
+            self._discard_old_ips(now)
+            slot, bucket = self._find(key)
+            if slot != -1:
+                self._counts[slot] += 1
+                self._unlink(slot)
             else:
-                self._ips.remove(ip)
-                self._ips.appendleft(ip)
-                self._counter[ip] += 1
+                if not self._free:
+                    self._evict(self._prev[self._maxlen])
+                    bucket = self._find(key)[1]
+                slot = self._free.pop()
+                self._keys[slot << 4:(slot + 1) << 4] = key
+                self._counts[slot] = 1
+                self._index[bucket] = slot
+                self._size += 1
+            self._updated[slot] = now
+            self._link(slot)
+        finally:
+            self._lock.release()
+
+    def count(self, ip):
+        """Returns the IP count."""
+        key = pack_ip(ip)
+        self._lock.acquire()
+        try:
+            slot, bucket = self._find(key)
+            if slot == -1:
+                return 0
+            if time.time() - self._updated[slot] > self._ttl:
+                self._remove(slot, bucket)
+                return 0
+            return self._counts[slot]
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns the count of each IP, at a given time. The IPs are
+        unpacked with unpack_ip."""
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(time.time())
+            res = {}
+            root = self._maxlen
+            slot = self._next[root]
+            while slot != root:
+                key = str(self._keys[slot << 4:(slot + 1) << 4])
+                res[unpack_ip(key)] = self._counts[slot]
+                slot = self._next[slot]
+            return res
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(time.time())
+            return self._size
+        finally:
+            self._lock.release()
+
+    def __contains__(self, ip):
+        return self.count(ip) > 0
+
+    def remove(self, ip):
+        self._lock.acquire()
+        try:
+            slot, bucket = self._find(pack_ip(ip))
+            if slot == -1:
+                raise ValueError('%r is not in the queue' % ip)
+            self._remove(slot, bucket)
+        finally:
+            self._lock.release()
+
+
+# fields of the buckets of SpaceSavingQueue
+_B_PREV, _B_NEXT, _B_COUNT, _B_IPS = range(4)
+
+
+class SpaceSavingQueue(object):
+    """Counts the calls of the most frequent IPs with the Space-Saving
+    algorithm, in a fixed number of counters.
+
+    Has the same API than IPQueue, but keeps counting the IPs that call the
+    most, even when there are many more IPs than counters:
+
+    - when an IP that has no counter comes in and all the counters are
+      used, it takes the counter of an IP with the smallest count, and
+      the count is incremented. The counter of an IP then overestimates
+      its calls by at most the count it took over: its error.
+    - count() returns the counter minus its error, the calls the IP made
+      for sure, so an IP is never blacklisted for calls it did not make.
+      top() returns the counters and their errors.
+    - an IP that makes more than 1/maxlen of the calls of the window
+      always has a counter. Its count() only misses the calls it made
+      before it got that counter, at most calls/maxlen. So an IP is only
+      sure to go over a treshold once it made treshold + calls/maxlen
+      calls: a bigger maxlen narrows that margin. The counter itself is
+      not used, since a new IP would take over the count of the IP it
+      replaces, and could go over the treshold on its first call.
+    - the counts are reset every ttl seconds.
+
+    The counters are in a "stream summary": a doubly-linked list of
+    buckets ordered by count, each bucket holding the IPs that have its
+    count. All the operations are O(1).
+    """
+    def __init__(self, maxlen=200, ttl=360):
+        self._maxlen = maxlen
+        self._ttl = float(ttl)
+        self._lock = threading.RLock()
+        self._clear(time.time())
 
-            self._last_update[ip] = time.time()
+    def _clear(self, now):
+        # the root is the sentinel of the circular list of buckets, its
+        # next bucket has the smallest count. Its count matches no bucket.
+        self._root = root = [None, None, -1, None]
+        root[_B_PREV] = root[_B_NEXT] = root
+        self._buckets = {}
+        self._errors = {}
+        self._start = now
 
-            if len(self._ips) > self._maxlen:
-                ip = self._ips.pop()
-                del self._counter[ip]
-                del self._last_update[ip]
+    def __getstate__(self):
+        self._lock.acquire()
+        try:
+            ips = [(ip, bucket[_B_COUNT], self._errors[ip])
+                   for ip, bucket in self._buckets.items()]
         finally:
             self._lock.release()
+        return {'maxlen': self._maxlen, 'ttl': self._ttl,
+                'start': self._start, 'ips': ips}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxlen'], state['ttl'])
+        self._start = state['start']
+        ips = sorted(state['ips'], key=lambda ip: ip[1])
+        for ip, count, error in ips:
+            last = self._root[_B_PREV]
+            if last[_B_COUNT] != count:
+                last = self._add_bucket(last, count)
+            self._add(ip, last, error)
+
+    def _add_bucket(self, prev, count):
+        # inserts a bucket after prev
+        next = prev[_B_NEXT]
+        bucket = [prev, next, count, set()]
+        prev[_B_NEXT] = next[_B_PREV] = bucket
+        return bucket
+
+    def _add(self, ip, bucket, error):
+        bucket[_B_IPS].add(ip)
+        self._buckets[ip] = bucket
+        self._errors[ip] = error
+
+    def _remove(self, ip):
+        bucket = self._buckets.pop(ip)
+        del self._errors[ip]
+        self._discard(ip, bucket)
+
+    def _discard(self, ip, bucket):
+        ips = bucket[_B_IPS]
+        ips.discard(ip)
+        if not ips:
+            bucket[_B_PREV][_B_NEXT] = bucket[_B_NEXT]
+            bucket[_B_NEXT][_B_PREV] = bucket[_B_PREV]
 
-    def _discard_if_old(self, ip):
-        updated = self._last_update.get(ip)
-        if updated is None:
-            return False
-        if time.time() - updated > self._ttl:
-            self.remove(ip)
-            return True
-        return False
+    def _increment(self, ip):
+        bucket = self._buckets[ip]
+        count = bucket[_B_COUNT] + 1
+        next = bucket[_B_NEXT]
+        if next[_B_COUNT] != count:
+            next = self._add_bucket(bucket, count)
+        next[_B_IPS].add(ip)
+        self._buckets[ip] = next
+        self._discard(ip, bucket)
 
-    def _discard_old_ips(self):
-        # from right-to-left check the age and discard old ones
-        index = len(self._ips) - 1
-        while index >= 0:
-            ip = self._ips[index]
-            if not self._discard_if_old(ip):
-                return
-            index -= 1
+    def _check_window(self, now):
+        if now - self._start > self._ttl:
+            self._clear(now)
+
+    def append(self, ip):
+        """Adds the IP and raise the counter accordingly."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._check_window(now)
+            if ip not in self._buckets:
+                root = self._root
+                if len(self._buckets) < self._maxlen:
+                    bucket = root[_B_NEXT]
+                    if bucket[_B_COUNT] != 0:
+                        bucket = self._add_bucket(root, 0)
+                    self._add(ip, bucket, 0)
+                else:
+                    # taking over the counter of a least frequent IP
+                    bucket = root[_B_NEXT]
+                    replaced = bucket[_B_IPS].pop()
+                    del self._buckets[replaced]
+                    del self._errors[replaced]
+                    self._add(ip, bucket, bucket[_B_COUNT])
+            self._increment(ip)
+        finally:
+            self._lock.release()
 
     def count(self, ip):
-        """Returns the IP count."""
-        self._discard_if_old(ip)
-        return self._counter.get(ip, 0)
+        """Returns the IP count, without its error."""
+        self._lock.acquire()
+        try:
+            self._check_window(time.time())
+            bucket = self._buckets.get(ip)
+            if bucket is None:
+                return 0
+            return bucket[_B_COUNT] - self._errors[ip]
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns the count of each IP, without its error, at a given
+        time."""
+        self._lock.acquire()
+        try:
+            self._check_window(time.time())
+            errors = self._errors
+            return dict([(ip, bucket[_B_COUNT] - errors[ip])
+                         for ip, bucket in self._buckets.items()])
+        finally:
+            self._lock.release()
+
+    def error(self, ip):
+        """Returns the maximum overestimation of the IP counter."""
+        self._lock.acquire()
+        try:
+            return self._errors.get(ip, 0)
+        finally:
+            self._lock.release()
+
+    def top(self, size=10):
+        """Returns the (ip, count, error) of the size most frequent IPs."""
+        self._lock.acquire()
+        try:
+            self._check_window(time.time())
+            res = []
+            bucket = self._root[_B_PREV]
+            while bucket is not self._root and len(res) < size:
+                for ip in bucket[_B_IPS]:
+                    res.append((ip, bucket[_B_COUNT], self._errors[ip]))
+                bucket = bucket[_B_PREV]
+            return res[:size]
+        finally:
+            self._lock.release()
 
     def __len__(self):
-        self._discard_old_ips()
-        return len(self._ips)
+        self._lock.acquire()
+        try:
+            self._check_window(time.time())
+            return len(self._buckets)
+        finally:
+            self._lock.release()
 
     def __contains__(self, ip):
-        self._discard_if_old(ip)
-        return ip in self._ips
+        # an IP with a counter, whatever its count
+        self._lock.acquire()
+        try:
+            self._check_window(time.time())
+            return ip in self._buckets
+        finally:
+            self._lock.release()
 
     def remove(self, ip):
         self._lock.acquire()
         try:
-            self._ips.remove(ip)
-            del self._counter[ip]
-            del self._last_update[ip]
+            try:
+                self._remove(ip)
+            except KeyError:
+                raise ValueError('%r is not in the queue' % ip)
         finally:
             self._lock.release()
+
+
+class StripedQueue(object):
+    """Spreads the IPs over several queues, so threads working on
+    different IPs don't wait for each other.
+
+    - factory: called with a size to build each stripe, like IPQueue.
+    - maxlen: the total size, shared by the stripes.
+    - stripes: the number of stripes.
+
+    An IP always goes to the same stripe, picked with its CRC-32 so it
+    does not change once pickled. Each stripe evicts its own IPs, so
+    maxlen is only reached when the IPs are evenly spread.
+    """
+    def __init__(self, factory, maxlen=200, stripes=16):
+        size = -(-maxlen // stripes)
+        self._stripes = [factory(size) for i in range(stripes)]
+
+    def _stripe(self, ip):
+        stripes = self._stripes
+        return stripes[(zlib.crc32(ip) & 0xffffffff) % len(stripes)]
+
+    def append(self, ip):
+        """Adds the IP and raise the counter accordingly."""
+        self._stripe(ip).append(ip)
+
+    def count(self, ip):
+        """Returns the IP count."""
+        return self._stripe(ip).count(ip)
+
+    def consume(self, ip):
+        """Takes a token from the IP bucket, if the stripes are
+        TokenBucketLimiter."""
+        return self._stripe(ip).consume(ip)
+
+    def __contains__(self, ip):
+        return ip in self._stripe(ip)
+
+    def remove(self, ip):
+        self._stripe(ip).remove(ip)
+
+    def __len__(self):
+        return sum([len(stripe) for stripe in self._stripes])
+
+    def snapshot(self):
+        """Returns the count of each IP, at a given time: all the stripes
+        are locked meanwhile."""
+        locked = []
+        try:
+            for stripe in self._stripes:
+                stripe._lock.acquire()
+                locked.append(stripe._lock)
+            res = {}
+            for stripe in self._stripes:
+                res.update(stripe.snapshot())
+            return res
+        finally:
+            for lock in reversed(locked):
+                lock.release()
+
+
+# the queues IPFiltering can use
+QUEUES = {'lru': IPQueue, 'compact': CompactIPQueue,
+          'spacesaving': SpaceSavingQueue}
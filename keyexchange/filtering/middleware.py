@@ -45,6 +45,9 @@ calls. If an IP as a high number of calls, it's blacklisted.
 
 For the bad request counter, the same technique is used.
 
+Alternatively, a token bucket per IP can be used to blacklist the IPs that
+go over a given rate of calls, see TokenBucketLimiter.
+
 Blacklisted IPs are kept in memory with a TTL.
 """
 import os
@@ -55,7 +58,8 @@ from mako.template import Template
 from keyexchange.filtering.IPy import IP
 from keyexchange.util import get_memcache_class
 from keyexchange.filtering.blacklist import Blacklist
-from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.filtering.ipqueue import QUEUES, StripedQueue
+from keyexchange.filtering.ratelimit import TokenBucketLimiter
 
 
 class IPFiltering(object):
@@ -67,7 +71,8 @@ class IPFiltering(object):
                  admin_page=None, use_memory=False, refresh_frequency=1,
                  observe=False, callback=None, ip_whitelist=None,
                  async=True, update_blfreq=None, ip_queue_ttl=360,
-                 br_callback=None):
+                 br_callback=None, queue_backend='lru', limiter='queue',
+                 rate=10, burst=20, br_rate=.1, br_burst=5, stripes=1):
 
         """Initializes the middleware.
 
@@ -96,6 +101,25 @@ class IPFiltering(object):
         - update_blfreq: number of requests before the blacklist is updated.
           async must be False.
         - ip_queue_ttl: Maximum time to live for an IP in the queues.
+        - queue_backend: 'lru' keeps the IPs of the queues in Python
+          objects, 'compact' in preallocated arrays, for big queue sizes.
+          'spacesaving' counts the most frequent IPs, even when many more
+          IPs call, see SpaceSavingQueue.
+        - limiter: 'queue' blacklists the IPs that reach the treshold in the
+          queues. 'token_bucket' blacklists the IPs that go over a rate,
+          using a token bucket per IP. The queue sizes are then the
+          maximum number of IPs tracked.
+        - rate: calls per second allowed per IP, for the token_bucket
+          limiter.
+        - burst: calls an idle IP can do at once, for the token_bucket
+          limiter.
+        - br_rate: bad requests per second allowed per IP, for the
+          token_bucket limiter.
+        - br_burst: bad requests an idle IP can do at once, for the
+          token_bucket limiter.
+        - stripes: number of parts the queues and the blacklist are split
+          in, each with its own lock, so the threads serving different IPs
+          don't wait for each other.
         """
         self.app = app
         self.blacklist_ttl = blacklist_ttl
@@ -105,8 +129,35 @@ class IPFiltering(object):
         self.treshold = treshold
         self.br_treshold = br_treshold
         self.observe = observe
-        self._last_ips = IPQueue(queue_size, ttl=ip_queue_ttl)
-        self._last_br_ips = IPQueue(br_queue_size, ttl=ip_queue_ttl)
+        if queue_backend not in QUEUES:
+            raise ValueError('Unknown queue backend %r' % queue_backend)
+        self.queue_backend = queue_backend
+        self.limiter = limiter
+        if limiter == 'queue':
+            queue = QUEUES[queue_backend]
+
+            def factory(size):
+                return queue(size, ttl=ip_queue_ttl)
+
+            br_factory = factory
+        elif limiter == 'token_bucket':
+
+            def factory(size):
+                return TokenBucketLimiter(rate, burst, size)
+
+            def br_factory(size):
+                return TokenBucketLimiter(br_rate, br_burst, size)
+
+        else:
+            raise ValueError('Unknown limiter %r' % limiter)
+        self.stripes = stripes
+        if stripes > 1:
+            self._last_ips = StripedQueue(factory, queue_size, stripes)
+            self._last_br_ips = StripedQueue(br_factory, br_queue_size,
+                                             stripes)
+        else:
+            self._last_ips = factory(queue_size)
+            self._last_br_ips = br_factory(br_queue_size)
         if isinstance(cache_servers, str):
             cache_servers = [cache_servers]
         self._cache_server = get_memcache_class(use_memory)(cache_servers)
@@ -116,7 +167,7 @@ class IPFiltering(object):
         self.update_blfreq = update_blfreq
         self._blcounter = 0
         self._blacklisted = Blacklist(self._cache_server, refresh_frequency,
-                                      self.async)
+                                      self.async, stripes)
         if admin_page is not None and not admin_page.startswith('/'):
             admin_page = '/' + admin_page
         self.admin_page = admin_page
@@ -140,6 +191,17 @@ class IPFiltering(object):
                 return False
         return False
 
+    def _is_over(self, queue, ip, treshold):
+        if self.limiter == 'token_bucket':
+            return not queue.consume(ip)
+
+        # insert the IP in the queue
+        # if the queue is full, the opposite-end item is discarded
+        queue.append(ip)
+
+        # counts its ratio in the queue
+        return queue.count(ip) >= treshold
+
     def _check_ip(self, ip, environ):
         if self._is_whitelisted(ip):
             return
@@ -151,12 +213,7 @@ class IPFiltering(object):
         if self.observe and ip in self._blacklisted:
             return
 
-        # insert the IP in the queue
-        # if the queue is full, the opposite-end item is discarded
-        self._last_ips.append(ip)
-
-        # counts its ratio in the queue
-        if self._last_ips.count(ip) >= self.treshold:
+        if self._is_over(self._last_ips, ip, self.treshold):
 
             # blacklisting the IP
             self._blacklisted.add(ip, self.blacklist_ttl)
@@ -172,12 +229,8 @@ class IPFiltering(object):
 
         if self.observe and ip in self._blacklisted:
             return
-        # insert the IP in the br queue
-        # if the queue is full, the opposite-end item is discarded
-        self._last_br_ips.append(ip)
 
-        # counts its occurences in the queue
-        if self._last_br_ips.count(ip) >= self.br_treshold:
+        if self._is_over(self._last_br_ips, ip, self.br_treshold):
             # blacklisting the IP
             self._blacklisted.add(ip, self.br_blacklist_ttl)
             if self.callback is not None:
@@ -207,7 +260,8 @@ class IPFiltering(object):
         headers = [('Content-Type', 'text/html')]
         start_response('200 OK', headers)
         # we want to display the list of blacklisted IPs
-        output = self._admin_tpl.render(ips=self._blacklisted.ips,
+        ips = sorted(self._blacklisted.snapshot())
+        output = self._admin_tpl.render(ips=ips,
                                         admin_page=self.admin_page,
                                         observe=self.observe)
         if isinstance(output, unicode):
@@ -0,0 +1,135 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Per-IP rate limiting with token buckets.
+
+The IPQueue counters depend on the traffic: an IP is blacklisted once it
+takes a given share of the last queue_size calls, so the same treshold is
+more permissive on a busy server than on a quiet one. A token bucket limits
+each IP to a rate in requests per second instead, whatever the others do.
+"""
+import time
+
+from keyexchange.filtering.ipqueue import (IPQueue, _PREV, _IP, _COUNT,
+                                         _UPDATED)
+
+
+class TokenBucketLimiter(IPQueue):
+    """Keeps a token bucket per IP.
+
+    - rate: tokens added to a bucket per second.
+    - burst: size of the buckets. An IP that was idle can do burst calls
+      at once, then rate calls per second.
+    - maxlen: maximum number of buckets.
+    - ttl: time in seconds after which an idle IP is forgotten. Defaults
+      to the time it takes to fill a bucket, so an IP that is forgotten
+      would have a full bucket anyway.
+
+    The buckets are refilled when they are used, in the IPQueue nodes: the
+    counter is the number of tokens left. When there are more than maxlen
+    IPs, the least recently seen one is dropped, and gets a full bucket
+    when it comes back.
+    """
+    def __init__(self, rate=10., burst=20, maxlen=200, ttl=None):
+        self.rate = float(rate)
+        self.burst = burst
+        if ttl is None:
+            ttl = burst / self.rate
+        IPQueue.__init__(self, maxlen, ttl)
+
+    def __getstate__(self):
+        state = IPQueue.__getstate__(self)
+        state['rate'] = self.rate
+        state['burst'] = self.burst
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['rate'], state['burst'], state['maxlen'],
+                      state['ttl'])
+        for ip, tokens, updated in reversed(state['ips']):
+            self._link(ip, tokens, updated)
+
+    def _refill(self, node, now):
+        tokens = node[_COUNT] + (now - node[_UPDATED]) * self.rate
+        return min(tokens, self.burst)
+
+    def consume(self, ip):
+        """Takes a token from the IP bucket. Returns False if it was empty,
+        i.e. if the IP is over its rate."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(now)
+            if ip in self._nodes:
+                tokens = self._refill(self._unlink(ip), now)
+            else:
+                tokens = self.burst
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._link(ip, tokens, now)
+
+            if len(self._nodes) > self._maxlen:
+                self._unlink(self._root[_PREV][_IP])
+        finally:
+            self._lock.release()
+        return allowed
+
+    # so it can be used as an IPQueue
+    append = consume
+
+    def count(self, ip):
+        """Returns the number of tokens left in the IP bucket."""
+        self._lock.acquire()
+        try:
+            node = self._get(ip)
+            if node is None:
+                return self.burst
+            return self._refill(node, time.time())
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns the number of tokens left in each bucket, at a given
+        time."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._discard_old_ips(now)
+            return dict([(node[_IP], self._refill(node, now))
+                         for node in self._iter_nodes()])
+        finally:
+            self._lock.release()
@@ -0,0 +1,132 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Memcache health checks.
+
+The deep check adds, reads and deletes a random key on every memcache
+server. Running it on every call to / turns load balancer probes into a
+steady write load, so a prober thread runs it every few seconds instead and
+the application answers from the last result.
+"""
+import time
+import random
+import threading
+
+from keyexchange.util import stop_at_exit
+
+
+def check_cache(cache):
+    """Checks that a memcache client is up and works as expected"""
+    rand = ''.join([random.choice('abcdefgh1234567') for i in range(50)])
+    key = 'test_%s' % rand
+    if not cache.add(key, 'test'):
+        return False
+    if cache.get(key) != 'test':
+        return False
+    cache.delete(key)
+    return cache.get(key) is None
+
+
+class HealthProber(threading.Thread):
+    """Runs the deep health check every `frequency` seconds.
+
+    - caches: mapping of server name -> memcache client for that server
+    - frequency: delay in seconds between two checks
+
+    The last result is kept in the status attribute: a mapping containing
+    the overall 'healthy' flag, the 'time' of the check and, per server,
+    its own 'healthy' flag and 'latency' in seconds.
+    """
+    def __init__(self, caches, frequency=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.caches = caches
+        self.frequency = frequency
+        self.status = None
+        self.running = False
+        self._event = threading.Event()
+
+    def check(self):
+        """Runs the check against every server and returns the status."""
+        servers = {}
+        for server, cache in self.caches.items():
+            start = time.time()
+            try:
+                healthy = check_cache(cache)
+            except Exception, e:
+                from keyexchange import logger
+                logger.error('Health check failed on %s: %s' % (server, e))
+                healthy = False
+            servers[server] = {'healthy': healthy,
+                               'latency': time.time() - start}
+
+        healthy = len(servers) > 0
+        for server in servers.values():
+            healthy = healthy and server['healthy']
+
+        self.status = {'healthy': healthy, 'time': time.time(),
+                       'servers': servers}
+        return self.status
+
+    def get_status(self, max_age=None):
+        """Returns the last status.
+
+        If no check was done yet, or if the last one is older than max_age
+        seconds, a check is done first.
+        """
+        status = self.status
+        if status is None or (max_age is not None and
+                              time.time() - status['time'] > max_age):
+            status = self.check()
+        return status
+
+    def start(self):
+        # set before the thread runs, so an early join() stops it
+        self.running = True
+        threading.Thread.start(self)
+        stop_at_exit(self)
+
+    def run(self):
+        while self.running:
+            self.check()
+            self._event.wait(self.frequency)
+
+    def join(self):
+        if not self.running:
+            return
+        self.running = False
+        self._event.set()
+        threading.Thread.join(self)
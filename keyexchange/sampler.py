@@ -0,0 +1,211 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Statistical profiler.
+
+Unlike the deterministic profiler, the sampler does not slow down the
+application: when sampling, a thread wakes up every few milliseconds and
+records what every other thread is running, using sys._current_frames().
+When it's not sampling, the thread just waits.
+
+The result is given in the collapsed stack format used by flamegraph.pl,
+one line per distinct stack with the number of times it was seen:
+
+    file:function:line;file:function:line 42
+"""
+import os
+import sys
+import time
+import thread
+import threading
+from urlparse import parse_qs
+
+
+class Sampler(object):
+    """Records the stack of all threads every `interval` seconds.
+
+    The samples are taken by a daemon thread, started by the first call to
+    start_sampling(), or by the next one once the thread was joined.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.running = False
+        self._sampling = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def sampling(self):
+        return self._sampling.isSet()
+
+    def start_sampling(self, reset=True):
+        self._lock.acquire()
+        try:
+            if reset:
+                self.samples = {}
+            self._sampling.set()
+            if self._thread is None or not self._thread.isAlive():
+                self.running = True
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def stop_sampling(self):
+        self._sampling.clear()
+
+    def sample(self):
+        """Records the current stack of every other thread."""
+        own_id = thread.get_ident()
+        samples = self.samples
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                           code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            stack = ';'.join(stack)
+            samples[stack] = samples.get(stack, 0) + 1
+
+    def collapsed(self):
+        """Returns the samples in the collapsed stack format."""
+        lines = ['%s %d' % (stack, count)
+                 for stack, count in sorted(self.samples.items())]
+        return '\n'.join(lines) + '\n'
+
+    def run(self):
+        while self.running:
+            self._sampling.wait()
+            if not self.running:
+                break
+            self.sample()
+            time.sleep(self.interval)
+
+    def join(self):
+        """Stops the sampling thread."""
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                return
+            self.running = False
+            self._sampling.set()
+            self._thread.join()
+            self._thread = None
+            self._sampling.clear()
+        finally:
+            self._lock.release()
+
+
+class SamplerMiddleware(object):
+    """Controls a Sampler through an admin URL.
+
+    - app: the wsgi application the middleware wraps
+    - path: the admin URL
+    - interval: delay in seconds between two samples
+    - max_seconds: maximum length of a sampling window. Longer windows
+      are rejected.
+
+    The admin URL accepts:
+
+    - ?seconds=N: samples during N seconds and returns the result
+    - ?action=start: starts sampling, until stopped
+    - ?action=stop: stops sampling and returns the result
+    - ?action=dump: returns the result without stopping
+    """
+    def __init__(self, app, path='/__sampler__', interval=0.005,
+                 max_seconds=60):
+        self.app = app
+        if not path.startswith('/'):
+            path = '/' + path
+        self.path = path
+        self.max_seconds = max_seconds
+        self.sampler = Sampler(interval)
+        self._lock = threading.Lock()
+
+    def _response(self, start_response, body, status='200 OK'):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [body]
+
+    def admin(self, environ, start_response):
+        query = dict([(key, values[0]) for key, values in
+                      parse_qs(environ.get('QUERY_STRING', '')).items()])
+        action = query.get('action')
+
+        if action == 'start':
+            self.sampler.start_sampling()
+            return self._response(start_response, 'Sampling\n')
+        elif action == 'stop':
+            self.sampler.stop_sampling()
+            return self._response(start_response, self.sampler.collapsed())
+        elif action == 'dump':
+            return self._response(start_response, self.sampler.collapsed())
+        elif action is not None:
+            return self._response(start_response, 'Unknown action\n',
+                                  '400 Bad Request')
+
+        try:
+            seconds = float(query.get('seconds', 10))
+        except ValueError:
+            seconds = None
+        # NaN fails the comparisons too
+        if seconds is None or not 0 < seconds <= self.max_seconds:
+            return self._response(start_response, 'Invalid seconds\n',
+                                  '400 Bad Request')
+
+        # one window at a time
+        if not self._lock.acquire(False):
+            return self._response(start_response, 'Already sampling\n',
+                                  '409 Conflict')
+        try:
+            self.sampler.start_sampling()
+            try:
+                time.sleep(seconds)
+            finally:
+                self.sampler.stop_sampling()
+            return self._response(start_response, self.sampler.collapsed())
+        finally:
+            self._lock.release()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self.admin(environ, start_response)
+        return self.app(environ, start_response)
@@ -0,0 +1,322 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Low overhead metrics.
+
+Histograms keep their values in log-linear buckets, in the spirit of HDR
+histograms: every power of two is split in 16 buckets, so a value is known
+within ~6% whatever its magnitude, in a fixed amount of memory.
+
+Each thread records in its own buckets so recording a value doesn't take
+any lock. The buckets of all threads are summed when the histogram is
+read. When a thread ends, its buckets are folded into the ones of the
+threads that are gone, so they don't pile up when threads come and go.
+"""
+import math
+import threading
+import weakref
+
+_SUB_BUCKETS = 16
+_MAX_EXPONENT = 48
+_NUM_BUCKETS = _SUB_BUCKETS * (_MAX_EXPONENT - 3)
+_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket(value):
+    """Returns the index of the bucket for a positive value."""
+    if value < _SUB_BUCKETS:
+        return int(value)
+    # value = mantissa * 2 ** exponent, with 0.5 <= mantissa < 1
+    mantissa, exponent = math.frexp(value)
+    index = ((exponent - 4) * _SUB_BUCKETS +
+             int((mantissa * 2 - 1) * _SUB_BUCKETS))
+    return min(index, _NUM_BUCKETS - 1)
+
+
+def _bucket_range(index):
+    """Returns the lowest and highest values of a bucket."""
+    if index < _SUB_BUCKETS:
+        return index, index + 1
+    exponent, sub = divmod(index, _SUB_BUCKETS)
+    base = 2. ** (exponent + 3)
+    step = base / _SUB_BUCKETS
+    return base + sub * step, base + (sub + 1) * step
+
+
+class _Owner(object):
+    # kept by the thread local only, so it's collected when the thread ends
+    pass
+
+
+class _ThreadShards(object):
+    """The shards of a metric, one per thread.
+
+    - new: returns an empty shard.
+    - fold: adds the values of a shard to another one.
+
+    The shard of a thread that ended is folded into the retired shard.
+    """
+    def __init__(self, new, fold):
+        self._new = new
+        self._fold = fold
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = new()
+        # re-entrant: a thread can end while the collector runs in a thread
+        # that holds the lock
+        self._lock = threading.RLock()
+
+    def get(self):
+        """Returns the shard of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            # first value recorded by this thread
+            shard = self._new()
+            owner = _Owner()
+            self._lock.acquire()
+            try:
+                self._shards[weakref.ref(owner, self._retire)] = shard
+            finally:
+                self._lock.release()
+            self._local.owner = owner
+            self._local.shard = shard
+            return shard
+
+    def _retire(self, ref):
+        self._lock.acquire()
+        try:
+            shard = self._shards.pop(ref, None)
+            if shard is not None:
+                self._fold(self._retired, shard)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._shards)
+
+    def merged(self):
+        """Returns a shard with the values of all the shards."""
+        res = self._new()
+        self._lock.acquire()
+        try:
+            self._fold(res, self._retired)
+            for shard in self._shards.values():
+                self._fold(res, shard)
+        finally:
+            self._lock.release()
+        return res
+
+
+def _new_histogram_shard():
+    # [buckets, count, total, max]
+    return [[0] * _NUM_BUCKETS, 0, 0, 0]
+
+
+def _fold_histogram_shard(shard, other):
+    buckets = shard[0]
+    for index, value in enumerate(other[0]):
+        if value:
+            buckets[index] += value
+    shard[1] += other[1]
+    shard[2] += other[2]
+    shard[3] = max(shard[3], other[3])
+
+
+class Histogram(object):
+    """Distribution of positive values.
+
+    - unit: unit of the recorded values, 'us' for latencies.
+    """
+    def __init__(self, unit='us'):
+        self.unit = unit
+        self._shards = _ThreadShards(_new_histogram_shard,
+                                     _fold_histogram_shard)
+
+    def record(self, value):
+        """Records a value."""
+        shard = self._shards.get()
+        shard[0][_bucket(value)] += 1
+        shard[1] += 1
+        shard[2] += value
+        if value > shard[3]:
+            shard[3] = value
+
+    def snapshot(self):
+        """Returns the merged buckets, count, total and max."""
+        return tuple(self._shards.merged())
+
+    def summary(self, percentiles=_PERCENTILES):
+        """Returns count, mean, max and the percentiles of the values.
+
+        A percentile is the middle of the bucket it falls in.
+        """
+        buckets, count, total, maximum = self.snapshot()
+        res = {'unit': self.unit, 'count': count, 'max': maximum,
+               'mean': count and float(total) / count or 0}
+
+        targets = [(percentile, math.ceil(count * percentile / 100.))
+                   for percentile in percentiles]
+        seen = 0
+        for index, value in enumerate(buckets):
+            if not value:
+                continue
+            seen += value
+            while targets and seen >= targets[0][1]:
+                low, high = _bucket_range(index)
+                res['p%s' % targets[0][0]] = min((low + high) / 2., maximum)
+                targets.pop(0)
+            if not targets:
+                break
+
+        for percentile, __ in targets:
+            res['p%s' % percentile] = 0
+        return res
+
+
+def _new_counter_shard():
+    return [0]
+
+
+def _fold_counter_shard(shard, other):
+    shard[0] += other[0]
+
+
+class Counter(object):
+    """Counter where each thread increments its own value."""
+    def __init__(self):
+        self._shards = _ThreadShards(_new_counter_shard, _fold_counter_shard)
+
+    def incr(self, value=1):
+        self._shards.get()[0] += value
+
+    @property
+    def value(self):
+        return self._shards.merged()[0]
+
+
+class Stats(object):
+    """Registry of named histograms and counters.
+
+    Names are dotted, the first part being the kind of metric, like
+    "route.put" or "status.200".
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, unit='us'):
+        """Returns the histogram, created if needed."""
+        try:
+            return self._histograms[name]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                if name not in self._histograms:
+                    self._histograms[name] = Histogram(unit)
+                return self._histograms[name]
+            finally:
+                self._lock.release()
+
+    def record(self, name, value, unit='us'):
+        self.histogram(name, unit).record(value)
+
+    def counter(self, name):
+        """Returns the counter, created if needed."""
+        try:
+            return self._counters[name]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                if name not in self._counters:
+                    self._counters[name] = Counter()
+                return self._counters[name]
+            finally:
+                self._lock.release()
+
+    def incr(self, name, value=1):
+        self.counter(name).incr(value)
+
+    def to_json(self):
+        """Returns the summaries and counters, grouped by kind of metric."""
+        res = {}
+        for name, histogram in self._histograms.items():
+            kind, label = name.split('.', 1)
+            res.setdefault(kind, {})[label] = histogram.summary()
+        for name, counter in self._counters.items():
+            kind, label = name.split('.', 1)
+            res.setdefault(kind, {})[label] = counter.value
+        return res
+
+    def to_prometheus(self, prefix='keyexchange'):
+        """Returns the summaries in the Prometheus text format."""
+        families = {}
+        for name, histogram in sorted(self._histograms.items()):
+            kind, label = name.split('.', 1)
+            summary = histogram.summary()
+            if summary['unit'] == 'us':
+                family = '%s_%s_latency_seconds' % (prefix, kind)
+                scale = 1e-6
+            else:
+                family = '%s_%s_%s' % (prefix, kind, summary['unit'])
+                scale = 1
+            lines = families.setdefault(family, [])
+            for percentile in _PERCENTILES:
+                value = summary['p%s' % percentile] * scale
+                lines.append('%s{name="%s",quantile="%s"} %r' %
+                             (family, label, percentile / 100., value))
+            total = summary['mean'] * summary['count'] * scale
+            lines.append('%s_sum{name="%s"} %r' % (family, label, total))
+            lines.append('%s_count{name="%s"} %d' % (family, label,
+                                                     summary['count']))
+
+        res = []
+        for family, lines in sorted(families.items()):
+            res.append('# TYPE %s summary' % family)
+            res.extend(lines)
+
+        families = {}
+        for name, counter in sorted(self._counters.items()):
+            kind, label = name.split('.', 1)
+            family = '%s_%s_total' % (prefix, kind)
+            families.setdefault(family, []).append(
+                    '%s{name="%s"} %d' % (family, label, counter.value))
+
+        for family, lines in sorted(families.items()):
+            res.append('# TYPE %s counter' % family)
+            res.extend(lines)
+        return '\n'.join(res) + '\n'
@@ -1,5 +1,5 @@
 # flake8: noqa
-import os, binascii
+import os, binascii, threading, atexit, weakref, Queue
 from hashlib import sha256, sha1
 try:
     import json as simplejson
@@ -38,12 +38,220 @@ def number_to_string(num, orderlen):
 def string_to_number(string):
     return int(binascii.hexlify(string), 16)
 
+def pack_fields(fields, trailer, orderlen):
+    """Packs hex numbers in fixed-width big-endian fields of orderlen bytes,
+    followed by trailer. The hex strings are padded and decoded at once,
+    without going through ints."""
+    width = 2*orderlen
+    padded = []
+    for field in fields:
+        if len(field) > width:
+            field = field.lstrip("0")
+            assert len(field) <= width, (len(field), width)
+        padded.append(field.rjust(width, "0"))
+    return binascii.unhexlify("".join(padded)) + trailer
+
+def unpack_fields(packed, count, orderlen):
+    """Returns the count fields packed by pack_fields, as hex strings, and
+    the trailer."""
+    width = 2*orderlen
+    end = count*orderlen
+    encoded = binascii.hexlify(packed[:end])
+    assert len(encoded) == count*width, "truncated message"
+    fields = [encoded[i:i+width] for i in range(0, count*width, width)]
+    return fields, packed[end:]
+
+class FixedBaseTable:
+    """Precomputed powers of a fixed base, to compute base^e mod p with only
+    multiplications. Row i holds base^(d*2^(width*i)) for every width-bit
+    digit d, so base^e is the product of one entry per digit of e. This
+    only works for exponents of up to maxbits bits: bigger (or negative)
+    exponents fall back to pow().
+
+    With width=8, a 256-bit exponent takes 32 multiplications instead of
+    the ~300 squarings and multiplications of pow(), and the table holds
+    32*256 numbers (3MB for a 3072-bit modulus).
+    """
+    def __init__(self, base, p, maxbits, width=8):
+        self.base = base
+        self.p = p
+        self.maxbits = maxbits
+        self.width = width
+        self.mask = (1 << width) - 1
+        rows = []
+        row_base = base % p
+        for i in range((maxbits + width - 1) // width):
+            row = [1, row_base]
+            for d in range(2, 1 << width):
+                row.append((row[-1] * row_base) % p)
+            rows.append(row)
+            row_base = (row[-1] * row_base) % p # base^(2^(width*(i+1)))
+        self.rows = rows
+
+    def pow(self, exponent):
+        if exponent < 0 or exponent >> self.maxbits:
+            return pow(self.base, exponent, self.p)
+        p = self.p; mask = self.mask; width = self.width
+        result = 1
+        for row in self.rows:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = (result * row[digit]) % p
+            exponent >>= width
+        return result
+
+# the tables are shared by all the Params with the same (p, g), like the
+# ones rebuilt by JPAKE.from_json()
+_tables = {}
+_tables_lock = threading.Lock()
+
+def get_fixed_base_table(base, p, q):
+    """Returns the table of base for exponents in [0,q), built on first
+    use. Thread-safe."""
+    key = (p, base)
+    table = _tables.get(key)
+    if table is None:
+        _tables_lock.acquire()
+        try:
+            table = _tables.get(key)
+            if table is None:
+                table = FixedBaseTable(base, p, 4*len("%x" % q))
+                _tables[key] = table
+        finally:
+            _tables_lock.release()
+    return table
+
+def multi_exp(pairs, p, width=4):
+    """Returns the product of base^exponent mod p for all the (base,
+    exponent) in pairs, with Straus' interleaved method: each base gets a
+    small table of its first 2^width powers, and a single chain of
+    squarings is shared by all the exponents, instead of one per pow().
+    For two exponents, this costs about 60% of two pow() calls."""
+    mask = (1 << width) - 1
+    tables = []
+    maxbits = 0
+    for base, exponent in pairs:
+        if exponent < 0:
+            raise ValueError("negative exponent")
+        table = [1, base % p]
+        for d in range(2, 1 << width):
+            table.append((table[-1] * base) % p)
+        tables.append((table, exponent))
+        maxbits = max(maxbits, 4*len("%x" % exponent))
+    result = 1
+    for shift in range(((maxbits + width - 1) // width - 1) * width, -1,
+                       -width):
+        if result != 1:
+            for i in range(width):
+                result = (result * result) % p
+        for table, exponent in tables:
+            digit = (exponent >> shift) & mask
+            if digit:
+                result = (result * table[digit]) % p
+    return result
+
+class PythonBackend:
+    """The big-integer operations of the J-PAKE math, with the Python
+    integers. The other backends wrap faster libraries, and must return the
+    same (Python) integers."""
+    name = "python"
+
+    def powmod(self, base, exponent, modulus):
+        return pow(base, exponent, modulus)
+
+    def fixed_base(self, base, p, q):
+        """Returns an object whose pow(e) method returns base^e mod p, for
+        e in [0,q)."""
+        return get_fixed_base_table(base, p, q)
+
+    def multi_exp(self, pairs, p):
+        return multi_exp(pairs, p)
+
+    def randrange(self, order, entropy):
+        return _randrange(order, entropy)
+
+class _GMPYPower:
+    def __init__(self, backend, base, p):
+        self.backend = backend
+        self.base = backend.mpz(base)
+        self.p = backend.mpz(p)
+
+    def pow(self, exponent):
+        return self.backend.powmod(self.base, exponent, self.p)
+
+class GMPYBackend(PythonBackend):
+    """Computes with GMP, through gmpy2 or gmpy (1.x). GMP exponentiates
+    faster than the precomputed tables, so they aren't used. Raises
+    ImportError if the module is missing."""
+    def __init__(self, module="gmpy2"):
+        self.name = module
+        self.mpz = __import__(module).mpz
+
+    def powmod(self, base, exponent, modulus):
+        if exponent < 0:
+            # same errors than pow()
+            return pow(base, exponent, modulus)
+        return long(pow(self.mpz(base), exponent, self.mpz(modulus)))
+
+    def fixed_base(self, base, p, q):
+        return _GMPYPower(self, base, p)
+
+    def multi_exp(self, pairs, p):
+        mpz = self.mpz
+        p = mpz(p)
+        result = mpz(1)
+        for base, exponent in pairs:
+            if exponent < 0:
+                raise ValueError("negative exponent")
+            result = (result * pow(mpz(base), exponent, p)) % p
+        return long(result)
+
+# by order of preference
+BACKENDS = ("gmpy2", "gmpy", "python")
+
+def get_backend(name):
+    if name == "python":
+        return PythonBackend()
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend %r" % name)
+    return GMPYBackend(name)
+
+def set_backend(name=None):
+    """Selects the backend of the J-PAKE math, by default the first one of
+    BACKENDS that can be imported. Returns it."""
+    global backend
+    if name is not None:
+        backend = get_backend(name)
+        return backend
+    for name in BACKENDS:
+        try:
+            backend = get_backend(name)
+        except ImportError:
+            continue
+        return backend
+
+backend = None
+set_backend()
+
 class Params:
     def __init__(self, p, q, g):
         self.p = p
         self.q = q
         self.g = g
         self.orderlen = orderlen(self.p)
+        self._g_table = None
+
+    def gpow(self, exponent):
+        """Returns pow(g, exponent, p), using a precomputed table with the
+        python backend. The table is built on the first call."""
+        table = self._g_table
+        if table is None or table[0] is not backend:
+            table = self._g_table = (backend,
+                                     backend.fixed_base(self.g, self.p,
+                                                        self.q))
+        return table[1].pow(exponent)
 
 # params_80 is roughly as secure as an 80-bit symmetric key, and uses a
 # 1024-bit modulus. params_112 uses a 2048-bit modulus, and params_128 uses a
@@ -79,6 +287,9 @@ def randrange(order, entropy):
     achieve stability within a given release (for repeatable unit tests), but
     should not be used as a long-term-compatible key generation algorithm.
     """
+    return backend.randrange(order, entropy)
+
+def _randrange(order, entropy):
     # we could handle arbitrary orders (even 256**k+1) better if we created
     # candidates bit-wise instead of byte-wise, which would reduce the
     # worst-case behavior to avg=2 loops, but that would be more complex. The
@@ -101,6 +312,34 @@ def randrange(order, entropy):
                        " is very wrong or you got realllly unlucky. Order was"
                        " %x" % order)
 
+def zkp_hash(generator, gr, gx, signerid):
+    # Ben's C implementation hashes the pieces this way:
+    def hashbn(bn):
+        bns = number_to_string(bn, None)
+        assert len(bns) <= 0xffff
+        return number_to_string(len(bns), 2) + bns
+    assert len(signerid) <= 0xffff
+    s = "".join([hashbn(generator), hashbn(gr), hashbn(gx),
+                 number_to_string(len(signerid), 2),
+                 signerid])
+    return string_to_number(sha1(s).digest())
+
+def check_zkp(params, generator, gx, zkp):
+    """Raises BadZeroKnowledgeProof unless zkp proves that its sender knows
+    x such that generator^x==gx."""
+    p = params.p
+    gr = int(zkp["gr"], 16)
+    b = int(zkp["b"], 16)
+    h = zkp_hash(generator, gr, gx, zkp["id"])
+    if generator == params.g:
+        # g^b is cheaper with the fixed-base table than within the
+        # multi-exponentiation
+        gby = (params.gpow(b) * backend.powmod(gx, h, p)) % p
+    else:
+        gby = backend.multi_exp([(generator, b), (gx, h)], p)
+    if gr != gby:
+        raise BadZeroKnowledgeProof
+
 class JPAKE:
     """This class manages one half of a J-PAKE key negotiation.
 
@@ -182,10 +421,14 @@ class JPAKE:
 
     """
 
-    def __init__(self, password, params=params_80, signerid=None, entropy=None):
+    def __init__(self, password, params=params_80, signerid=None, entropy=None,
+                 pool=None):
         if entropy is None:
             entropy = os.urandom
         self.entropy = entropy
+        # optional RoundOnePool for the same params
+        assert pool is None or pool.params is params
+        self.pool = pool
         if signerid is None:
             signerid = binascii.hexlify(self.entropy(16))
         self.signerid = signerid
@@ -203,15 +446,22 @@ class JPAKE:
             self.s = 1 + (string_to_number(sha256(password).digest()) % (q-1))
 
 
-    def createZKP(self, generator, exponent, gx):
+    def createZKP(self, generator, exponent, gx, r=None, gr=None):
         # This returns a proof that I know a secret value 'exponent' that
         # satisfies the equation A^exponent=B mod P, where A,B,P are known to
         # the recipient of this proof (A=generator, P=self.params.p). It
         # happens that everywhere createZKP() is called, we already have
         # A^exponent, so we pass it in to save some computation time.
+        # A precomputed r and A^r (see RoundOnePool) can be passed as well.
         p = self.params.p; q = self.params.q
-        r = randrange(q, self.entropy) # [0,q)
-        gr = pow(generator, r, p)
+        if r is not None:
+            assert gr is not None
+        elif generator == self.params.g:
+            r = randrange(q, self.entropy) # [0,q)
+            gr = self.params.gpow(r)
+        else:
+            r = randrange(q, self.entropy) # [0,q)
+            gr = backend.powmod(generator, r, p)
         #gx = pow(generator, exponent, p) # the verifier knows this already
         # Ben's C implementation hashes the pieces this way:
         def hashbn(bn):
@@ -235,34 +485,21 @@ class JPAKE:
     def checkZKP(self, generator, gx, zkp):
         # confirm the sender's proof (contained in 'zkp') that they know 'x'
         # such that generator^x==gx
-        p = self.params.p
-        gr = int(zkp["gr"], 16)
-        b = int(zkp["b"], 16)
         if zkp["id"] == self.signerid:
             raise DuplicateSignerID
-        # Ben's C implementation hashes the pieces this way:
-        def hashbn(bn):
-            bns = number_to_string(bn, None)
-            assert len(bns) <= 0xffff
-            return number_to_string(len(bns), 2) + bns
-        assert len(zkp["id"]) <= 0xffff
-        s = "".join([hashbn(generator), hashbn(gr), hashbn(gx),
-                     number_to_string(len(zkp["id"]), 2),
-                     zkp["id"]])
-        h = string_to_number(sha1(s).digest())
-        gb = pow(generator, b, p)
-        y = pow(gx, h, p)
-        if gr != (gb*y)%p:
-            raise BadZeroKnowledgeProof
+        check_zkp(self.params, generator, gx, zkp)
 
     def one(self):
-        g = self.params.g; p = self.params.p; q = self.params.q
-        self.x1 = randrange(q, self.entropy) # [0,q)
-        self.x2 = 1+randrange(q-1, self.entropy) # [1,q)
-        gx1 = self.gx1 = pow(g, self.x1, p)
-        gx2 = self.gx2 = pow(g, self.x2, p)
-        zkp_x1 = self.createZKP(g, self.x1, gx1)
-        zkp_x2 = self.createZKP(g, self.x2, gx2)
+        g = self.params.g
+        material = None
+        if self.pool is not None:
+            material = self.pool.get()
+        if material is None:
+            material = round_one_material(self.params, self.entropy)
+        self.x1, self.x2, gx1, gx2, r1, gr1, r2, gr2 = material
+        self.gx1 = gx1; self.gx2 = gx2
+        zkp_x1 = self.createZKP(g, self.x1, gx1, r1, gr1)
+        zkp_x2 = self.createZKP(g, self.x2, gx2, r2, gr2)
         # now serialize all four. Use simple jsonable dict for now
         return {"gx1": "%x"%gx1,
                 "gx2": "%x"%gx2,
@@ -271,38 +508,25 @@ class JPAKE:
                 }
 
     def pack_one(self, data):
-        orderlen = self.params.orderlen
-        def n2s(hexint):
-            return number_to_string(int(hexint,16), orderlen)
         assert data["zkp_x1"]["id"] == data["zkp_x2"]["id"]
-        packed = "".join([n2s(data["gx1"]),
-                          n2s(data["gx2"]),
-                          n2s(data["zkp_x1"]["gr"]),
-                          n2s(data["zkp_x1"]["b"]),
-                          n2s(data["zkp_x2"]["gr"]),
-                          n2s(data["zkp_x2"]["b"]),
-                          # the rest of the string is signerid
-                          data["zkp_x1"]["id"],
-                          ])
-        return packed
+        return pack_fields([data["gx1"],
+                            data["gx2"],
+                            data["zkp_x1"]["gr"],
+                            data["zkp_x1"]["b"],
+                            data["zkp_x2"]["gr"],
+                            data["zkp_x2"]["b"]],
+                           # the rest of the string is signerid
+                           data["zkp_x1"]["id"], self.params.orderlen)
 
     def unpack_one(self, packed):
-        orderlen = self.params.orderlen
-        def generate_substrings(packed):
-            for i in range(6):
-                yield binascii.hexlify(packed[i*orderlen:(i+1)*orderlen])
-            yield packed[6*orderlen:] # signerid
-        g = generate_substrings(packed)
-        data = { "gx1": g.next(),
-                 "gx2": g.next(),
-                 "zkp_x1": {"gr": g.next(), "b": g.next() },
-                 "zkp_x2": {"gr": g.next(), "b": g.next() },
-                 }
-        signerid = g.next()
+        (gx1, gx2, gr1, b1, gr2, b2), signerid = unpack_fields(
+            packed, 6, self.params.orderlen)
         assert isinstance(signerid, str)
-        data["zkp_x1"]["id"] = signerid
-        data["zkp_x2"]["id"] = signerid
-        return data
+        return {"gx1": gx1,
+                "gx2": gx2,
+                "zkp_x1": {"gr": gr1, "b": b1, "id": signerid},
+                "zkp_x2": {"gr": gr2, "b": b2, "id": signerid},
+                }
 
     def two(self, m1):
         g = self.params.g; p = self.params.p
@@ -316,7 +540,7 @@ class JPAKE:
         # now compute A = g^((x1+x3+x4)*x2*s), i.e. (gx1*gx3*gx4)^(x2*s)
         t1 = (((self.gx1*gx3) % p) * gx4) % p   # (gx1*gx3*gx4)%p
         t2 = (self.x2*self.s) % p
-        A = pow(t1, t2, p)
+        A = backend.powmod(t1, t2, p)
         # also create a ZKP for x2*s
         zkp_A = self.createZKP(t1, t2, A)
         return {"A": "%x"%A,
@@ -324,31 +548,18 @@ class JPAKE:
                 }
 
     def pack_two(self, data):
-        orderlen = self.params.orderlen
-        def n2s(hexint):
-            return number_to_string(int(hexint,16), orderlen)
-        packed = "".join([n2s(data["A"]),
-                          n2s(data["zkp_A"]["gr"]),
-                          n2s(data["zkp_A"]["b"]),
-                          # the rest of the string is signerid
-                          data["zkp_A"]["id"],
-                          ])
-        return packed
+        return pack_fields([data["A"],
+                            data["zkp_A"]["gr"],
+                            data["zkp_A"]["b"]],
+                           # the rest of the string is signerid
+                           data["zkp_A"]["id"], self.params.orderlen)
 
     def unpack_two(self, packed):
-        orderlen = self.params.orderlen
-        def generate_substrings(packed):
-            for i in range(3):
-                yield binascii.hexlify(packed[i*orderlen:(i+1)*orderlen])
-            yield packed[3*orderlen:] # signerid
-        g = generate_substrings(packed)
-        data = { "A": g.next(),
-                 "zkp_A": {"gr": g.next(), "b": g.next() },
-                 }
-        signerid = g.next()
+        (A, gr, b), signerid = unpack_fields(packed, 3, self.params.orderlen)
         assert isinstance(signerid, str)
-        data["zkp_A"]["id"] = signerid
-        return data
+        return {"A": A,
+                "zkp_A": {"gr": gr, "b": b, "id": signerid},
+                }
 
     def three(self, m2):
         p = self.params.p; q = self.params.q
@@ -358,10 +569,10 @@ class JPAKE:
         # we want (B/(g^(x2*x4*s)))^x2, using the g^x4 that we got from them
         # (stored in gx4). We start with gx4^x2, then (gx4^x2)^-s, then
         # (B*(gx4^x2)^-s), then finally apply the ^x2.
-        t3 = pow(self.gx4, self.x2, p)
-        t3 = pow(t3, q-self.s, p)
+        t3 = backend.powmod(self.gx4, self.x2, p)
+        t3 = backend.powmod(t3, q-self.s, p)
         t4 = (B * t3) % p
-        K = pow(t4, self.x2, p)
+        K = backend.powmod(t4, self.x2, p)
         # the paper suggests this can be reduced to two pow() calls, but I'm
         # not seeing it.
         self.K = K # stash it, so that folks trying to be compatible with
@@ -403,3 +614,182 @@ class JPAKE:
             if data[name]:
                 setattr(self, name, int(data[name], 16))
         return self
+
+def batch_check_zkps(params, proofs, signerid=None, entropy=None, bits=64):
+    """Checks many proofs at once. proofs is a list of (generator, gx, zkp)
+    tuples, as passed to JPAKE.checkZKP(). signerid is our own signer ID: a
+    proof using it raises DuplicateSignerID.
+
+    Each proof says gr = generator^b * gx^h. They are all raised to a random
+    'bits'-bit exponent c and multiplied together, so a single equation is
+    checked:
+
+        prod(gr^c) == g^(sum(b*c) mod q) * prod(generator^(b*c) * gx^(h*c))
+
+    with one multi-exponentiation per side. A set containing a bad proof
+    passes with a probability of about 2^-bits. Then the proofs are checked
+    one by one, and BadZeroKnowledgeProof is raised with the indexes of the
+    bad ones in its 'indexes' attribute.
+
+    That bound only holds for values of the order-q subgroup: a component of
+    order 2 vanishes when c is even, for instance. So gr and gx are checked
+    first, and a proof with a value outside of the subgroup is bad.
+    """
+    if entropy is None:
+        entropy = os.urandom
+    p = params.p; q = params.q; g = params.g
+    nbytes = (bits + 7) // 8
+    randoms = entropy(nbytes * len(proofs))
+    left = []
+    right = []
+    gexponent = 0
+    bad = []
+    for index, (generator, gx, zkp) in enumerate(proofs):
+        if zkp["id"] == signerid:
+            raise DuplicateSignerID
+        gr = int(zkp["gr"], 16)
+        if backend.powmod(gr, q, p) != 1 or backend.powmod(gx, q, p) != 1:
+            bad.append(index)
+            continue
+        b = int(zkp["b"], 16)
+        h = zkp_hash(generator, gr, gx, zkp["id"])
+        # a zero would drop the proof from the check
+        c = string_to_number(randoms[index*nbytes:(index+1)*nbytes]) or 1
+        left.append((gr, c))
+        if generator == g:
+            # g has order q, its exponents can be added up
+            gexponent += b*c
+        else:
+            right.append((generator, b*c))
+        right.append((gx, h*c))
+
+    if not bad and backend.multi_exp(left, p) == (
+            params.gpow(gexponent % q) * backend.multi_exp(right, p)) % p:
+        return
+
+    indexes = []
+    for index, (generator, gx, zkp) in enumerate(proofs):
+        if index in bad:
+            indexes.append(index)
+            continue
+        try:
+            check_zkp(params, generator, gx, zkp)
+        except BadZeroKnowledgeProof:
+            indexes.append(index)
+    error = BadZeroKnowledgeProof(indexes)
+    error.indexes = indexes
+    raise error
+
+def round_one_material(params, entropy):
+    """Returns the round-one values that don't depend on the signer ID:
+    (x1, x2, g^x1, g^x2, r1, g^r1, r2, g^r2), where r1 and r2 are the ZKP
+    nonces. That's where all the exponentiations of one() are."""
+    q = params.q
+    x1 = randrange(q, entropy) # [0,q)
+    x2 = 1+randrange(q-1, entropy) # [1,q)
+    r1 = randrange(q, entropy)
+    r2 = randrange(q, entropy)
+    return (x1, x2, params.gpow(x1), params.gpow(x2),
+            r1, params.gpow(r1), r2, params.gpow(r2))
+
+def _round_one_batch(args):
+    # run by the worker processes of a RoundOnePool
+    p, q, g, count = args
+    params = Params(p, q, g)
+    return [round_one_material(params, os.urandom) for i in range(count)]
+
+# the running pools, stopped before the interpreter exits. The registry
+# holds them weakly, so a pool that is dropped can be collected
+_POOLS = weakref.WeakKeyDictionary()
+
+def _stop_pools():
+    for pool in list(_POOLS.keys()):
+        pool.join()
+
+atexit.register(_stop_pools)
+
+class RoundOnePool(threading.Thread):
+    """Precomputes the round-one material of JPAKE instances from a
+    background thread, so one() doesn't pay for the exponentiations.
+
+    - params: the Params the material is computed for.
+    - size: maximum number of states kept.
+    - processes: when non zero, the material is computed by that many
+      worker processes, and the thread only feeds the pool. Otherwise the
+      thread computes it, which only helps when the caller is idle (waiting
+      on the network) since it holds the GIL.
+    - batch: number of states computed per worker call.
+
+    Each state is handed out once. get() returns None when the pool is
+    empty, and JPAKE.one() then computes the material inline.
+    """
+    def __init__(self, params=params_80, size=100, processes=0, batch=10,
+                 entropy=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if entropy is None:
+            entropy = os.urandom
+        self.entropy = entropy
+        self.params = params
+        self.size = size
+        self.processes = processes
+        self.batch = batch
+        self._queue = Queue.Queue(size)
+        self.hits = self.misses = 0
+        self.running = False
+
+    def get(self):
+        """Returns a state, or None if the pool is empty."""
+        try:
+            material = self._queue.get_nowait()
+        except Queue.Empty:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return material
+
+    def _put(self, material):
+        while self.running:
+            try:
+                self._queue.put(material, timeout=.1)
+                return
+            except Queue.Full:
+                pass
+
+    def start(self):
+        # set before the thread runs, so an early join() stops it
+        self.running = True
+        threading.Thread.start(self)
+        # the worker processes are stopped before the interpreter exits
+        _POOLS[self] = True
+
+    def run(self):
+        if not self.processes:
+            while self.running:
+                self._put(round_one_material(self.params, self.entropy))
+            return
+
+        import multiprocessing
+        workers = multiprocessing.Pool(self.processes)
+        params = self.params
+        args = [(params.p, params.q, params.g, self.batch)] * self.processes
+        try:
+            while self.running:
+                for states in workers.imap_unordered(_round_one_batch, args):
+                    for material in states:
+                        self._put(material)
+        finally:
+            workers.terminate()
+            workers.join()
+
+    def stats(self):
+        """Returns the pool metrics."""
+        return {'available': self._queue.qsize(), 'size': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+    def join(self):
+        """Stops the producer."""
+        if not self.running:
+            return
+        self.running = False
+        threading.Thread.join(self)
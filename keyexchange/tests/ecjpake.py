@@ -0,0 +1,417 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+J-PAKE over an elliptic curve, NIST P-256 by default.
+
+ECJPAKE has the API of the JPAKE class of keyexchange.tests.client, and its
+messages have the same keys, but the group elements are points encoded as
+uncompressed SEC1 hex strings (04 || x || y). A 256-bit scalar
+multiplication is much cheaper than the 3072-bit exponentiation of
+params_128, for a similar security level.
+
+The ZKPs are Schnorr proofs hashed as in mbed TLS: SHA-256 over the
+generator, the commitment and the public key, each one prefixed with its
+length on four bytes, then the signer ID, and the result reduced modulo the
+order. The shared key is the SHA-256 of the x coordinate of K.
+
+The points are kept in Jacobian coordinates during the computations, so
+only the final conversion needs a modular inversion. Multiples of the base
+point come from a precomputed table, others use a fixed 4-bit window.
+"""
+import os
+import struct
+import binascii
+import threading
+from hashlib import sha256
+
+from keyexchange.tests.client import (JPAKEError, DuplicateSignerID,
+                                      BadZeroKnowledgeProof, randrange,
+                                      orderlen, number_to_string,
+                                      string_to_number)
+
+
+class InvalidPoint(JPAKEError):
+    """The encoded point is not on the curve."""
+
+
+# the point at infinity, in Jacobian coordinates
+_INFINITY = (1, 1, 0)
+
+
+class Curve(object):
+    """A curve y^2 = x^3 - 3x + b over GF(p), with a base point g of prime
+    order n and a cofactor of 1, like the NIST curves.
+
+    Points are (x, y) tuples, and None is the point at infinity.
+    """
+    def __init__(self, name, p, b, gx, gy, n, width=4):
+        self.name = name
+        self.p = p
+        self.b = b
+        self.g = (gx, gy)
+        self.n = n
+        self.orderlen = orderlen(p)
+        self.width = width
+        self._g_table = None
+        self._lock = threading.Lock()
+
+    def contains(self, point):
+        """Tells if point is on the curve."""
+        p = self.p
+        x, y = point
+        return (0 <= x < p and 0 <= y < p and
+                (y * y - (x * x * x - 3 * x + self.b)) % p == 0)
+
+    def _double(self, X, Y, Z):
+        # dbl-2001-b, for a = -3
+        p = self.p
+        if not Z or not Y:
+            return _INFINITY
+        delta = Z * Z % p
+        gamma = Y * Y % p
+        beta = X * gamma % p
+        alpha = 3 * (X - delta) * (X + delta) % p
+        X3 = (alpha * alpha - 8 * beta) % p
+        Z3 = ((Y + Z) * (Y + Z) - gamma - delta) % p
+        Y3 = (alpha * (4 * beta - X3) - 8 * gamma * gamma) % p
+        return X3, Y3, Z3
+
+    def _add_affine(self, X1, Y1, Z1, x2, y2):
+        # madd: adds the affine point (x2, y2) to a Jacobian point
+        p = self.p
+        if not Z1:
+            return x2, y2, 1
+        Z1Z1 = Z1 * Z1 % p
+        H = (x2 * Z1Z1 - X1) % p
+        r = (y2 * Z1 * Z1Z1 - Y1) % p
+        if not H:
+            if not r:
+                return self._double(X1, Y1, Z1)
+            return _INFINITY
+        HH = H * H % p
+        HHH = H * HH % p
+        V = X1 * HH % p
+        X3 = (r * r - HHH - 2 * V) % p
+        Y3 = (r * (V - X3) - Y1 * HHH) % p
+        return X3, Y3, Z1 * H % p
+
+    def _to_affine(self, X, Y, Z):
+        if not Z:
+            return None
+        p = self.p
+        zinv = pow(Z, p - 2, p)
+        zinv2 = zinv * zinv % p
+        return X * zinv2 % p, Y * zinv2 * zinv % p
+
+    def _batch_to_affine(self, points):
+        # Montgomery's trick: one inversion for all the points
+        p = self.p
+        products = []
+        product = 1
+        for X, Y, Z in points:
+            products.append(product)
+            if Z:
+                product = product * Z % p
+        inverse = pow(product, p - 2, p)
+        affine = [None] * len(points)
+        for index in range(len(points) - 1, -1, -1):
+            X, Y, Z = points[index]
+            if not Z:
+                continue
+            zinv = inverse * products[index] % p
+            inverse = inverse * Z % p
+            zinv2 = zinv * zinv % p
+            affine[index] = X * zinv2 % p, Y * zinv2 * zinv % p
+        return affine
+
+    def _multiples(self, point):
+        # [None, point, 2 * point, ..., (2^width - 1) * point]
+        x, y = point
+        multiples = [(x, y, 1)]
+        for digit in range(2, 1 << self.width):
+            multiples.append(self._add_affine(*(multiples[-1] + point)))
+        return [None] + self._batch_to_affine(multiples)
+
+    def add(self, first, second):
+        """Returns first + second."""
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return self._to_affine(*self._add_affine(first[0], first[1], 1,
+                                                 second[0], second[1]))
+
+    def negate(self, point):
+        """Returns -point."""
+        if point is None:
+            return None
+        return point[0], (self.p - point[1]) % self.p
+
+    def multiply(self, point, scalar):
+        """Returns scalar * point, with a fixed window."""
+        scalar %= self.n
+        if point is None or not scalar:
+            return None
+        width = self.width
+        mask = (1 << width) - 1
+        table = self._multiples(point)
+        bits = 4 * len('%x' % scalar)
+        shift = (bits + width - 1) // width * width - width
+        X, Y, Z = _INFINITY
+        while shift >= 0:
+            for i in range(width):
+                X, Y, Z = self._double(X, Y, Z)
+            digit = (scalar >> shift) & mask
+            if digit:
+                x, y = table[digit]
+                X, Y, Z = self._add_affine(X, Y, Z, x, y)
+            shift -= width
+        return self._to_affine(X, Y, Z)
+
+    def _base_table(self):
+        table = self._g_table
+        if table is not None:
+            return table
+        self._lock.acquire()
+        try:
+            if self._g_table is None:
+                # row i holds the multiples of 2^(width*i) * g, so a
+                # multiplication is one addition per window, no doubling.
+                width = self.width
+                windows = (4 * len('%x' % self.n) + width - 1) // width
+                point = self.g
+                table = []
+                for i in range(windows):
+                    table.append(self._multiples(point))
+                    X, Y, Z = point + (1,)
+                    for j in range(width):
+                        X, Y, Z = self._double(X, Y, Z)
+                    point = self._to_affine(X, Y, Z)
+                self._g_table = table
+            return self._g_table
+        finally:
+            self._lock.release()
+
+    def base_multiply(self, scalar):
+        """Returns scalar * g."""
+        scalar %= self.n
+        table = self._base_table()
+        mask = (1 << self.width) - 1
+        X, Y, Z = _INFINITY
+        row = 0
+        while scalar:
+            digit = scalar & mask
+            if digit:
+                x, y = table[row][digit]
+                X, Y, Z = self._add_affine(X, Y, Z, x, y)
+            scalar >>= self.width
+            row += 1
+        return self._to_affine(X, Y, Z)
+
+    def point_to_string(self, point):
+        """Encodes a point in the uncompressed SEC1 format."""
+        if point is None:
+            raise InvalidPoint('The point at infinity has no encoding')
+        return ('\x04' + number_to_string(point[0], self.orderlen) +
+                number_to_string(point[1], self.orderlen))
+
+    def string_to_point(self, string):
+        """Decodes a point, and checks it's on the curve."""
+        size = self.orderlen
+        if len(string) != 1 + 2 * size or string[0] != '\x04':
+            raise InvalidPoint('Not an uncompressed point')
+        point = (string_to_number(string[1:1 + size]),
+                 string_to_number(string[1 + size:]))
+        if not self.contains(point):
+            raise InvalidPoint('The point is not on the curve')
+        return point
+
+    def encode(self, point):
+        """Encodes a point in hex, for the JSON messages."""
+        return binascii.hexlify(self.point_to_string(point))
+
+    def decode(self, encoded):
+        """Decodes a point encoded by encode()."""
+        try:
+            string = binascii.unhexlify(encoded)
+        except (TypeError, binascii.Error):
+            raise InvalidPoint('Not an hex string')
+        return self.string_to_point(string)
+
+
+P256 = Curve('P-256',
+    p=0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+    b=0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+    gx=0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+    gy=0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5,
+    n=0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551)
+
+CURVES = {P256.name: P256}
+
+
+def zkp_hash(curve, generator, gr, gx, signerid):
+    """Returns the challenge of a Schnorr proof."""
+    def _chunk(data):
+        return struct.pack('>I', len(data)) + data
+
+    data = ''.join([_chunk(curve.point_to_string(generator)),
+                    _chunk(curve.point_to_string(gr)),
+                    _chunk(curve.point_to_string(gx)),
+                    _chunk(signerid)])
+    return string_to_number(sha256(data).digest()) % curve.n
+
+
+def check_zkp(curve, generator, gx, zkp):
+    """Raises BadZeroKnowledgeProof unless zkp proves that its sender knows
+    x such that x * generator == gx."""
+    gr = curve.decode(zkp['gr'])
+    b = int(zkp['b'], 16)
+    h = zkp_hash(curve, generator, gr, gx, zkp['id'])
+    if generator == curve.g:
+        gb = curve.base_multiply(b)
+    else:
+        gb = curve.multiply(generator, b)
+    if curve.add(gb, curve.multiply(gx, h)) != gr:
+        raise BadZeroKnowledgeProof
+
+
+class ECJPAKE(object):
+    """One side of an EC-JPAKE exchange: one(), two() and three() are
+    called in turn with the messages of the other side, and three()
+    returns the shared key."""
+
+    def __init__(self, password, curve=P256, signerid=None, entropy=None):
+        if entropy is None:
+            entropy = os.urandom
+        self.entropy = entropy
+        if signerid is None:
+            signerid = binascii.hexlify(self.entropy(16))
+        self.signerid = signerid
+        self.curve = curve
+        n = curve.n
+        if isinstance(password, (int, long)):
+            assert 0 < password < n - 1
+            self.s = password
+        else:
+            assert isinstance(password, str)
+            self.s = 1 + string_to_number(sha256(password).digest()) % (n - 1)
+
+    def _scalar(self):
+        # [1, n)
+        return 1 + randrange(self.curve.n - 1, self.entropy)
+
+    def createZKP(self, generator, exponent, gx):
+        """Proves we know exponent, such that exponent * generator == gx."""
+        curve = self.curve
+        r = self._scalar()
+        if generator == curve.g:
+            gr = curve.base_multiply(r)
+        else:
+            gr = curve.multiply(generator, r)
+        h = zkp_hash(curve, generator, gr, gx, self.signerid)
+        b = (r - exponent * h) % curve.n
+        return {'gr': curve.encode(gr), 'b': '%x' % b, 'id': self.signerid}
+
+    def checkZKP(self, generator, gx, zkp):
+        if zkp['id'] == self.signerid:
+            raise DuplicateSignerID
+        check_zkp(self.curve, generator, gx, zkp)
+
+    def one(self):
+        curve = self.curve
+        self.x1 = self._scalar()
+        self.x2 = self._scalar()
+        self.gx1 = curve.base_multiply(self.x1)
+        self.gx2 = curve.base_multiply(self.x2)
+        return {'gx1': curve.encode(self.gx1),
+                'gx2': curve.encode(self.gx2),
+                'zkp_x1': self.createZKP(curve.g, self.x1, self.gx1),
+                'zkp_x2': self.createZKP(curve.g, self.x2, self.gx2)}
+
+    def two(self, m1):
+        curve = self.curve
+        self.gx3 = curve.decode(m1['gx1'])
+        self.gx4 = curve.decode(m1['gx2'])
+        self.checkZKP(curve.g, self.gx3, m1['zkp_x1'])
+        self.checkZKP(curve.g, self.gx4, m1['zkp_x2'])
+        # A = (x2 * s) * (gx1 + gx3 + gx4)
+        generator = curve.add(curve.add(self.gx1, self.gx3), self.gx4)
+        if generator is None:
+            raise JPAKEError('gx1 + gx3 + gx4 is the point at infinity')
+        xs = self.x2 * self.s % curve.n
+        A = curve.multiply(generator, xs)
+        return {'A': curve.encode(A),
+                'zkp_A': self.createZKP(generator, xs, A)}
+
+    def three(self, m2):
+        curve = self.curve
+        B = curve.decode(m2['A'])
+        generator = curve.add(curve.add(self.gx1, self.gx2), self.gx3)
+        if generator is None:
+            raise JPAKEError('gx1 + gx2 + gx3 is the point at infinity')
+        self.checkZKP(generator, B, m2['zkp_A'])
+        # K = x2 * (B - (x2 * s) * gx4)
+        xs = self.x2 * self.s % curve.n
+        K = curve.multiply(curve.add(B, curve.multiply(self.gx4, -xs)),
+                           self.x2)
+        if K is None:
+            raise JPAKEError('K is the point at infinity')
+        self.K = K
+        return sha256(number_to_string(K[0], curve.orderlen)).digest()
+
+    def to_json(self):
+        data = {'signerid': self.signerid, 'curve': self.curve.name,
+                's': self.s}
+        for name in ('x1', 'x2'):
+            value = getattr(self, name, None)
+            data[name] = value is not None and '%x' % value or None
+        for name in ('gx1', 'gx2', 'gx3', 'gx4'):
+            value = getattr(self, name, None)
+            data[name] = value is not None and self.curve.encode(value) or None
+        return data
+
+    @classmethod
+    def from_json(klass, data, entropy=None):
+        curve = CURVES[data['curve']]
+        self = klass(data['s'], curve=curve, signerid=data['signerid'],
+                     entropy=entropy)
+        for name in ('x1', 'x2'):
+            if data[name]:
+                setattr(self, name, int(data[name], 16))
+        for name in ('gx1', 'gx2', 'gx3', 'gx4'):
+            if data[name]:
+                setattr(self, name, curve.decode(data[name]))
+        return self
@@ -0,0 +1,214 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import json
+import random
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from keyexchange.bench import (percentile, summarize, measure, dump,
+                               environment)
+from keyexchange.bench.results import (mann_whitney, compare, save, load,
+                                       runs, bootstrap_percentile)
+from keyexchange.bench import crypto
+
+
+class TestBench(unittest.TestCase):
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile(samples, 100), 100)
+        self.assertEqual(percentile([3], 99.9), 3)
+        self.assertEqual(percentile([], 50), 0.)
+
+    def test_summarize(self):
+        res = summarize([.001, .003, .002, .002])
+        self.assertEqual(res['count'], 4)
+        self.assertEqual(res['ops_per_sec'], 500.)
+        self.assertEqual(res['mean'], 2000.)
+        self.assertEqual(res['min'], 1000.)
+        self.assertEqual(res['max'], 3000.)
+        self.assertEqual(res['unit'], 'us')
+        self.assertEqual(summarize([.5], unit='ms')['p50'], 500.)
+
+    def test_measure(self):
+        calls = []
+        prepared = []
+
+        def prepare():
+            prepared.append(len(prepared))
+            return prepared[-1]
+
+        samples = measure(calls.append, 10, warmup=5, prepare=prepare)
+        self.assertEqual(len(samples), 10)
+        self.assertEqual(calls, range(15))
+
+    def test_dump(self):
+        stream = StringIO()
+        dump({'b': 1, 'a': {'d': 2, 'c': 3}}, stream)
+        output = stream.getvalue()
+        self.assertTrue(output.index('"a"') < output.index('"b"'))
+        self.assertTrue(output.index('"c"') < output.index('"d"'))
+        self.assertEqual(json.loads(output)['a']['c'], 3)
+
+
+class TestResults(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_crypto_report(self):
+        def summary(mean):
+            return summarize([mean / 1000000.] * 3)
+
+        results = {'results': {'params_80': {'one': summary(100),
+                                             'two': summary(250),
+                                             'three': summary(150),
+                                             'table_build': 12.5}}}
+        stream = StringIO()
+        crypto.report(results, stream)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0].split()[:3],
+                         ['params', 'operation', 'ops/sec'])
+        self.assertEqual(lines[1].split()[:3],
+                         ['params_80', 'one', '10000.0'])
+        self.assertEqual(len(lines), 7)
+        # each side runs the three steps: 1s / 1ms
+        self.assertEqual(lines[-1], 'params_80    1000.0 pairings/sec per CPU')
+
+    def test_app(self):
+        from keyexchange.bench import app
+        self.assertRaises(ValueError, app.run, ['new_channel'], 0)
+        results = app.run(['new_channel'], iterations=1, warmup=0)
+        new_channel = results['results']['new_channel']
+        self.assertEqual(new_channel['count'], 1)
+        self.assertTrue(new_channel['cache_calls'] > 0)
+
+    def test_mann_whitney(self):
+        # checked against scipy.stats.mannwhitneyu
+        first = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        second = [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+        u, pvalue = mann_whitney(first, second)
+        self.assertEqual(u, 18)
+        self.assertAlmostEqual(pvalue, 0.010016, 5)
+
+        u, pvalue = mann_whitney(first, first)
+        self.assertEqual(u, 50)
+        self.assertAlmostEqual(pvalue, 1.)
+        self.assertRaises(ValueError, mann_whitney, [], first)
+
+    def test_bootstrap_percentile(self):
+        rand = random.Random(0)
+        first = [rand.gauss(50, 5) for i in range(200)]
+        self.assertEqual(bootstrap_percentile(first, first), 1.)
+        self.assertTrue(bootstrap_percentile(first, first[:100]) > .01)
+        # only the tail moved
+        second = sorted(first)
+        second[-10:] = [value + 100 for value in second[-10:]]
+        self.assertTrue(mann_whitney(first, second)[1] > .01)
+        self.assertTrue(bootstrap_percentile(first, second) < .01)
+        self.assertRaises(ValueError, bootstrap_percentile, [], first)
+
+    def _results(self, p99=100., ops=1000., cache_calls=2., shift=0):
+        rand = random.Random(shift)
+        samples = [rand.gauss(50 + shift, 5) for i in range(200)]
+        summary = {'count': 200, 'p99': p99, 'ops_per_sec': ops,
+                   'cache_calls': cache_calls, 'samples': samples}
+        return {'benchmark': 'app', 'config': {'iterations': 200},
+                'environment': environment(),
+                'results': {'put': summary}}
+
+    def _statuses(self, metrics):
+        return dict([(metric['name'], metric['status'])
+                     for metric in metrics])
+
+    def test_compare(self):
+        warnings, metrics = compare(self._results(), self._results())
+        self.assertEqual(warnings, [])
+        self.assertEqual(self._statuses(metrics),
+                         {'ops_per_sec': 'same', 'p99': 'same',
+                          'cache_calls': 'same'})
+
+        # a real slowdown
+        warnings, metrics = compare(self._results(),
+                                    self._results(200., 500., 3., 20))
+        self.assertEqual(self._statuses(metrics),
+                         {'ops_per_sec': 'regression', 'p99': 'regression',
+                          'cache_calls': 'regression'})
+
+        # the same distributions: the p99 difference is noise
+        warnings, metrics = compare(self._results(), self._results(200.))
+        self.assertEqual(self._statuses(metrics)['p99'], 'same')
+
+        # without the samples, the thresholds decide
+        old = self._results()
+        new = self._results(200.)
+        del old['results']['put']['samples']
+        warnings, metrics = compare(old, new)
+        self.assertEqual(self._statuses(metrics)['p99'], 'regression')
+
+        # a slower tail, the rest of the distribution is the same
+        new = self._results(200.)
+        samples = sorted(new['results']['put']['samples'])
+        samples[-10:] = [value + 100 for value in samples[-10:]]
+        new['results']['put']['samples'] = samples
+        warnings, metrics = compare(self._results(), new)
+        self.assertEqual(self._statuses(metrics),
+                         {'ops_per_sec': 'same', 'p99': 'regression',
+                          'cache_calls': 'same'})
+
+    def test_compare_warnings(self):
+        new = self._results()
+        new['config']['iterations'] = 300
+        new['environment']['fingerprint'] = 'other'
+        warnings, metrics = compare(self._results(), new)
+        self.assertEqual(len(warnings), 2)
+
+    def test_save(self):
+        first = save(self._results(), self.dir)
+        second = save(self._results(), self.dir)
+        self.assertNotEqual(first, second)
+        self.assertEqual(runs(self.dir), [first, second])
+        self.assertEqual(runs(self.dir, 'loadgen'), [])
+        saved = load(first)
+        self.assertTrue('revision' in saved)
+        self.assertEqual(saved['benchmark'], 'app')
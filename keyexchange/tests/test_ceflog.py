@@ -0,0 +1,191 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import threading
+import time
+
+from keyexchange.ceflog import AsyncCEFLogger, CEFAggregator
+
+
+class TestAsyncCEFLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.logs = []
+        self.blocker = threading.Event()
+        self.blocker.set()
+
+    def _log(self, name, severity, environ, config, *args, **kw):
+        self.blocker.wait()
+        self.logs.append((name, environ, kw))
+
+    def test_logging(self):
+        logger = AsyncCEFLogger(log=self._log, interval=.1)
+        logger.start()
+        environ = {'REMOTE_ADDR': '127.0.0.1', 'wsgi.input': None}
+        for i in range(10):
+            logger.log_cef('Report', 5, environ, {}, msg=str(i))
+        logger.join()
+
+        # everything was written, in order
+        self.assertEqual([kw['msg'] for name, env, kw in self.logs],
+                         [str(i) for i in range(10)])
+
+        # only the keys needed by CEF are kept from the environ
+        self.assertEqual(self.logs[0][1], {'REMOTE_ADDR': '127.0.0.1'})
+        stats = logger.stats()
+        self.assertEqual(stats['written'], 10)
+        self.assertEqual(stats['dropped'], 0)
+        self.assertEqual(stats['queued'], 0)
+
+    def test_drop(self):
+        # the writer is stuck, so the queue fills up
+        self.blocker.clear()
+        logger = AsyncCEFLogger(maxsize=5, batch_size=1, log=self._log,
+                                interval=.1)
+        logger.start()
+        for i in range(20):
+            logger.log_cef('Report', 5, {}, {}, msg=str(i))
+
+        stats = logger.stats()
+        self.assertEqual(stats['queued'], 5)
+        # one record may already be in the writer's hands
+        self.assertTrue(stats['dropped'] in (14, 15))
+
+        self.blocker.set()
+        logger.join()
+        self.assertEqual(len(self.logs), 20 - logger.dropped)
+
+    def test_errors(self):
+        def _log(*args, **kw):
+            raise IOError()
+
+        logger = AsyncCEFLogger(log=_log, interval=.1)
+        logger.start()
+        logger.log_cef('Report', 5, {}, {}, msg='1')
+        logger.join()
+        self.assertEqual(logger.stats()['errors'], 1)
+        self.assertRaises(ValueError, AsyncCEFLogger, overflow='wait')
+
+
+class TestCEFAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.logs = []
+
+    def _log(self, name, severity, environ, config, *args, **kw):
+        self.logs.append((name, environ.get('REMOTE_ADDR'), kw))
+
+    def test_aggregation(self):
+        aggregator = CEFAggregator(self._log, window=.5)
+        bad_guy = {'REMOTE_ADDR': 'bad_guy'}
+        other = {'REMOTE_ADDR': 'other'}
+
+        for i in range(100):
+            aggregator.log_cef('Invalid X-KeyExchange-Id', 5, bad_guy, {},
+                               msg=str(i))
+        aggregator.log_cef('Invalid X-KeyExchange-Id', 5, other, {},
+                           msg='other')
+        aggregator.log_cef('Report', 5, bad_guy, {}, msg='report')
+
+        # other signatures are not aggregated
+        for i in range(3):
+            aggregator.log_cef('Could not delete the channel', 5, bad_guy,
+                               {}, msg='cid')
+
+        # only the first event for each signature and IP was logged
+        self.assertEqual(len(self.logs), 6)
+        self.assertEqual(self.logs[0][2], {'msg': '0'})
+
+        # once the window is over, we get a summary
+        time.sleep(.6)
+        aggregator.tick()
+        self.assertEqual(len(self.logs), 7)
+        name, ip, kw = self.logs[-1]
+        self.assertEqual((name, ip), ('Invalid X-KeyExchange-Id', 'bad_guy'))
+        self.assertEqual(kw, {'msg': '99', 'cnt': 100})
+
+        # and the next event starts a new window
+        aggregator.log_cef('Invalid X-KeyExchange-Id', 5, bad_guy, {},
+                           msg='new')
+        self.assertEqual(self.logs[-1][2], {'msg': 'new'})
+
+    def test_max_keys(self):
+        aggregator = CEFAggregator(self._log, max_keys=10)
+        for i in range(11):
+            env = {'REMOTE_ADDR': str(i)}
+            aggregator.log_cef('BlackListed IP', 5, env, {}, msg=str(i))
+            aggregator.log_cef('BlackListed IP', 5, env, {}, msg=str(i))
+
+        # the 11th ip is not tracked, so both its events were logged
+        self.assertEqual(len(self.logs), 10 + 2)
+        self.assertEqual(len(aggregator._events), 10)
+
+        # the next tick closes the window early
+        aggregator.tick()
+        self.assertEqual(len(self.logs), 10 + 2 + 10)
+        self.assertEqual(len(aggregator._events), 0)
+
+    def test_async(self):
+        aggregator = CEFAggregator(window=.2)
+        logger = AsyncCEFLogger(log=self._log, interval=.1,
+                                periodic=aggregator.tick)
+        aggregator._log = logger.log_cef
+        logger.start()
+        try:
+            for i in range(10):
+                aggregator.log_cef('Report', 5, {'REMOTE_ADDR': 'ip'}, {},
+                                   msg=str(i))
+            # the writer closes the window by itself
+            time.sleep(.5)
+        finally:
+            logger.join()
+
+        self.assertEqual([kw for name, ip, kw in self.logs],
+                         [{'msg': '0'}, {'msg': '9', 'cnt': 10}])
+
+    def test_needs_async(self):
+        # the requests would write the summaries themselves
+        from keyexchange.wsgiapp import KeyExchangeApp
+        config = {'keyexchange.use_memory': True,
+                  'keyexchange.health_frequency': 0, 'cef.aggregate': True}
+        self.assertRaises(ValueError, KeyExchangeApp, config)
+        config['cef.async'] = True
+        app = KeyExchangeApp(config)
+        try:
+            self.assertEqual(app.cef_logger.periodic,
+                             app.cef_aggregator.tick)
+        finally:
+            app.close()
@@ -0,0 +1,373 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import random
+import threading
+import time
+
+from keyexchange.tests import client
+from keyexchange.tests.client import (JPAKE, Params, FixedBaseTable,
+                                      get_fixed_base_table, multi_exp,
+                                      batch_check_zkps, check_zkp, zkp_hash,
+                                      BadZeroKnowledgeProof,
+                                      DuplicateSignerID, RoundOnePool,
+                                      pack_fields, unpack_fields,
+                                      get_backend, set_backend, BACKENDS,
+                                      params_80, params_112, params_128)
+
+
+class _PythonBackend(unittest.TestCase):
+
+    def setUp(self):
+        # the tables are used by the python backend
+        self.backend = client.backend
+        set_backend('python')
+
+    def tearDown(self):
+        client.backend = self.backend
+
+
+class TestFixedBase(_PythonBackend):
+
+    def test_gpow(self):
+        for params in (params_80, params_112, params_128):
+            exponents = [0, 1, 2, params.q - 1]
+            exponents += [random.randrange(params.q) for i in range(20)]
+            for exponent in exponents:
+                self.assertEqual(params.gpow(exponent),
+                                 pow(params.g, exponent, params.p))
+
+    def test_out_of_range(self):
+        table = FixedBaseTable(3, 1019, 8, width=3)
+        for exponent in range(0, 2000, 7):
+            self.assertEqual(table.pow(exponent), pow(3, exponent, 1019))
+
+    def test_shared(self):
+        # Params rebuilt from the same values share the table
+        params = Params(params_80.p, params_80.q, params_80.g)
+        self.assertEqual(params.gpow(12345), params_80.gpow(12345))
+        self.assertTrue(params._g_table[1] is params_80._g_table[1])
+
+    def test_threads(self):
+        # a single table is built, even by concurrent threads
+        params = Params(1019, 509, 4)
+        key = (params.p, params.g)
+        tables = []
+
+        def _gpow():
+            params.gpow(5)
+            tables.append(get_fixed_base_table(params.g, params.p, params.q))
+
+        threads = [threading.Thread(target=_gpow) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(tables), 10)
+        for table in tables:
+            self.assertTrue(table is client._tables[key])
+
+    def test_exchange(self):
+        for params in (params_80, params_112):
+            sender = JPAKE('secret', params=params, signerid='sender')
+            receiver = JPAKE('secret', params=params, signerid='receiver')
+            sender_one = sender.one()
+            receiver_one = receiver.one()
+            sender_two = sender.two(receiver_one)
+            receiver_two = receiver.two(sender_one)
+            self.assertEqual(sender.three(receiver_two),
+                             receiver.three(sender_two))
+
+            # a wrong password gives different keys
+            sender = JPAKE('secret', params=params, signerid='sender')
+            receiver = JPAKE('other', params=params, signerid='receiver')
+            sender_one = sender.one()
+            receiver_one = receiver.one()
+            sender_two = sender.two(receiver_one)
+            receiver_two = receiver.two(sender_one)
+            self.assertNotEqual(sender.three(receiver_two),
+                                receiver.three(sender_two))
+
+
+class TestMultiExp(_PythonBackend):
+
+    def test_multi_exp(self):
+        p = params_80.p
+        self.assertEqual(multi_exp([], p), 1)
+        for i in range(50):
+            pairs = [(random.randrange(p), random.randrange(params_80.q))
+                     for j in range(random.randint(1, 4))]
+            expected = 1
+            for base, exponent in pairs:
+                expected = (expected * pow(base, exponent, p)) % p
+            self.assertEqual(multi_exp(pairs, p), expected)
+        self.assertEqual(multi_exp([(5, 0), (7, 0)], p), 1)
+        self.assertRaises(ValueError, multi_exp, [(5, -1)], p)
+
+    def test_check_zkp(self):
+        prover = JPAKE('secret', signerid='prover')
+        verifier = JPAKE('secret', signerid='verifier')
+        for generator in (params_80.g, params_80.gpow(12345)):
+            x = random.randrange(params_80.q)
+            gx = pow(generator, x, params_80.p)
+            zkp = prover.createZKP(generator, x, gx)
+            verifier.checkZKP(generator, gx, zkp)
+
+            # a proof for another value
+            self.assertRaises(BadZeroKnowledgeProof, verifier.checkZKP,
+                              generator, (gx * generator) % params_80.p,
+                              zkp)
+
+
+class TestBatchZKPs(_PythonBackend):
+
+    def _proofs(self, count, params=params_80):
+        prover = JPAKE('secret', params=params, signerid='prover')
+        generator = params.gpow(random.randrange(params.q))
+        proofs = []
+        for i in range(count):
+            if i % 2:
+                base = generator
+            else:
+                base = params.g
+            x = random.randrange(params.q)
+            gx = pow(base, x, params.p)
+            proofs.append((base, gx, prover.createZKP(base, x, gx)))
+        return proofs
+
+    def test_batch_check_zkps(self):
+        proofs = self._proofs(20)
+        batch_check_zkps(params_80, proofs, 'verifier')
+        batch_check_zkps(params_80, [], 'verifier')
+
+        # the bad proofs are found
+        for bad in ([3], [0, 7, 19]):
+            proofs = self._proofs(20)
+            for index in bad:
+                generator, gx, zkp = proofs[index]
+                proofs[index] = generator, (gx * 2) % params_80.p, zkp
+            try:
+                batch_check_zkps(params_80, proofs, 'verifier')
+            except BadZeroKnowledgeProof, e:
+                self.assertEqual(e.indexes, bad)
+            else:
+                raise AssertionError('Bad proof not detected')
+
+        # we don't accept our own proofs
+        self.assertRaises(DuplicateSignerID, batch_check_zkps, params_80,
+                          self._proofs(2), 'prover')
+
+    def test_small_order_component(self):
+        # gr is multiplied by -1, of order 2, and the proof is made for it
+        p, q, g = params_80.p, params_80.q, params_80.g
+        x = random.randrange(q)
+        gx = params_80.gpow(x)
+        for i in range(20):
+            r = random.randrange(q)
+            gr = p - params_80.gpow(r)
+            h = zkp_hash(g, gr, gx, 'prover')
+            zkp = {'gr': '%x' % gr, 'b': '%x' % ((r - x * h) % q),
+                   'id': 'prover'}
+            self.assertRaises(BadZeroKnowledgeProof, check_zkp, params_80,
+                              g, gx, zkp)
+            proofs = self._proofs(3)
+            proofs.insert(1, (g, gx, zkp))
+            try:
+                batch_check_zkps(params_80, proofs, 'verifier')
+            except BadZeroKnowledgeProof, e:
+                self.assertEqual(e.indexes, [1])
+            else:
+                raise AssertionError('Bad proof not detected')
+
+
+class TestRoundOnePool(_PythonBackend):
+
+    def _wait_for(self, pool, count):
+        for i in range(500):
+            if pool.stats()['available'] >= count:
+                return
+            time.sleep(.01)
+        raise AssertionError('The pool was not filled')
+
+    def test_round_one_pool(self):
+        for processes in (0, 2):
+            pool = RoundOnePool(params_80, size=4, processes=processes,
+                                batch=2)
+            pool.start()
+            try:
+                self._wait_for(pool, 4)
+                # bounded
+                time.sleep(.05)
+                self.assertEqual(pool.stats()['available'], 4)
+
+                sender = JPAKE('secret', signerid='sender', pool=pool)
+                receiver = JPAKE('secret', signerid='receiver', pool=pool)
+                sender_one = sender.one()
+                receiver_one = receiver.one()
+                self.assertEqual(pool.hits, 2)
+                # each state is used once
+                self.assertNotEqual(sender.x1, receiver.x1)
+                self.assertEqual(sender.gx1, params_80.gpow(sender.x1))
+                sender_two = sender.two(receiver_one)
+                receiver_two = receiver.two(sender_one)
+                self.assertEqual(sender.three(receiver_two),
+                                 receiver.three(sender_two))
+            finally:
+                pool.join()
+            self.assertFalse(pool.isAlive())
+
+        # an empty pool falls back on the inline computation
+        pool = RoundOnePool(params_80)
+        sender = JPAKE('secret', signerid='sender', pool=pool)
+        receiver = JPAKE('secret', signerid='receiver', pool=pool)
+        sender_one = sender.one()
+        receiver_one = receiver.one()
+        self.assertEqual(pool.stats()['misses'], 2)
+        sender_two = sender.two(receiver_one)
+        receiver_two = receiver.two(sender_one)
+        self.assertEqual(sender.three(receiver_two),
+                         receiver.three(sender_two))
+
+
+class TestPacking(_PythonBackend):
+
+    def test_pack(self):
+        # fixed-width fields, leading zeros included
+        packed = pack_fields(['1', 'abcd', '00ff'], 'id', 2)
+        self.assertEqual(packed, '\x00\x01\xab\xcd\x00\xffid')
+        self.assertEqual(unpack_fields(packed, 3, 2),
+                         (['0001', 'abcd', '00ff'], 'id'))
+        self.assertRaises(AssertionError, pack_fields, ['12345'], '', 2)
+        self.assertRaises(AssertionError, unpack_fields, '\x00\x01', 2, 2)
+
+        for params in (params_80, params_128):
+            sender = JPAKE('secret', params=params, signerid='sender')
+            receiver = JPAKE('secret', params=params, signerid='receiver')
+            sender_one = sender.one()
+            packed = sender.pack_one(sender_one)
+            self.assertEqual(len(packed), 6 * params.orderlen + 6)
+            unpacked = receiver.unpack_one(packed)
+            self.assertEqual(unpacked['zkp_x2']['id'], 'sender')
+            for name in ('gx1', 'gx2'):
+                self.assertEqual(int(unpacked[name], 16),
+                                 int(sender_one[name], 16))
+            receiver_one = receiver.unpack_one(
+                receiver.pack_one(receiver.one()))
+            sender_two = sender.two(receiver_one)
+            receiver_two = receiver.two(unpacked)
+            unpacked = receiver.unpack_two(sender.pack_two(sender_two))
+            self.assertEqual(int(unpacked['A'], 16),
+                             int(sender_two['A'], 16))
+            self.assertEqual(
+                sender.three(sender.unpack_two(
+                    receiver.pack_two(receiver_two))),
+                receiver.three(unpacked))
+
+
+def _backends():
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(get_backend(name))
+        except ImportError:
+            pass
+    return backends
+
+
+def _entropy(seed):
+    rnd = random.Random(seed)
+
+    def entropy(size):
+        return ''.join([chr(rnd.randrange(256)) for i in range(size)])
+    return entropy
+
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = client.backend
+
+    def tearDown(self):
+        client.backend = self.backend
+
+    def test_select(self):
+        # the first importable one is the default
+        self.assertEqual(set_backend().name, _backends()[0].name)
+        self.assertEqual(set_backend('python').name, 'python')
+        self.assertTrue(client.backend is not self.backend)
+        self.assertRaises(ValueError, set_backend, 'bc')
+
+    def test_operations(self):
+        reference = get_backend('python')
+        rnd = random.Random(1)
+        for backend in _backends():
+            for params in (params_80, params_128):
+                p = params.p
+                q = params.q
+                table = backend.fixed_base(params.g, p, q)
+                for i in range(5):
+                    base = rnd.randrange(p)
+                    exponent = rnd.randrange(q)
+                    self.assertEqual(backend.powmod(base, exponent, p),
+                                     pow(base, exponent, p))
+                    self.assertEqual(table.pow(exponent),
+                                     pow(params.g, exponent, p))
+                    pairs = [(rnd.randrange(p), rnd.randrange(q))
+                             for j in range(3)]
+                    self.assertEqual(backend.multi_exp(pairs, p),
+                                     reference.multi_exp(pairs, p))
+                self.assertEqual(backend.randrange(q, _entropy(2)),
+                                 reference.randrange(q, _entropy(2)))
+            self.assertRaises(TypeError, backend.powmod, 2, -1, 7)
+            self.assertRaises(ValueError, backend.multi_exp, [(2, -1)], 7)
+
+    def test_exchange(self):
+        # the same entropy gives the same messages and keys
+        exchanges = []
+        for backend in _backends():
+            set_backend(backend.name)
+            sender = JPAKE('secret', params=params_80, signerid='sender',
+                           entropy=_entropy(3))
+            receiver = JPAKE('secret', params=params_80,
+                             signerid='receiver', entropy=_entropy(4))
+            messages = [sender.one(), receiver.one()]
+            messages += [sender.two(messages[1]), receiver.two(messages[0])]
+            key = sender.three(messages[3])
+            self.assertEqual(key, receiver.three(messages[2]))
+            exchanges.append((messages, key))
+        for exchange in exchanges[1:]:
+            self.assertEqual(exchange, exchanges[0])
+
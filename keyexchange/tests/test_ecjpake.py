@@ -0,0 +1,165 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+from hashlib import sha256
+
+from keyexchange.tests.client import (JPAKEError, DuplicateSignerID,
+                                      BadZeroKnowledgeProof)
+from keyexchange.tests.ecjpake import ECJPAKE, P256, InvalidPoint
+
+
+# scalar, k * g computed with OpenSSL
+_VECTORS = (
+    (2, '047cf27b188d034f7e8a52380304b51ac3c08969e277f21b35a60b48fc4766997807'
+        '775510db8ed040293d9ac69f7430dbba7dade63ce982299e04b79d227873d1'),
+    (P256.n - 1,
+        '046b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296b0'
+        '1cbd1c01e58065711814b583f061e9d431cca994cea1313449bf97c840ae0a'),
+    (0x1e2feb89414c343c1027c4d1c386bbc4cd613e30d8f16adf91b7584a2265b1f6,
+        '04696d724d9ca18306d21e5849dd0b45cdbdad0a5878e8ee1f9679d49d1b524d54bf'
+        'c64470f942da1519a5fb5dc6ad02f74ef14871c50069c912356f661336fac7'))
+
+# the key of an exchange with the secrets below, from the K computed with
+# OpenSSL as ((x1 + x3) * x4 * x2 * s) * g
+_SECRETS = [int(sha256('x%d' % i).hexdigest(), 16) % P256.n
+            for i in range(1, 5)]
+_KEY = '524d8e437195e072bb930b6cb395466a0e63c3563f8fdd518c187cd605830062'
+
+
+def _state(signerid, x1, x2):
+    return ECJPAKE.from_json({'signerid': signerid, 'curve': 'P-256',
+                              's': 1 + (int(sha256('password').hexdigest(),
+                                            16) % (P256.n - 1)),
+                              'x1': '%x' % x1, 'x2': '%x' % x2,
+                              'gx1': P256.encode(P256.base_multiply(x1)),
+                              'gx2': P256.encode(P256.base_multiply(x2)),
+                              'gx3': None, 'gx4': None})
+
+
+def _one(pake):
+    # the round one message of a given state
+    g = P256.g
+    return {'gx1': P256.encode(pake.gx1), 'gx2': P256.encode(pake.gx2),
+            'zkp_x1': pake.createZKP(g, pake.x1, pake.gx1),
+            'zkp_x2': pake.createZKP(g, pake.x2, pake.gx2)}
+
+
+def _exchange(sender, receiver):
+    sender_one = sender.one()
+    receiver_one = receiver.one()
+    sender_two = sender.two(receiver_one)
+    receiver_two = receiver.two(sender_one)
+    return sender.three(receiver_two), receiver.three(sender_two)
+
+
+class TestECJPAKE(unittest.TestCase):
+
+    def test_vectors(self):
+        g = P256.g
+        self.assertTrue(P256.contains(g))
+        self.assertEqual(P256.multiply(g, P256.n), None)
+        self.assertEqual(P256.base_multiply(P256.n), None)
+        for scalar, expected in _VECTORS:
+            self.assertEqual(P256.encode(P256.base_multiply(scalar)),
+                             expected)
+            self.assertEqual(P256.encode(P256.multiply(g, scalar)), expected)
+            self.assertEqual(P256.decode(expected),
+                             P256.base_multiply(scalar))
+
+        point = P256.base_multiply(12345)
+        self.assertEqual(P256.add(point, P256.negate(point)), None)
+        self.assertEqual(P256.add(point, point), P256.multiply(point, 2))
+        self.assertEqual(P256.multiply(point, -1), P256.negate(point))
+
+    def test_known_key(self):
+        x1, x2, x3, x4 = _SECRETS
+        sender = _state('sender', x1, x2)
+        receiver = _state('receiver', x3, x4)
+        sender_two = sender.two(_one(receiver))
+        receiver_two = receiver.two(_one(sender))
+        self.assertEqual(sender.three(receiver_two).encode('hex'), _KEY)
+        self.assertEqual(receiver.three(sender_two).encode('hex'), _KEY)
+
+    def test_exchange(self):
+        sender = ECJPAKE('secret', signerid='sender')
+        receiver = ECJPAKE('secret', signerid='receiver')
+        key, other = _exchange(sender, receiver)
+        self.assertEqual(key, other)
+        self.assertEqual(len(key), 32)
+
+        sender = ECJPAKE('secret', signerid='sender')
+        receiver = ECJPAKE('other', signerid='receiver')
+        key, other = _exchange(sender, receiver)
+        self.assertNotEqual(key, other)
+
+    def test_json(self):
+        sender = ECJPAKE('secret', signerid='sender')
+        receiver = ECJPAKE('secret', signerid='receiver')
+        sender_one = sender.one()
+        receiver_one = receiver.one()
+        # the states are saved and restored between the steps
+        sender = ECJPAKE.from_json(sender.to_json())
+        receiver = ECJPAKE.from_json(receiver.to_json())
+        sender_two = sender.two(receiver_one)
+        receiver_two = receiver.two(sender_one)
+        sender = ECJPAKE.from_json(sender.to_json())
+        receiver = ECJPAKE.from_json(receiver.to_json())
+        self.assertEqual(sender.three(receiver_two),
+                         receiver.three(sender_two))
+
+    def test_bad_messages(self):
+        sender = ECJPAKE('secret', signerid='sender')
+        receiver = ECJPAKE('secret', signerid='receiver')
+        sender_one = sender.one()
+
+        # echoing our own message back
+        self.assertRaises(DuplicateSignerID, sender.two, sender_one)
+
+        # a proof for another point
+        bad = dict(sender_one)
+        bad['zkp_x2'] = sender_one['zkp_x1']
+        self.assertRaises(BadZeroKnowledgeProof, receiver.two, bad)
+
+        # points off the curve
+        bad = dict(sender_one)
+        x, y = P256.decode(bad['gx1'])
+        bad['gx1'] = '04%064x%064x' % (x, (y + 1) % P256.p)
+        self.assertRaises(InvalidPoint, receiver.two, bad)
+        bad['gx1'] = '02%064x' % x
+        self.assertRaises(InvalidPoint, receiver.two, bad)
+        bad['gx1'] = 'zz'
+        self.assertRaises(InvalidPoint, receiver.two, bad)
+        self.assertTrue(issubclass(InvalidPoint, JPAKEError))
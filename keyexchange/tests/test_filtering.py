@@ -347,3 +347,125 @@ class TestIPFiltering(unittest.TestCase):
         # but we don't want to callback in case the ip is
         # blacklisted in observe mode
         self.assertEqual(count[0], 1)
+
+    def test_queue_backend(self):
+        app = IPFiltering(FakeApp(), queue_size=10, blacklist_ttl=.5,
+                          treshold=5, use_memory=True,
+                          queue_backend='compact')
+        app = TestApp(app)
+        env = {'REMOTE_ADDR': '193.0.0.1'}
+        for i in range(5):
+            app.get('/', status=200, extra_environ=env)
+        app.get('/', status=403, extra_environ=env)
+
+        self.assertRaises(ValueError, IPFiltering, FakeApp(),
+                          use_memory=True, queue_backend='fifo')
+
+    def test_token_bucket(self):
+        app = IPFiltering(FakeApp(), blacklist_ttl=.5, use_memory=True,
+                          limiter='token_bucket', rate=1, burst=5)
+        blacklisted = []
+        app.callback = lambda ip, environ: blacklisted.append(ip)
+        app = TestApp(app)
+        env = {'REMOTE_ADDR': '193.0.0.1'}
+        for i in range(5):
+            app.get('/', status=200, extra_environ=env)
+        self.assertEqual(blacklisted, [])
+
+        # the sixth call goes over the rate
+        app.get('/', status=200, extra_environ=env)
+        self.assertEqual(blacklisted, ['193.0.0.1'])
+        app.get('/', status=403, extra_environ=env)
+
+        self.assertRaises(ValueError, IPFiltering, FakeApp(),
+                          use_memory=True, limiter='leaky_bucket')
+
+    def test_blacklist_stripes(self):
+        blacklist = Blacklist(MemoryClient(None), stripes=4, async=False)
+        now = time.time()
+        blacklist.add('ip1')
+        blacklist.add('ip2', .3)
+        blacklist.add('ip3', 10)
+        snapshot = blacklist.snapshot()
+        self.assertEqual(sorted(snapshot), ['ip1', 'ip2', 'ip3'])
+        self.assertEqual(snapshot['ip1'], None)
+        self.assertTrue(now + 10 <= snapshot['ip3'] <= time.time() + 10)
+
+        time.sleep(.4)
+        self.assertEqual(sorted(blacklist.snapshot()), ['ip1', 'ip3'])
+        self.assertFalse('ip2' in blacklist)
+        self.assertTrue('ip3' in blacklist)
+        blacklist.remove('ip3')
+        self.assertFalse('ip3' in blacklist)
+
+        blacklist = cPickle.loads(cPickle.dumps(blacklist))
+        self.assertEqual(len(blacklist._locks), 4)
+        self.assertTrue('ip1' in blacklist)
+
+        # each stripe keeps its own IPs
+        for i in range(20):
+            blacklist.add('10.0.0.%d' % i)
+        self.assertEqual(len(blacklist), 21)
+        self.assertEqual(len(blacklist.ips), 21)
+        self.assertTrue(min([len(ips) for ips in blacklist._ips]) > 0)
+        for index, ips in enumerate(blacklist._ips):
+            self.assertEqual(sorted(ips), sorted(blacklist._ttls[index]))
+
+    def test_blacklist_sync(self):
+        cache = MemoryClient(None)
+        first = Blacklist(cache, stripes=4, async=False)
+        second = Blacklist(cache, stripes=2, async=False)
+        first.add('ip1')
+        first.add('ip2', 10)
+        first.save()
+        ips, ttls = cache.get('keyexchange:blacklist')
+        self.assertEqual(ips, set(['ip1', 'ip2']))
+        self.assertEqual(sorted(ttls), ['ip1', 'ip2'])
+
+        # the IPs blacklisted by the other one are merged, the longest
+        # blacklisting wins
+        second.add('ip2', 20)
+        second.add('ip3', 5)
+        second.update()
+        self.assertEqual(sorted(second.ips), ['ip1', 'ip2', 'ip3'])
+        self.assertTrue('ip1' in second)
+        snapshot = second.snapshot()
+        self.assertEqual(snapshot['ip1'], None)
+        self.assertTrue(snapshot['ip2'] > ttls['ip2'])
+        second.save()
+        first.update()
+        self.assertEqual(sorted(first.ips), ['ip1', 'ip2', 'ip3'])
+        self.assertEqual(first.snapshot(), snapshot)
+
+        # an IP removed here doesn't come back from the cache
+        first.remove('ip3')
+        first.update()
+        self.assertFalse('ip3' in first)
+        first.save()
+        second.remove('ip3')
+        second.update()
+        self.assertEqual(sorted(second.ips), ['ip1', 'ip2'])
+        second.add('ip3')
+        self.assertTrue('ip3' in second)
+
+        # pickled before the stripes had their own IPs
+        blacklist = Blacklist.__new__(Blacklist)
+        blacklist.__setstate__({'_cache_server': None, '_dirty': False,
+                                'async': False, 'stripes': 4,
+                                'ips': set(['ip1', 'ip2']),
+                                '_ttls': {'ip1': None, 'ip2': 1}})
+        self.assertEqual(len(blacklist), 2)
+        self.assertTrue('ip1' in blacklist)
+        self.assertFalse('ip2' in blacklist)
+
+    def test_stripes(self):
+        app = IPFiltering(FakeApp(), queue_size=10, blacklist_ttl=.5,
+                          treshold=5, use_memory=True, stripes=4)
+        app.admin_page = '/__admin__'
+        app = TestApp(app)
+        env = {'REMOTE_ADDR': '193.0.0.1'}
+        for i in range(5):
+            app.get('/', status=200, extra_environ=env)
+        app.get('/', status=403, extra_environ=env)
+        self.assertEqual(app.app._last_ips.snapshot(), {'193.0.0.1': 5})
+        self.assertTrue('193.0.0.1' in app.get('/__admin__').body)
@@ -0,0 +1,76 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import time
+
+from keyexchange.health import HealthProber
+from keyexchange.util import MemoryClient
+
+
+class BrokenClient(MemoryClient):
+
+    def add(self, key, value, time=0):
+        return False
+
+
+class TestHealthProber(unittest.TestCase):
+
+    def test_status(self):
+        caches = {'one': MemoryClient(None), 'two': MemoryClient(None)}
+        prober = HealthProber(caches)
+        status = prober.get_status()
+        self.assertTrue(status['healthy'])
+        self.assertEqual(sorted(status['servers']), ['one', 'two'])
+
+        # the last status is used until it's too old
+        caches['two'] = BrokenClient(None)
+        self.assertTrue(prober.get_status(max_age=10)['healthy'])
+        status['time'] -= 20
+        status = prober.get_status(max_age=10)
+        self.assertFalse(status['healthy'])
+        self.assertTrue(status['servers']['one']['healthy'])
+        self.assertFalse(status['servers']['two']['healthy'])
+
+    def test_thread(self):
+        prober = HealthProber({'one': MemoryClient(None)}, frequency=.1)
+        prober.start()
+        try:
+            while prober.status is None:
+                time.sleep(.01)
+            self.assertTrue(prober.status['healthy'])
+        finally:
+            prober.join()
+        self.assertFalse(prober.isAlive())
@@ -36,8 +36,11 @@
 import unittest
 import time
 import threading
+import cPickle
 
-from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.filtering.ipqueue import (IPQueue, CompactIPQueue,
+                                         SpaceSavingQueue, StripedQueue,
+                                         pack_ip, unpack_ip)
 
 
 class Worker(threading.Thread):
@@ -69,9 +72,15 @@ class Remover(threading.Thread):
 
 class TestIPQueue(unittest.TestCase):
 
+    klass = IPQueue
+
+    def _stored(self, queue):
+        # the number of IPs kept, expired or not
+        return len(queue._nodes)
+
     def test_ttl(self):
         # we want to discard IP that are in the queue for too long
-        queue = IPQueue(ttl=.5)
+        queue = self.klass(ttl=.5)
 
         for ip in ('ip1', 'ip2', 'ip2', 'ip3', 'ip1'):
             queue.append(ip)
@@ -90,7 +99,7 @@ class TestIPQueue(unittest.TestCase):
 
     def test_threading(self):
         # make sure the queue supports concurrency
-        queue = IPQueue()
+        queue = self.klass()
         workers = [Worker(queue, ['1', '2', '3']) for i in range(10)]
         removers = [Remover(queue, ['2', '3']) for i in range(10)]
         for worker in workers + removers:
@@ -101,3 +110,226 @@ class TestIPQueue(unittest.TestCase):
 
         # if the queue is not thread-safe we would get less than 1000 here
         self.assertEqual(queue.count('1'), 1000)
+
+    def test_lru(self):
+        queue = self.klass(maxlen=3)
+        for ip in ('ip1', 'ip2', 'ip3', 'ip1', 'ip4'):
+            queue.append(ip)
+        # ip2 was the least recently seen
+        self.assertFalse('ip2' in queue)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.count('ip1'), 2)
+        queue.append('ip5')
+        self.assertFalse('ip3' in queue)
+        self.assertTrue('ip1' in queue)
+
+        queue.remove('ip1')
+        self.assertEqual(queue.count('ip1'), 0)
+        self.assertRaises(ValueError, queue.remove, 'ip1')
+
+    def test_expire_on_append(self):
+        queue = self.klass(ttl=.2)
+        for ip in ('ip1', 'ip2'):
+            queue.append(ip)
+        time.sleep(.3)
+        queue.append('ip3')
+        # the old IPs are gone without being looked up
+        self.assertEqual(self._stored(queue), 1)
+        self.assertEqual(len(queue), 1)
+
+    def test_snapshot(self):
+        queue = self.klass(ttl=.3)
+        queue.append('10.0.0.1')
+        time.sleep(.4)
+        for ip in ('10.0.0.2', '10.0.0.3', '10.0.0.2'):
+            queue.append(ip)
+        self.assertEqual(queue.snapshot(), {'10.0.0.2': 2, '10.0.0.3': 1})
+
+    def test_big_queue(self):
+        queue = self.klass(maxlen=50000)
+        for i in range(60000):
+            queue.append(str(i))
+        self.assertEqual(len(queue), 50000)
+        self.assertEqual(queue.count('9999'), 0)
+        self.assertEqual(queue.count('10000'), 1)
+
+        # the pickled queue keeps the order
+        queue2 = cPickle.loads(cPickle.dumps(queue, 2))
+        self.assertEqual(len(queue2), 50000)
+        queue2.append('new')
+        self.assertFalse('10000' in queue2)
+        self.assertTrue('10001' in queue2)
+
+
+class TestCompactIPQueue(TestIPQueue):
+
+    klass = CompactIPQueue
+
+    def _stored(self, queue):
+        return queue._size
+
+    def test_pack_ip(self):
+        self.assertEqual(pack_ip('1.2.3.4'),
+                         '\x00' * 10 + '\xff\xff\x01\x02\x03\x04')
+        self.assertEqual(pack_ip('::ffff:1.2.3.4'), pack_ip('1.2.3.4'))
+        self.assertEqual(pack_ip('2001:db8::1'),
+                         ' \x01\r\xb8' + '\x00' * 11 + '\x01')
+        # other strings are hashed
+        self.assertEqual(len(pack_ip('myip')), 16)
+        self.assertNotEqual(pack_ip('myip'), pack_ip('myip2'))
+
+        self.assertEqual(unpack_ip(pack_ip('1.2.3.4')), '1.2.3.4')
+        self.assertEqual(unpack_ip(pack_ip('2001:db8::1')), '2001:db8::1')
+
+    def test_collisions(self):
+        # a tiny table, most IPs share their bucket with others
+        queue = self.klass(maxlen=50)
+        ips = ['10.0.0.%d' % i for i in range(200)]
+        for rounds in range(3):
+            for ip in ips:
+                queue.append(ip)
+                queue.append(ip)
+            for ip in ips[-50:]:
+                self.assertEqual(queue.count(ip), 2)
+            for ip in ips[:-50]:
+                self.assertFalse(ip in queue)
+            for ip in ips[-50::3]:
+                queue.remove(ip)
+            for ip in ips[-50:]:
+                self.assertEqual(ip in queue, ip not in ips[-50::3])
+
+
+class TestSpaceSavingQueue(unittest.TestCase):
+
+    def test_window(self):
+        queue = SpaceSavingQueue(ttl=.5)
+        for ip in ('ip1', 'ip2', 'ip2', 'ip3', 'ip1'):
+            queue.append(ip)
+        self.assertEqual(queue.count('ip2'), 2)
+        self.assertTrue('ip3' in queue)
+        self.assertEqual(len(queue), 3)
+
+        # the counts are reset
+        time.sleep(.6)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.count('ip2'), 0)
+        queue.append('ip2')
+        self.assertEqual(queue.count('ip2'), 1)
+
+    def test_threading(self):
+        queue = SpaceSavingQueue()
+        workers = [Worker(queue, ['1', '2', '3']) for i in range(10)]
+        removers = [Remover(queue, ['2', '3']) for i in range(10)]
+        for worker in workers + removers:
+            worker.start()
+
+        for worker in workers + removers:
+            worker.join()
+
+        self.assertEqual(queue.count('1'), 1000)
+
+    def test_heavy_hitters(self):
+        queue = SpaceSavingQueue(maxlen=10)
+        # 3 IPs do half of the calls, among 1000 others
+        actual = {}
+        for i in range(1000):
+            queue.append('ip%d' % i)
+            if i % 2:
+                ip = 'bad%d' % (i % 3)
+                queue.append(ip)
+                actual[ip] = actual.get(ip, 0) + 1
+        self.assertEqual(len(queue), 10)
+
+        top = queue.top(3)
+        self.assertEqual(sorted([ip for ip, count, error in top]),
+                         ['bad0', 'bad1', 'bad2'])
+        for ip, count, error in top:
+            # the estimate is never below the actual count
+            self.assertTrue(count - error <= actual[ip] <= count)
+            self.assertEqual(queue.count(ip), count - error)
+            self.assertEqual(queue.error(ip), error)
+
+        # the others took the counter of another IP
+        ip, count, error = queue.top(10)[-1]
+        self.assertTrue(error >= count - 1)
+        self.assertTrue(queue.count(ip) <= 1)
+
+        # the counts miss at most calls / maxlen
+        calls = 1000 + sum(actual.values())
+        for ip, count, error in top:
+            self.assertTrue(actual[ip] - queue.count(ip) <= calls / 10)
+
+        # the IPs with a counter are in the queue, whatever their count
+        for ip, count, error in queue.top(10):
+            self.assertTrue(ip in queue)
+        self.assertFalse('ip0' in queue)
+
+        queue.remove('bad0')
+        self.assertFalse('bad0' in queue)
+        self.assertRaises(ValueError, queue.remove, 'bad0')
+        self.assertEqual(len(queue), 9)
+
+    def test_pickling(self):
+        queue = SpaceSavingQueue(maxlen=5)
+        for i in range(20):
+            queue.append('ip%d' % (i % 7))
+        queue2 = cPickle.loads(cPickle.dumps(queue, 2))
+        self.assertEqual(sorted(queue2.top(5)), sorted(queue.top(5)))
+
+        queue.append('ip0')
+        queue2.append('ip0')
+        self.assertEqual(queue2.count('ip0'), queue.count('ip0'))
+        self.assertEqual(queue2.top(1), queue.top(1))
+
+
+class TestStripedQueue(unittest.TestCase):
+
+    def test_stripes(self):
+        queue = StripedQueue(IPQueue, maxlen=100, stripes=4)
+        self.assertEqual([stripe._maxlen for stripe in queue._stripes],
+                         [25] * 4)
+        ips = ['10.0.0.%d' % i for i in range(20)]
+        for ip in ips + ips[:5]:
+            queue.append(ip)
+        self.assertEqual(len(queue), 20)
+        self.assertEqual(queue.count(ips[0]), 2)
+        self.assertEqual(queue.count(ips[10]), 1)
+        self.assertTrue(ips[10] in queue)
+
+        # the IPs are spread
+        self.assertTrue(min([len(stripe) for stripe in queue._stripes]) > 0)
+
+        queue.remove(ips[0])
+        self.assertFalse(ips[0] in queue)
+        self.assertRaises(ValueError, queue.remove, ips[0])
+
+        snapshot = queue.snapshot()
+        self.assertEqual(len(snapshot), 19)
+        self.assertEqual(snapshot[ips[1]], 2)
+
+        queue2 = cPickle.loads(cPickle.dumps(queue, 2))
+        self.assertEqual(queue2.snapshot(), snapshot)
+        queue2.append(ips[1])
+        self.assertEqual(queue2.count(ips[1]), 3)
+
+    def test_threading(self):
+        queue = StripedQueue(IPQueue, stripes=8)
+        ips = [str(i) for i in range(10)]
+        workers = [Worker(queue, ips) for i in range(10)]
+        removers = [Remover(queue, ips[5:]) for i in range(10)]
+        for worker in workers + removers:
+            worker.start()
+
+        snapshots = []
+        while [worker for worker in workers if worker.isAlive()]:
+            snapshots.append(queue.snapshot())
+
+        for worker in workers + removers:
+            worker.join()
+
+        for ip in ips[:5]:
+            self.assertEqual(queue.count(ip), 1000)
+        # every snapshot is taken between two appends
+        for snapshot in snapshots:
+            counts = [snapshot.get(ip, 0) for ip in ips[:5]]
+            self.assertTrue(max(counts) - min(counts) <= 10)
@@ -43,8 +43,9 @@ import random
 import hashlib
 import os
 import tempfile
+from StringIO import StringIO
 
-from webtest import TestApp, AppError
+from webtest import TestApp, TestRequest, AppError
 from paste.deploy import loadapp
 
 from keyexchange import wsgiapp
@@ -208,6 +209,8 @@ class TestWsgiApp(unittest.TestCase):
         for file_ in self._files:
             if os.path.exists(file_):
                 os.remove(file_)
+        if self.real_app is not None:
+            self.real_app.close()
 
     def _tmpfile(self):
         fd, name = tempfile.mkstemp()
@@ -478,8 +481,18 @@ class TestWsgiApp(unittest.TestCase):
         if self.distant:
             return
 
-        self.real_app.cache.add = lambda x, y: False
-        res = self.app.get('/', status=503, extra_environ=self.env)
+        # the checks are done by the calls rather than by the prober, so
+        # they can't run before the clients are broken
+        self.real_app.close()
+        self.real_app.health_frequency = 0
+        for client in self.real_app.health.caches.values():
+            client.add = lambda *args, **kw: False
+        self.app.get('/?deep=1', status=503, extra_environ=self.env)
+        self.app.get('/', status=503, extra_environ=self.env)
+        status = self.real_app.health.status
+        self.assertFalse(status['healthy'])
+        for server in status['servers'].values():
+            self.assertFalse(server['healthy'])
 
     def test_max_gets(self):
         headers = {'X-KeyExchange-Id': 'b' * 256}
@@ -594,6 +607,110 @@ class TestWsgiApp(unittest.TestCase):
 
         # success !
 
+    def test_max_payload(self):
+        headers = {'X-KeyExchange-Id': 'b' * 256}
+        res = self.app.get('/new_channel', status=200,
+                           headers=headers, extra_environ=self.env)
+        cid = str(json.loads(res.body))
+        curl = '/%s' % cid
+
+        # a body bigger than max_payload is rejected upfront
+        self.app.put(curl, headers=headers, extra_environ=self.env,
+                     params='x' * 16385, status=413)
+        self.app.post('/report', extra_environ=self.env,
+                      params='x' * 16385, status=413)
+
+        # the channel is still usable and was not touched
+        self.app.put(curl, headers=headers, extra_environ=self.env,
+                     params='x' * 16384, status=200)
+        res = self.app.get(curl, headers=headers, extra_environ=self.env)
+        self.assertEqual(res.body, 'x' * 16384)
+
+        if self.distant:
+            return
+
+        # reports are truncated to max_report_size
+        logs = []
+
+        def _counter(log, *args, **kw):
+            logs.append(kw['msg'])
+
+        old = wsgiapp.log_cef
+        wsgiapp.log_cef = _counter
+        try:
+            self.app.post('/report', params='x' * 5000,
+                          extra_environ=self.env)
+        finally:
+            wsgiapp.log_cef = old
+
+        self.assertEqual(logs, ['x' * 2000])
+
+    def test_chunked_body(self):
+        if self.distant:
+            return
+
+        headers = {'X-KeyExchange-Id': 'b' * 256}
+        res = self.app.get('/new_channel', status=200,
+                           headers=headers, extra_environ=self.env)
+        cid = str(json.loads(res.body))
+        curl = '/%s' % cid
+
+        # the server decoded the chunks, there's no Content-Length
+        def put(body, status):
+            environ = dict(self.env)
+            environ['HTTP_X_KEYEXCHANGE_ID'] = 'b' * 256
+            environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+            req = TestRequest.blank(curl, environ, method='PUT')
+            req.environ['wsgi.input'] = StringIO(body)
+            req.environ.pop('CONTENT_LENGTH', None)
+            self.assertEqual(req.content_length, None)
+            return self.app.do_request(req, status, False)
+
+        put('x' * 16385, 413)
+        put('x' * 5000, 200)
+        res = self.app.get(curl, headers=headers, extra_environ=self.env)
+        self.assertEqual(res.body, 'x' * 5000)
+
+    def test_stats(self):
+        if self.distant:
+            return
+
+        headers = {'X-KeyExchange-Id': 'b' * 256}
+        res = self.app.get('/new_channel', status=200,
+                           headers=headers, extra_environ=self.env)
+        cid = str(json.loads(res.body))
+        curl = '/%s' % cid
+        res = self.app.put(curl, headers=headers, extra_environ=self.env,
+                           params='xxx')
+        self.app.get(curl, headers=headers, extra_environ=self.env)
+        headers2 = dict(headers)
+        headers2['If-None-Match'] = res.headers['ETag']
+        self.app.get(curl, status=304, extra_environ=self.env,
+                     headers=headers2)
+
+        # the round trips to memcache are counted per request
+        res = self.app.get(curl, headers=headers, extra_environ=self.env)
+        environ = res.request.environ
+        self.assertTrue(environ['keyexchange.cache_calls'] >= 2)
+        self.assertTrue(environ['keyexchange.cache_time'] > 0)
+
+        res = self.app.get('/__stats__', extra_environ=self.env)
+        stats = json.loads(res.body)
+        for route in ('new_channel', 'put', 'get_hit', 'get_304'):
+            self.assertTrue(stats['route'][route]['count'] > 0)
+        self.assertTrue(stats['status']['304']['count'] > 0)
+
+        # every memcache call is measured
+        self.assertTrue(stats['cache']['get']['count'] > 0)
+        self.assertTrue(stats['cache_gets']['hit'] > 0)
+        self.assertTrue(stats['cache_size']['set']['max'] > 0)
+        self.assertTrue(stats['request']['cache_calls']['max'] > 0)
+
+        res = self.app.get('/__stats__?format=prometheus',
+                           extra_environ=self.env)
+        self.assertTrue('keyexchange_route_latency_seconds_count'
+                        '{name="get_304"}' in res.body)
+
     def test_new_channel_header(self):
         headers = {'X-KeyExchange-Id': 'b' * 256}
         res = self.app.get('/new_channel', status=200,
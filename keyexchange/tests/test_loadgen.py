@@ -0,0 +1,299 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import os
+import socket
+import threading
+import time
+
+from paste import httpserver
+
+from keyexchange.bench import loadgen
+from keyexchange.bench.app import build_app
+from keyexchange.bench.loadgen import (Loop, Sleep, Park, Return, Wait,
+                                       Timeout, Pool, find_knee, merge,
+                                       run, _arrivals, _split)
+
+
+def _app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH')
+                                          or 0))
+    headers = [('Content-Type', 'text/plain'),
+               ('Content-Length', str(len(body) + 2))]
+    if environ['PATH_INFO'] == '/close':
+        headers.append(('Connection', 'close'))
+    start_response('200 OK', headers)
+    return ['ok', body]
+
+
+class TestLoop(unittest.TestCase):
+
+    def test_calls(self):
+        loop = Loop()
+        res = []
+
+        def double(value):
+            yield Sleep(0.01)
+            yield Return(value * 2)
+
+        def failing():
+            yield Sleep(0)
+            raise ValueError()
+
+        def main():
+            value = yield double(2)
+            res.append(value)
+            try:
+                yield failing()
+            except ValueError:
+                res.append('error')
+
+        task = loop.spawn(main())
+        loop.run()
+        self.assertEqual(res, [4, 'error'])
+        self.assertTrue(task.done)
+        self.assertEqual(task.error, None)
+
+    def test_park(self):
+        loop = Loop()
+        waiters = []
+        res = []
+
+        def waiter():
+            value = yield Park(waiters)
+            res.append(value)
+
+        def waker():
+            yield Sleep(0.01)
+            loop.resume(waiters.pop(), 'awake')
+
+        loop.spawn(waiter())
+        loop.spawn(waker())
+        loop.run()
+        self.assertEqual(res, ['awake'])
+
+    def test_timeout(self):
+        loop = Loop()
+        sock, other = socket.socketpair()
+
+        def reader():
+            yield Wait(sock, 'r', 0.01)
+
+        task = loop.spawn(reader())
+        loop.run()
+        self.assertTrue(isinstance(task.error, Timeout))
+        sock.close()
+        other.close()
+
+    def test_arrivals(self):
+        loop = Loop()
+        started = []
+
+        def start_pairing(intended):
+            started.append((intended, loop.time()))
+
+        loop.spawn(_arrivals(loop, 5, 100., 'fixed', start_pairing))
+        loop.run()
+        self.assertEqual(len(started), 5)
+        for i in range(1, 5):
+            interval = started[i][0] - started[i - 1][0]
+            self.assertAlmostEqual(interval, .01)
+            # never started before its time
+            self.assertTrue(started[i][1] >= started[i][0])
+
+    def test_late_arrivals(self):
+        # when the loop is late, the pairings due start at once and keep
+        # their intended start time
+        loop = Loop()
+        started = []
+
+        def start_pairing(intended):
+            started.append(intended)
+            if len(started) == 1:
+                time.sleep(.05)
+
+        loop.spawn(_arrivals(loop, 5, 100., 'fixed', start_pairing))
+        start = time.time()
+        loop.run()
+        self.assertEqual(len(started), 5)
+        self.assertAlmostEqual(started[-1] - started[0], .04)
+        self.assertTrue(time.time() - start < .08)
+
+    def test_find_knee(self):
+        def step(rate, p99, achieved=None, errors=0):
+            if achieved is None:
+                achieved = rate
+            return {'config': {'rate': rate, 'pairings': rate * 10},
+                    'results': {'pairing_corrected': {'p99': p99},
+                                'pairings_per_sec': achieved,
+                                'errors': {'timeout': errors}}}
+
+        steps = [step(10, 100), step(20, 120), step(40, 250)]
+        self.assertEqual(find_knee(steps), None)
+        self.assertEqual(find_knee(steps + [step(80, 400)]), 80)
+        self.assertEqual(find_knee(steps + [step(80, 100, achieved=50)]), 80)
+        self.assertEqual(find_knee(steps + [step(80, 100, errors=10)]), 80)
+        self.assertEqual(find_knee([]), None)
+
+    def test_merge(self):
+        self.assertEqual(_split(10, 3), [4, 3, 3])
+        self.assertEqual(_split(2, 3), [1, 1, 0])
+
+        def shard(samples, duration, errors):
+            summary = {'samples': samples}
+            return {'benchmark': 'loadgen', 'config': {}, 'environment': {},
+                    'results': {'pairing': summary,
+                                'steps': {'put': summary},
+                                'completed': len(samples),
+                                'requests': 10 * len(samples),
+                                'connections': 2, 'duration': duration,
+                                'errors': errors,
+                                'round_one': {'hits': 2, 'misses': 1}}}
+
+        merged = merge([shard([1., 3.], 2., {'timeout': 1}),
+                        shard([2., 4., 5.], 2.5, {'timeout': 2, 'http_500': 1})
+                        ])['results']
+        self.assertEqual(merged['pairing']['samples'], [1., 2., 3., 4., 5.])
+        self.assertEqual(merged['pairing']['p50'], 3.)
+        self.assertEqual(merged['steps']['put']['count'], 5)
+        self.assertEqual(merged['completed'], 5)
+        self.assertEqual(merged['connections'], 4)
+        self.assertEqual(merged['duration'], 2.5)
+        self.assertEqual(merged['pairings_per_sec'], 2.)
+        self.assertEqual(merged['requests_per_sec'], 20.)
+        self.assertEqual(merged['errors'], {'timeout': 3, 'http_500': 1})
+        self.assertEqual(merged['round_one'], {'hits': 4, 'misses': 2})
+        self.assertEqual(len(merged['shards']), 2)
+        self.assertFalse('lag' in merged)
+
+    def test_dead_shard(self):
+        # the forked shards run this instead of the load
+        def run(url, ready=None, **options):
+            if options['pairings'] == 2:
+                ready()
+            os._exit(3)
+
+        old_run = loadgen.run
+        loadgen.run = run
+        try:
+            for pairings in (2, 4):
+                try:
+                    loadgen._run_sharded(2, url='http://localhost',
+                                         pairings=pairings, concurrency=1,
+                                         connections=1, rate=None,
+                                         precompute=0)
+                except RuntimeError, e:
+                    self.assertTrue('died with exit code 3' in str(e))
+                else:
+                    raise AssertionError('no error')
+        finally:
+            loadgen.run = old_run
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = httpserver.serve(_app, host='127.0.0.1', port=0,
+                                       protocol_version='HTTP/1.1',
+                                       start_loop=False)
+        self.server.timeout = .1
+        self.port = self.server.server_address[1]
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def _serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        loop = Loop()
+        pool = Pool(loop, '127.0.0.1', self.port, size=2)
+        res = []
+
+        def client(path):
+            for i in range(5):
+                status, headers, body = yield pool.request('POST', path,
+                                                           body='data')
+                res.append((status, body))
+
+        for i in range(4):
+            loop.spawn(client('/'))
+        loop.spawn(client('/close'))
+        loop.run()
+        pool.close()
+
+        self.assertEqual(len(res), 25)
+        self.assertEqual(set(res), set([(200, 'okdata')]))
+        # the tasks waited for the two connections
+        self.assertEqual(pool.connections, 2)
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        app, self.kxapp = build_app()
+        self.server = httpserver.serve(app, host='127.0.0.1', port=0,
+                                       protocol_version='HTTP/1.1',
+                                       start_loop=False)
+        self.server.timeout = .1
+        self.port = self.server.server_address[1]
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def _serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        self.server.server_close()
+        self.kxapp.close()
+
+    def test_run(self):
+        url = 'http://127.0.0.1:%d' % self.port
+        res = run(url, pairings=2, concurrency=1, poll=.01,
+                  timeout=5.)['results']
+        self.assertEqual(res['completed'], 2)
+        self.assertEqual(res['errors'], {})
+        self.assertEqual(res['pairing']['count'], 2)
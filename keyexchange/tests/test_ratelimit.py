@@ -0,0 +1,92 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import time
+import cPickle
+
+from keyexchange.filtering.ratelimit import TokenBucketLimiter
+
+
+class TestTokenBucketLimiter(unittest.TestCase):
+
+    def test_burst(self):
+        limiter = TokenBucketLimiter(rate=1, burst=3)
+        for i in range(3):
+            self.assertTrue(limiter.consume('ip'))
+        self.assertFalse(limiter.consume('ip'))
+        self.assertFalse(limiter.consume('ip'))
+        # other IPs have their own bucket
+        self.assertTrue(limiter.consume('ip2'))
+        self.assertEqual(limiter.count('ip3'), 3)
+
+    def test_refill(self):
+        limiter = TokenBucketLimiter(rate=20, burst=2)
+        self.assertTrue(limiter.consume('ip'))
+        self.assertTrue(limiter.consume('ip'))
+        self.assertFalse(limiter.consume('ip'))
+        time.sleep(.06)
+        self.assertTrue(limiter.consume('ip'))
+        self.assertFalse(limiter.consume('ip'))
+
+        # the bucket does not get bigger than burst
+        time.sleep(.3)
+        self.assertEqual(limiter.count('ip'), 2)
+
+    def test_bounded(self):
+        limiter = TokenBucketLimiter(rate=1, burst=1, maxlen=3)
+        for ip in ('ip1', 'ip2', 'ip3', 'ip4'):
+            limiter.consume(ip)
+        self.assertEqual(len(limiter), 3)
+        self.assertFalse('ip1' in limiter)
+        self.assertTrue('ip4' in limiter)
+
+        # idle IPs are forgotten once their bucket is full again
+        limiter = TokenBucketLimiter(rate=20, burst=1)
+        limiter.consume('ip')
+        self.assertEqual(len(limiter), 1)
+        time.sleep(.1)
+        self.assertEqual(len(limiter), 0)
+        self.assertTrue(limiter.consume('ip'))
+
+    def test_pickling(self):
+        limiter = TokenBucketLimiter(rate=.1, burst=2)
+        limiter.consume('ip')
+        limiter.consume('ip')
+        limiter = cPickle.loads(cPickle.dumps(limiter))
+        self.assertEqual(limiter.rate, .1)
+        self.assertFalse(limiter.consume('ip'))
+        self.assertTrue(limiter.consume('ip2'))
+
@@ -0,0 +1,153 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import time
+import threading
+
+from webtest import TestApp
+
+from keyexchange.sampler import SamplerMiddleware
+
+
+class BusyApp(object):
+    def __call__(self, environ, start_response):
+        end = time.time() + .3
+        while time.time() < end:
+            sum(range(100))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.middleware = SamplerMiddleware(BusyApp(), path='__sampler__',
+                                            interval=.001)
+        self.app = TestApp(self.middleware)
+
+    def tearDown(self):
+        self.middleware.sampler.join()
+
+    def _busy(self):
+        worker = threading.Thread(target=self.app.get, args=('/',))
+        worker.start()
+        return worker
+
+    def test_window(self):
+        worker = self._busy()
+        res = self.app.get('/__sampler__?seconds=.2')
+        worker.join()
+
+        # the busy thread was caught in the app
+        stacks = [line for line in res.body.split('\n')
+                  if 'test_sampler.py:__call__' in line]
+        self.assertTrue(len(stacks) > 0)
+        count = int(stacks[0].split(' ')[-1])
+        self.assertTrue(count > 0)
+        self.assertFalse(self.middleware.sampler.sampling)
+
+    def test_start_stop(self):
+        self.app.get('/__sampler__?action=start')
+        self.assertTrue(self.middleware.sampler.sampling)
+        self._busy().join()
+        res = self.app.get('/__sampler__?action=stop')
+        self.assertFalse(self.middleware.sampler.sampling)
+        self.assertTrue('test_sampler.py:__call__' in res.body)
+
+        # the samples are kept until the next start
+        res2 = self.app.get('/__sampler__?action=dump')
+        self.assertEqual(res.body, res2.body)
+
+        self.app.get('/__sampler__?action=boom', status=400)
+        self.app.get('/__sampler__?seconds=boom', status=400)
+
+    def test_invalid_seconds(self):
+        for seconds in ('-1', '0', 'nan', 'inf', '61'):
+            self.app.get('/__sampler__?seconds=%s' % seconds, status=400)
+        self.assertFalse(self.middleware.sampler.sampling)
+        self.assertFalse(self.middleware.sampler.running)
+
+        # the sampling stops even if the window fails
+        old_sleep = time.sleep
+        request_thread = threading.current_thread()
+
+        def _sleep(seconds):
+            if threading.current_thread() is request_thread:
+                raise IOError(22, 'Invalid argument')
+            old_sleep(seconds)
+
+        time.sleep = _sleep
+        try:
+            self.assertRaises(IOError, self.app.get,
+                              '/__sampler__?seconds=1')
+        finally:
+            time.sleep = old_sleep
+        self.assertFalse(self.middleware.sampler.sampling)
+
+    def test_restart(self):
+        sampler = self.middleware.sampler
+        errors = []
+
+        def _start():
+            try:
+                self.app.get('/__sampler__?action=start')
+            except Exception, e:
+                errors.append(e)
+
+        # concurrent first starts
+        workers = [threading.Thread(target=_start) for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(sampler.sampling)
+
+        # a new thread samples once the previous one was joined
+        sampler.join()
+        self.assertFalse(sampler.sampling)
+        self.app.get('/__sampler__?action=start')
+        self._busy().join()
+        res = self.app.get('/__sampler__?action=stop')
+
+        # the line being run is recorded, not the first one of the function
+        first = BusyApp.__call__.im_func.func_code.co_firstlineno
+        lines = set([int(frame.split(':')[-1].split(' ')[0])
+                     for line in res.body.split('\n')
+                     for frame in line.split(';')
+                     if 'test_sampler.py:__call__:' in frame])
+        self.assertTrue(len(lines) > 0)
+        self.assertFalse(first in lines)
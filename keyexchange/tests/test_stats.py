@@ -0,0 +1,151 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import threading
+import random
+import time
+
+from keyexchange.stats import Histogram, Stats, _bucket, _bucket_range
+
+
+class TestStats(unittest.TestCase):
+
+    def test_buckets(self):
+        for i in range(10000):
+            value = random.random() * 10 ** random.randint(0, 10)
+            low, high = _bucket_range(_bucket(value))
+            self.assertTrue(low <= value < high)
+            # above 16 units, the precision is relative to the value
+            if value >= 16:
+                self.assertTrue((high - low) / high < .07)
+
+    def test_summary(self):
+        histogram = Histogram()
+        values = [random.expovariate(1 / 1000.) for i in range(10000)]
+        for value in values:
+            histogram.record(value)
+
+        values.sort()
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 10000)
+        self.assertEqual(summary['max'], values[-1])
+        for percentile in (50, 90, 99):
+            real = values[int(10000 * percentile / 100.) - 1]
+            found = summary['p%d' % percentile]
+            self.assertTrue(abs(found - real) / real < .07)
+
+        # empty histograms
+        self.assertEqual(Histogram().summary()['p99'], 0)
+
+    def test_threads(self):
+        histogram = Histogram()
+        recorded = threading.Semaphore(0)
+        done = threading.Event()
+
+        def _record():
+            for i in range(1000):
+                histogram.record(i)
+            recorded.release()
+            done.wait()
+
+        workers = [threading.Thread(target=_record) for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            recorded.acquire()
+
+        # every thread got its own buckets
+        self.assertEqual(len(histogram._shards), 10)
+        self.assertEqual(histogram.summary()['count'], 10000)
+
+        done.set()
+        for worker in workers:
+            worker.join()
+
+        # the buckets of the threads that ended are folded, once their
+        # thread state is cleared
+        for i in range(100):
+            if len(histogram._shards) == 0:
+                break
+            time.sleep(.01)
+        self.assertEqual(len(histogram._shards), 0)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 10000)
+        self.assertEqual(summary['max'], 999)
+
+        # a new thread starts from scratch
+        worker = threading.Thread(target=histogram.record, args=(5000,))
+        worker.start()
+        worker.join()
+        self.assertEqual(histogram.summary()['count'], 10001)
+
+    def test_counters(self):
+        stats = Stats()
+
+        def _incr():
+            for i in range(1000):
+                stats.incr('cache_gets.hit')
+
+        workers = [threading.Thread(target=_incr) for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        stats.incr('cache_gets.miss', 5)
+        self.assertEqual(stats.to_json()['cache_gets'],
+                         {'hit': 10000, 'miss': 5})
+        res = stats.to_prometheus().split('\n')
+        self.assertTrue('keyexchange_cache_gets_total{name="miss"} 5' in res)
+
+    def test_export(self):
+        stats = Stats()
+        stats.record('route.put', 1000)
+        stats.record('route.put', 3000)
+        stats.record('status.200', 1000)
+        stats.record('size.get', 20, unit='bytes')
+
+        res = stats.to_json()
+        self.assertEqual(sorted(res.keys()), ['route', 'size', 'status'])
+        self.assertEqual(res['route']['put']['count'], 2)
+        self.assertEqual(res['route']['put']['mean'], 2000)
+
+        res = stats.to_prometheus().split('\n')
+        self.assertTrue('# TYPE keyexchange_route_latency_seconds summary'
+                        in res)
+        self.assertTrue('keyexchange_route_latency_seconds_count'
+                        '{name="put"} 2' in res)
+        self.assertTrue('keyexchange_size_bytes_sum{name="get"} 20.0' in res)
@@ -36,11 +36,37 @@
 """ Various helpers.
 """
 import json
+import time
+import threading
+import atexit
+import weakref
+
 from webob import Response
+from webob.exc import HTTPRequestEntityTooLarge
 from services.util import randchar
 
+from keyexchange.stats import Stats
+
 
 CID_CHARS = '23456789abcdefghijkmnpqrstuvwxyz'
+_CHUNK_SIZE = 4096
+
+# background threads to stop at exit, only weakly referenced so the
+# threads that were stopped and dropped meanwhile are not kept alive
+_STOPPED_AT_EXIT = weakref.WeakKeyDictionary()
+
+
+def stop_at_exit(thread):
+    """Calls the join() method of the thread before the interpreter tears
+    the modules down, if the thread is still around by then."""
+    _STOPPED_AT_EXIT[thread] = True
+
+
+def _stop_threads():
+    for thread in _STOPPED_AT_EXIT.keys():
+        thread.join()
+
+atexit.register(_stop_threads)
 
 
 def json_response(data, dump=True, **kw):
@@ -50,6 +76,58 @@ def json_response(data, dump=True, **kw):
     return Response(data, content_type='application/json', **kw)
 
 
+def read_body(request, max_size, truncate=False):
+    """Reads the request body without buffering more than max_size bytes.
+
+    The Content-Length is checked before anything is read: if it's bigger
+    than max_size a 413 is raised, unless truncate is True, in which case
+    only the first max_size bytes are read and the rest is left in the
+    input stream.
+
+    The body is read by chunks into a buffer allocated once for the
+    expected size. Without a Content-Length, like for a chunked body, the
+    input is read until its end, with the same limit.
+    """
+    input = request.environ['wsgi.input']
+    size = request.content_length
+    if size is None:
+        return _read_until_eof(input, max_size, truncate)
+    if size > max_size:
+        if not truncate:
+            raise HTTPRequestEntityTooLarge()
+        size = max_size
+
+    buffer = bytearray(size)
+    pos = 0
+    while pos < size:
+        chunk = input.read(min(size - pos, _CHUNK_SIZE))
+        if not chunk:
+            break   # the client sent less than announced
+        buffer[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+
+    return str(buffer[:pos])
+
+
+def _read_until_eof(input, max_size, truncate):
+    # one byte more than max_size tells if the body is too big
+    chunks = []
+    read = 0
+    while read <= max_size:
+        chunk = input.read(min(max_size + 1 - read, _CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        read += len(chunk)
+
+    body = ''.join(chunks)
+    if len(body) > max_size:
+        if not truncate:
+            raise HTTPRequestEntityTooLarge()
+        body = body[:max_size]
+    return body
+
+
 def generate_cid(size=4):
     """Returns a random channel id."""
     return ''.join([randchar(CID_CHARS) for i in range(size)])
@@ -111,6 +189,81 @@ class PrefixedCache(object):
         return self.cache.add(self.prefix + key, value, **kw)
 
 
+def _sizeof(value):
+    """Returns roughly how many bytes a value takes in memcache."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum([_sizeof(item) for item in value])
+    if value is None:
+        return 0
+    return 8
+
+
+class InstrumentedCache(PrefixedCache):
+    """PrefixedCache that measures every memcache call.
+
+    - stats: the Stats instance where the metrics are recorded: the
+      latency of each operation ("cache.<op>"), the size of the values
+      read and written ("cache_size.<op>") and the hits and misses of get
+      ("cache_gets.hit", "cache_gets.miss").
+
+    Each thread also keeps the number of calls and the time spent in
+    memcache since its last call to start_request().
+    """
+    def __init__(self, cache, prefix='', stats=None):
+        PrefixedCache.__init__(self, cache, prefix)
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+        self._local = threading.local()
+
+    def start_request(self):
+        """Resets the counters of the current thread."""
+        self._local.calls = 0
+        self._local.time = 0.
+
+    def request_stats(self):
+        """Returns the number of calls and the time spent in memcache by the
+        current thread since start_request() was called."""
+        local = self._local
+        return getattr(local, 'calls', 0), getattr(local, 'time', 0.)
+
+    def _call(self, op, method, *args, **kw):
+        start = time.time()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            duration = time.time() - start
+            self.stats.record('cache.%s' % op, duration * 1000000)
+            local = self._local
+            local.calls = getattr(local, 'calls', 0) + 1
+            local.time = getattr(local, 'time', 0.) + duration
+
+    def incr(self, key):
+        return self._call('incr', PrefixedCache.incr, key)
+
+    def get(self, key):
+        res = self._call('get', PrefixedCache.get, key)
+        if res is None:
+            self.stats.incr('cache_gets.miss')
+        else:
+            self.stats.incr('cache_gets.hit')
+            self.stats.record('cache_size.get', _sizeof(res), unit='bytes')
+        return res
+
+    def set(self, key, value, **kw):
+        self.stats.record('cache_size.set', _sizeof(value), unit='bytes')
+        return self._call('set', PrefixedCache.set, key, value, **kw)
+
+    def delete(self, key):
+        return self._call('delete', PrefixedCache.delete, key)
+
+    def add(self, key, value, **kw):
+        self.stats.record('cache_size.add', _sizeof(value), unit='bytes')
+        return self._call('add', PrefixedCache.add, key, value, **kw)
+
+
 def get_memcache_class(memory=False):
     """Returns the memcache class."""
     if memory:
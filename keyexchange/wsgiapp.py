@@ -39,19 +39,24 @@ KeyExchange server - see https://wiki.mozilla.org/Services/Sync/SyncKey/J-PAKE
 import re
 from hashlib import md5
 import time
-import random
 
 from webob.dec import wsgify
 from webob.exc import (HTTPNotModified, HTTPNotFound, HTTPServiceUnavailable,
                        HTTPBadRequest, HTTPMethodNotAllowed,
-                       HTTPMovedPermanently, HTTPPreconditionFailed)
+                       HTTPMovedPermanently, HTTPPreconditionFailed,
+                       HTTPRequestEntityTooLarge, HTTPException)
+from webob import Response
 
 from cef import log_cef
 from services.config import Config
 
 from keyexchange.util import (generate_cid, json_response, CID_CHARS,
-                              PrefixedCache, get_memcache_class)
+                              InstrumentedCache, get_memcache_class,
+                              read_body)
 from keyexchange.filtering import IPFiltering
+from keyexchange.health import HealthProber
+from keyexchange.ceflog import AsyncCEFLogger, CEFAggregator
+from keyexchange.stats import Stats
 
 
 _URL = re.compile('^/(new_channel|report|[%s]+)/?$' % CID_CHARS)
@@ -73,15 +78,68 @@ class KeyExchangeApp(object):
         self.cid_len = config.get('keyexchange.cid_len', 4)
         self.ttl = config.get('keyexchange.ttl', 300)
         self.max_gets = config.get('keyexchange.max_gets', 6)
+        self.max_payload = config.get('keyexchange.max_payload', 16384)
+        self.max_report_size = config.get('keyexchange.max_report_size',
+                                          2000)
         self.root = self.config.get('keyexchange.root_redirect')
+        self.stats = Stats()
+        self.stats_path = config.get('keyexchange.stats_path')
+        if self.stats_path is not None and not self.stats_path.startswith('/'):
+            self.stats_path = '/' + self.stats_path
         servers = config.get('keyexchange.cache_servers', ['127.0.0.1:11211'])
         if isinstance(servers, str):
             self.cache_servers = [servers]
         else:
             self.cache_servers = servers
         use_memory = config.get('keyexchange.use_memory', False)
-        cache = get_memcache_class(use_memory)(self.cache_servers)
-        self.cache = PrefixedCache(cache, _CPREFIX)
+        cache_class = get_memcache_class(use_memory)
+        self.cache = InstrumentedCache(cache_class(self.cache_servers),
+                                       _CPREFIX, stats=self.stats)
+
+        # the health of each memcache server is checked in the background
+        self.health_frequency = config.get('keyexchange.health_frequency', 5)
+        probes = dict([(server, cache_class([server]))
+                       for server in self.cache_servers])
+        self.health = HealthProber(probes, self.health_frequency)
+        if self.health_frequency:
+            self.health.start()
+
+        # CEF records can be written by a background thread
+        if config.get('cef.async', False):
+            self.cef_logger = AsyncCEFLogger(
+                    maxsize=config.get('cef.queue_size', 10000),
+                    batch_size=config.get('cef.batch_size', 100),
+                    overflow=config.get('cef.overflow', 'drop'))
+            self.cef_logger.start()
+        else:
+            self.cef_logger = None
+
+        # repeated CEF events from a same IP can be aggregated
+        if config.get('cef.aggregate', False):
+            # the writer closes the windows, the requests never do
+            if self.cef_logger is None:
+                raise ValueError('cef.aggregate needs cef.async')
+            window = config.get('cef.aggregate_window', 60)
+            self.cef_aggregator = CEFAggregator(self.cef_logger.log_cef,
+                                                window=window)
+            self.cef_logger.periodic = self.cef_aggregator.tick
+        else:
+            self.cef_aggregator = None
+
+    def close(self):
+        """Stops the background threads."""
+        self.health.join()
+        if self.cef_logger is not None:
+            self.cef_logger.join()
+
+    def _log_cef(self, name, severity, environ, *args, **kw):
+        if self.cef_aggregator is not None:
+            log = self.cef_aggregator.log_cef
+        elif self.cef_logger is not None:
+            log = self.cef_logger.log_cef
+        else:
+            log = log_cef
+        log(name, severity, environ, self.config, *args, **kw)
 
     def _get_new_cid(self, client_id):
         tries = 0
@@ -104,23 +162,81 @@ class KeyExchangeApp(object):
 
         return new_cid
 
-    def _health_check(self):
-        """Checks that memcache is up and works as expected"""
-        rand = ''.join([random.choice('abcdefgh1234567') for i in range(50)])
-        key = 'test_%s' % rand
-        success = self.cache.add(key, 'test')
-        if not success:
-            raise HTTPServiceUnavailable()
-        stored = self.cache.get(key)
-        if stored != 'test':
-            raise HTTPServiceUnavailable()
-        self.cache.delete(key)
-        stored = self.cache.get(key)
-        if stored is not None:
+    def _health_check(self, deep=False):
+        """Checks that memcache is up and works as expected.
+
+        Unless deep is True, the last result of the background prober is
+        used, as long as the prober is running and the result is fresh.
+        """
+        if deep or not self.health_frequency:
+            status = self.health.check()
+        else:
+            status = self.health.get_status(max_age=self.health_frequency * 3)
+        if not status['healthy']:
             raise HTTPServiceUnavailable()
 
+    def _route(self, request, status):
+        """Returns the name of the route used in the stats."""
+        url = request.path_info
+        if url == '/':
+            return 'health'
+        match = _URL.match(url)
+        if match is None:
+            return 'not_found'
+        url = match.group(1)
+        if url in ('new_channel', 'report'):
+            return url
+        if request.method == 'GET':
+            if status == 304:
+                return 'get_304'
+            return 'get_hit'
+        return request.method.lower()
+
+    def _record(self, request, status, start):
+        duration = (time.time() - start) * 1000000
+        self.stats.record('route.%s' % self._route(request, status), duration)
+        self.stats.record('status.%d' % status, duration)
+
+        # memcache round trips done for this request
+        calls, cache_time = self.cache.request_stats()
+        request.environ['keyexchange.cache_calls'] = calls
+        request.environ['keyexchange.cache_time'] = cache_time
+        self.stats.record('request.cache_calls', calls, unit='calls')
+        self.stats.record('request.cache_time', cache_time * 1000000)
+
+    def stats_view(self, request):
+        """Returns the stats in JSON, or in the Prometheus text format."""
+        if request.method != 'GET':
+            raise HTTPMethodNotAllowed()
+        if request.GET.get('format') == 'prometheus':
+            return Response(self.stats.to_prometheus(),
+                            content_type='text/plain; version=0.0.4')
+        stats = self.stats.to_json()
+        stats['health'] = self.health.status
+        if self.cef_logger is not None:
+            stats['cef'] = self.cef_logger.stats()
+        return json_response(stats)
+
     @wsgify
     def __call__(self, request):
+        if request.path_info == self.stats_path:
+            return self.stats_view(request)
+
+        start = time.time()
+        status = 500
+        self.cache.start_request()
+        try:
+            try:
+                response = self._dispatch(request)
+            except HTTPException, response:
+                # webob's HTTP exceptions are also responses
+                pass
+            status = response.status_int
+            return response
+        finally:
+            self._record(request, status, start)
+
+    def _dispatch(self, request):
         request.config = self.config
         client_id = request.headers.get('X-KeyExchange-Id')
         method = request.method
@@ -131,7 +247,8 @@ class KeyExchangeApp(object):
         if url == '/':
             if method != 'GET':
                 raise HTTPMethodNotAllowed()
-            self._health_check()
+            deep = request.GET.get('deep', 'false').lower() in ('1', 'true')
+            self._health_check(deep)
             raise HTTPMovedPermanently(location=self.root)
 
         match = _URL.match(url)
@@ -139,6 +256,12 @@ class KeyExchangeApp(object):
             raise HTTPNotFound()
 
         url = match.group(1)
+
+        # oversized bodies are rejected before anything is read or stored
+        content_length = request.content_length
+        if content_length is not None and content_length > self.max_payload:
+            raise HTTPRequestEntityTooLarge()
+
         if url == 'new_channel':
             # creation of a channel
             if method != 'GET':
@@ -147,8 +270,8 @@ class KeyExchangeApp(object):
                 # The X-KeyExchange-Id is valid
                 try:
                     log = 'Invalid X-KeyExchange-Id'
-                    log_cef(log, 5, request.environ, self.config,
-                            msg=_cid2str(client_id))
+                    self._log_cef(log, 5, request.environ,
+                                  msg=_cid2str(client_id))
                 finally:
                     raise HTTPBadRequest()
             cid = self._get_new_cid(client_id)
@@ -184,14 +307,13 @@ class KeyExchangeApp(object):
             # the key is invalid
             try:
                 log = 'Invalid X-KeyExchange-Id'
-                log_cef(log, 5, request.environ, self.config,
-                        msg=_cid2str(client_id))
+                self._log_cef(log, 5, request.environ,
+                              msg=_cid2str(client_id))
             finally:
                 # we need to kill the channel
                 if not self._delete_channel(channel_id):
-                    log_cef('Could not delete the channel', 5,
-                            request.environ, self.config,
-                            msg=_cid2str(channel_id))
+                    self._log_cef('Could not delete the channel', 5,
+                                  request.environ, msg=_cid2str(channel_id))
 
                 raise HTTPBadRequest()
 
@@ -199,8 +321,7 @@ class KeyExchangeApp(object):
         if content is None:
             # we have a valid channel id but it does not exists.
             log = 'Invalid X-KeyExchange-Channel'
-            log_cef(log, 5, request.environ, self.config,
-                    _cid2str(channel_id))
+            self._log_cef(log, 5, request.environ, _cid2str(channel_id))
             raise HTTPNotFound()
 
         ttl, ids, data, etag = content
@@ -217,13 +338,12 @@ class KeyExchangeApp(object):
             # that's an unknown id, hu-ho
             try:
                 log = 'Unknown X-KeyExchange-Id'
-                log_cef(log, 5, request.environ, self.config,
-                        msg=_cid2str(client_id))
+                self._log_cef(log, 5, request.environ,
+                              msg=_cid2str(client_id))
             finally:
                 if not self._delete_channel(channel_id):
-                    log_cef('Could not delete the channel', 5,
-                            request.environ, self.config,
-                            msg=_cid2str(channel_id))
+                    self._log_cef('Could not delete the channel', 5,
+                                  request.environ, msg=_cid2str(channel_id))
 
                 raise HTTPBadRequest()
 
@@ -247,7 +367,7 @@ class KeyExchangeApp(object):
         """Append data into channel."""
         ttl, ids, old_data, old_etag = existing_content
 
-        data = request.body
+        data = read_body(request, self.max_payload)
         etag = self._etag(data)
 
         # check the If-Match header
@@ -264,8 +384,7 @@ class KeyExchangeApp(object):
                 if old_data != _EMPTY:
                     raise HTTPPreconditionFailed(etag=etag)
 
-        if not self.cache.set(channel_id, (ttl, ids, request.body, etag),
-                              time=ttl):
+        if not self.cache.set(channel_id, (ttl, ids, data, etag), time=ttl):
             raise HTTPServiceUnavailable()
 
         return json_response('', etag=etag)
@@ -300,9 +419,8 @@ class KeyExchangeApp(object):
             # deleting the channel in case we did all GETs
             if deletion:
                 if not self._delete_channel(channel_id):
-                    log_cef('Could not delete the channel', 5,
-                            request.environ, self.config,
-                            msg=_cid2str(channel_id))
+                    self._log_cef('Could not delete the channel', 5,
+                                  request.environ, msg=_cid2str(channel_id))
 
     def _delete_channel(self, channel_id):
         self.cache.delete('GET:%s' % channel_id)
@@ -312,7 +430,7 @@ class KeyExchangeApp(object):
         return self.cache.delete(channel_id)
 
     def blacklisted(self, ip, environ):
-        log_cef('BlackListed IP', 5, environ, self.config, msg=ip)
+        self._log_cef('BlackListed IP', 5, environ, msg=ip)
 
     def report(self, request, client_id):
         """Reports a log and delete the channel if relevant"""
@@ -322,14 +440,15 @@ class KeyExchangeApp(object):
         if header_log is not None:
             log.append(header_log)
 
-        body_log = request.body[:2000].strip()
+        body_log = read_body(request, self.max_report_size,
+                             truncate=True).strip()
         if body_log != '':
             log.append(body_log)
 
         # logging only if the log is not empty
         if len(log) > 0:
             log = '\n'.join(log)
-            log_cef('Report', 5, request.environ, self.config, msg=log)
+            self._log_cef('Report', 5, request.environ, msg=log)
 
         # removing the channel if present
         channel_id = request.headers.get('X-KeyExchange-Cid')
@@ -342,9 +461,8 @@ class KeyExchangeApp(object):
                 # if the client_ids is in ids, we allow the deletion
                 # of the channel
                 if not self._delete_channel(channel_id):
-                    log_cef('Could not delete the channel', 5,
-                            request.environ, self.config,
-                            msg=_cid2str(channel_id))
+                    self._log_cef('Could not delete the channel', 5,
+                                  request.environ, msg=_cid2str(channel_id))
 
         return json_response('')
 
@@ -365,6 +483,14 @@ def make_app(global_conf, **app_conf):
                                           flush_at_shutdown=True,
                                            path='/__profile__')
 
+    # hooking a sampling profiler, driven at runtime from its admin URL
+    if global_conf.get('sampler', 'false').lower() == 'true':
+        from keyexchange.sampler import SamplerMiddleware
+        interval = float(global_conf.get('sampler_interval', '0.005'))
+        app = SamplerMiddleware(app, path=global_conf.get('sampler_path',
+                                                          '/__sampler__'),
+                                interval=interval)
+
     # hooking a client debugger
     if global_conf.get('client_debug', 'false').lower() == 'true':
         from paste.exceptions.errormiddleware import ErrorMiddleware